@@ -0,0 +1,188 @@
+import json
+from functools import wraps
+
+from api.authentication import aauthenticate
+from api.models import AppUser, ChatRoom, Friendship, Message
+from api.pagination import apaginate_messages, legacy_page_size, set_cursor_headers
+from api.serializers import (ChatRoomSerializer, FriendshipSerializer,
+                             MessageSerializer)
+from django.db.models import Q
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import aget_object_or_404
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions, status
+
+# async versions of the read heavy views in api/views.py (routed under api/async/)
+# DRF views are sync only, under ASGI every one of them holds a thread of the sync_to_async
+# pool for the whole request, the same small pool the chat consumers use for the db.
+# these are plain django async views using the async ORM, so a worker can wait on many
+# queries at once. responses are the same json the DRF versions return
+
+
+def async_api_view(methods):
+    """
+    The parts of @api_view these views need: allowed methods, token auth
+    (same token cache as CachedTokenAuthentication), request.data and json errors
+    """
+
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in methods:
+                return JsonResponse(
+                    {"detail": f'Method "{request.method}" not allowed.'},
+                    status=status.HTTP_405_METHOD_NOT_ALLOWED,
+                )
+
+            try:
+                user = await aauthenticate(request)
+            except exceptions.AuthenticationFailed as e:
+                user = None
+                detail = str(e.detail)
+            else:
+                detail = "Authentication credentials were not provided."
+            if user is None:
+                response = JsonResponse(
+                    {"detail": detail}, status=status.HTTP_401_UNAUTHORIZED
+                )
+                response["WWW-Authenticate"] = "Token"
+                return response
+            request.user = user
+
+            try:
+                request.data = parse_data(request)
+            except ValueError:
+                return JsonResponse(
+                    {"detail": "JSON parse error"}, status=status.HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                return await view(request, *args, **kwargs)
+            except Http404 as e:
+                return JsonResponse({"detail": str(e)}, status=status.HTTP_404_NOT_FOUND)
+
+        # token auth only, same as the DRF views
+        return csrf_exempt(wrapper)
+
+    return decorator
+
+
+def parse_data(request):
+    if request.method == "GET":
+        return {}
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}")
+    return request.POST
+
+
+@async_api_view(["GET"])
+async def get_chatrooms(request):
+    user_id = request.user.id
+
+    chatrooms = [
+        chatroom
+        async for chatroom in ChatRoom.objects.filter(
+            Q(user1_id=user_id) | Q(user2_id=user_id)
+        ).select_related("user1", "user2")
+    ]
+    serializer = ChatRoomSerializer(chatrooms, many=True)
+    return JsonResponse(serializer.data, safe=False)
+
+
+@async_api_view(["GET"])
+async def get_friends(request):
+    user_id = request.user.id
+
+    accepted_friends = [
+        friendship
+        async for friendship in Friendship.objects.filter(
+            Q(to_user_id=user_id, status="accepted")
+            | Q(from_user_id=user_id, status="accepted")
+        ).select_related("from_user", "to_user")
+    ]
+    serializer = FriendshipSerializer(instance=accepted_friends, many=True)
+    return JsonResponse(serializer.data, safe=False)
+
+
+@async_api_view(["GET"])
+async def get_pending_friends(request):
+    pending_friends = [
+        friendship
+        async for friendship in Friendship.objects.filter(
+            to_user_id=request.user.id, status="pending"
+        ).select_related("from_user", "to_user")
+    ]
+    serializer = FriendshipSerializer(instance=pending_friends, many=True)
+    return JsonResponse(serializer.data, safe=False)
+
+
+@async_api_view(["POST"])
+async def get_messages_from_db(request):
+    chatroom = await aget_object_or_404(ChatRoom, id=request.data.get("chatroom_id"))
+    all_messages = Message.objects.filter(chat_room=chatroom)
+
+    before_id = request.data.get("before_id")
+    after_id = request.data.get("after_id")
+    page_size = request.data.get("page_size")
+
+    # old clients dont send any cursor, they still get a plain list but only of the newest page
+    if before_id is None and after_id is None and page_size is None:
+        messages, next_cursor, has_more = await apaginate_messages(
+            all_messages, page_size=legacy_page_size()
+        )
+        serializer = MessageSerializer(instance=messages, many=True)
+        return set_cursor_headers(
+            JsonResponse(serializer.data, safe=False), next_cursor, has_more
+        )
+
+    try:
+        messages, next_cursor, has_more = await apaginate_messages(
+            all_messages, before_id=before_id, after_id=after_id, page_size=page_size
+        )
+    except (TypeError, ValueError) as e:
+        return JsonResponse({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = MessageSerializer(instance=messages, many=True)
+    return JsonResponse(
+        {
+            "messages": serializer.data,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+        }
+    )
+
+
+@async_api_view(["POST"])
+async def get_public(request):
+    try:
+        user = await aget_object_or_404(
+            AppUser, username=request.data.get("get_username")
+        )
+    except Http404 as e:
+        return JsonResponse({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    return JsonResponse({"public_key": str(user.public_key)})
+
+
+@async_api_view(["POST"])
+async def get_user_SK(request):
+    user_id = request.user.id
+    try:
+        user_2 = await aget_object_or_404(
+            AppUser, username=request.data.get("friend_username")
+        )
+    except Http404:
+        return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+
+    friend_object = await Friendship.objects.filter(
+        Q(from_user_id=user_2.id, to_user_id=user_id)
+        | Q(from_user_id=user_id, to_user_id=user_2.id)
+    ).afirst()
+    if not friend_object:
+        return HttpResponse(status=status.HTTP_400_BAD_REQUEST)
+
+    # the key stored for our side of the friendship
+    if friend_object.from_user_id == user_id:
+        sk = friend_object.from_user_SK
+    else:
+        sk = friend_object.to_user_SK
+    return JsonResponse({"sk": sk})
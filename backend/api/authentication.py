@@ -0,0 +1,74 @@
+from api.cache import TTLCache
+from django.conf import settings
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+# token key -> (user, token), shared by the websocket middleware and the REST views
+# entries are dropped when the token is deleted/rotated or the user is saved (see api/signals.py),
+# the ttl bounds how long another worker can keep using a token that was deleted elsewhere
+token_cache = TTLCache(
+    "tokens", maxsize=settings.TOKEN_CACHE_SIZE, ttl=settings.TOKEN_CACHE_TTL
+)
+
+
+def get_cached_token(key):
+    # returns (user, token) from the cache or None
+    return token_cache.get(key)
+
+
+def invalidate_token(key):
+    token_cache.delete(key)
+
+
+def invalidate_user_tokens(user_id):
+    token_cache.delete_matching(lambda key, value: value[0].id == user_id)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that only goes to the db when the token is not in token_cache
+    """
+
+    def authenticate_credentials(self, key):
+        cached = get_cached_token(key)
+        if cached is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, (user, token))
+            return user, token
+
+        user, token = cached
+        # same check TokenAuthentication does after its lookup
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+        return user, token
+
+
+async def aauthenticate(request):
+    """
+    CachedTokenAuthentication for the plain django async views (api/async_views.py)
+    returns the user, None when the request has no token and raises AuthenticationFailed for a bad one
+    """
+    from rest_framework.authtoken.models import Token
+
+    auth = request.headers.get("Authorization", "").split()
+    if not auth or auth[0].lower() != "token":
+        return None
+    if len(auth) != 2:
+        raise exceptions.AuthenticationFailed(_("Invalid token header."))
+
+    key = auth[1]
+    cached = get_cached_token(key)
+    if cached is None:
+        try:
+            token = await Token.objects.select_related("user").aget(key=key)
+        except Token.DoesNotExist:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+        cached = (token.user, token)
+        if token.user.is_active:
+            token_cache.set(key, cached)
+
+    user, _token = cached
+    if not user.is_active:
+        raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+    return user
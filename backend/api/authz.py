@@ -0,0 +1,65 @@
+from api.cache import TTLCache
+from api.lookups import get_room_info, room_cache
+from django.conf import settings
+
+# who may use a chatroom: its 2 members, and only while they are friends
+# friendship adjacency (user id -> ids of accepted friends) and room membership (api/lookups.py)
+# are cached per process and loaded lazily, the Friendship / ChatRoom post_save and post_delete
+# handlers in api/signals.py drop the entries of the users involved. other workers pick up
+# a change after at most AUTHZ_CACHE_TTL seconds
+
+friends_cache = TTLCache(
+    "friends", maxsize=settings.AUTHZ_CACHE_SIZE, ttl=settings.AUTHZ_CACHE_TTL
+)
+
+
+def get_friend_ids(user_id):
+    from api.models import Friendship
+    from django.db.models import Q
+
+    friend_ids = friends_cache.get(user_id)
+    if friend_ids is None:
+        friend_ids = frozenset(
+            to_user_id if from_user_id == user_id else from_user_id
+            for from_user_id, to_user_id in Friendship.objects.filter(
+                Q(from_user_id=user_id) | Q(to_user_id=user_id), status="accepted"
+            ).values_list("from_user_id", "to_user_id")
+        )
+        friends_cache.set(user_id, friend_ids)
+    return friend_ids
+
+
+def _room_access(room, user_id, friend_ids):
+    if room is None or user_id not in (room["user1_id"], room["user2_id"]):
+        return False
+    if not settings.CHAT_REQUIRE_FRIENDSHIP:
+        return True
+    other_id = room["user2_id"] if room["user1_id"] == user_id else room["user1_id"]
+    return other_id in friend_ids
+
+
+def can_use_room(room_id, user_id):
+    # loads whatever is not cached, at most 2 queries
+    room = get_room_info(room_id)
+    if room is None:
+        return False
+    return _room_access(room, user_id, get_friend_ids(user_id))
+
+
+def cached_room_access(room_id, user_id):
+    """
+    Same answer as can_use_room from the caches only, None when something has to be loaded
+    safe to call from async code, it never touches the db
+    """
+    room = room_cache.get(room_id)
+    if room is None:
+        return None
+    friend_ids = friends_cache.get(user_id)
+    if friend_ids is None:
+        return None
+    return _room_access(room, user_id, friend_ids)
+
+
+def invalidate_friends(*user_ids):
+    for user_id in user_ids:
+        friends_cache.delete(user_id)
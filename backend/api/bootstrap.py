@@ -0,0 +1,111 @@
+from api.last_seen import get_last_seen_writer
+from api.public_keys import key_entry, set_cached_public_key
+from api.sync import settled_message_id
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import Q
+from django.utils import timezone
+
+# everything a client needs after login in one response (bootstrap view)
+# instead of get_friends + get_pending_friends + get_chatrooms, then get_public / get_user_SK for
+# every friend and get_users_last_online for every room. always 4 queries: the friendships and
+# the rooms (both with their users, which also carry the public keys), the inbox entries and
+# the sync watermark
+
+
+def session_bootstrap(user):
+    """
+    Returns a dict with
+    - friends: accepted friendships, pending_friends: friend requests sent to the user
+    - chatrooms, inbox: the user's rooms and their InboxEntry (room attached, most recent first)
+    - public_keys: username -> {"public_key", "version"} of everyone in friends / pending / rooms
+    - session_keys: friend username -> the user's wrapped key of that friendship (set_SK)
+    - last_online: room id -> last time the other member was seen in the room
+    - last_message_id: since_message_id for sync / resume, held back like sync's next_message_id
+      (see settled_message_id)
+    """
+    from api.models import ChatRoom, Friendship, InboxEntry
+
+    server_time = timezone.now()
+
+    friendships = list(
+        Friendship.objects.filter(
+            Q(from_user=user, status="accepted")
+            | Q(to_user=user, status__in=["accepted", "pending"])
+        )
+        .select_related("from_user", "to_user")
+        .order_by("id")
+    )
+    chatrooms = list(
+        ChatRoom.objects.filter(Q(user1=user) | Q(user2=user))
+        .select_related("user1", "user2")
+        .order_by("id")
+    )
+    inbox = list(InboxEntry.objects.filter(user=user))
+
+    friends = []
+    pending_friends = []
+    session_keys = {}
+    users = {}
+    for friendship in friendships:
+        users[friendship.from_user_id] = friendship.from_user
+        users[friendship.to_user_id] = friendship.to_user
+        if friendship.status == "pending":
+            pending_friends.append(friendship)
+            continue
+
+        friends.append(friendship)
+        # our side of the friendship, like get_user_SK
+        if friendship.from_user_id == user.id:
+            session_keys[friendship.to_user.username] = friendship.from_user_SK
+        else:
+            session_keys[friendship.from_user.username] = friendship.to_user_SK
+
+    last_seen = get_last_seen_writer()
+    last_online = {}
+    for chatroom in chatrooms:
+        users[chatroom.user1_id] = chatroom.user1
+        users[chatroom.user2_id] = chatroom.user2
+        # times not flushed to the db yet are only in the last seen service, like get_users_last_online
+        if chatroom.user1_id == user.id:
+            last_online[chatroom.id] = (
+                last_seen.get(chatroom.id, chatroom.user2_id) or chatroom.user2_last_online
+            )
+        else:
+            last_online[chatroom.id] = (
+                last_seen.get(chatroom.id, chatroom.user1_id) or chatroom.user1_last_online
+            )
+
+    users.pop(user.id, None)
+    public_keys = {}
+    for other in users.values():
+        public_keys[other.username] = key_entry(other.public_key)
+        # the keys were read anyway, later get_public_keys calls dont need the db. not when they
+        # came from a replica (REPLICA_READ_VIEWS), it can be behind a key change
+        if other._state.db == DEFAULT_DB_ALIAS:
+            set_cached_public_key(other.username, other.public_key)
+
+    # the serializer reads the room of every entry, attach the ones we already have
+    chatrooms_by_id = {chatroom.id: chatroom for chatroom in chatrooms}
+    inbox = [entry for entry in inbox if entry.chat_room_id in chatrooms_by_id]
+    for entry in inbox:
+        entry.chat_room = chatrooms_by_id[entry.chat_room_id]
+    inbox.sort(
+        key=lambda entry: (
+            entry.last_message_time is not None,
+            entry.last_message_time or server_time,
+            entry.chat_room_id,
+        ),
+        reverse=True,
+    )
+
+    return {
+        "friends": friends,
+        "pending_friends": pending_friends,
+        "chatrooms": chatrooms,
+        "inbox": inbox,
+        "public_keys": public_keys,
+        "session_keys": session_keys,
+        "last_online": last_online,
+        "last_message_id": settled_message_id(list(chatrooms_by_id), server_time),
+        "server_time": server_time,
+    }
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+# small in-process caches used to keep repeated lookups (tokens, users, rooms..) off the db
+# every cache registers itself by name so its hit/miss counters show up in the cache_stats view
+
+_registry = {}
+
+_missing = object()
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache where every entry also expires ttl seconds after it was set
+    """
+
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._data = OrderedDict()  # key -> (expires at, value), least recently used first
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        _registry[name] = self
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is _missing or entry[0] <= now:
+                if entry is not _missing:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        # removes every entry where predicate(key, value) is true
+        with self._lock:
+            for key in [
+                key for key, (_, value) in self._data.items() if predicate(key, value)
+            ]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def all_cache_stats():
+    return {name: cache.stats() for name, cache in _registry.items()}
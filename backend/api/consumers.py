@@ -1,14 +1,21 @@
 import asyncio
+import base64
 import json
+import os
 import time
-from datetime import datetime
-from urllib.parse import unquote
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, unquote
 
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.utils import timezone
 
+from .protocol import MSGPACK_SUBPROTOCOL, decode_msgpack, encode, wants_msgpack
+from .typing_indicators import TypingState
+
 # pretty much like views but for sockets
 
 
@@ -16,108 +23,403 @@ from django.utils import timezone
 
 TODO:
 - if user already has a chatting session, it will not create a new one, check if they are in connected users
-- check if users are firends, before chatting
 
 
 """
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class RoomSubscription:
+    # per room state of a connection
+    def __init__(self, room_id, typing_state):
+        self.room_id = room_id
+        self.group_name = f"chat_{room_id}"
+        self.typing_state = typing_state
+        # set in join_room right before the group is joined, live events can only be for messages after it
+        self.joined_at = None
+        # delivery ids of replayed messages that can still arrive as live events (see replay_messages)
+        self.replayed_ids = set()
+
+
+def get_last_message_id(value):
+    # None when the client did not send one (or sent garbage), it then gets no replay
+    try:
+        return int(value) if value not in (None, "") else None
+    except (TypeError, ValueError):
+        return None
+
+
+def replay_frame(message):
+    # a stored message in the same format as the live new_message / new_upload frames
+    if message.isFile:
+        frame = {
+            "message_type": "new_upload",
+            "file_name": message.fileName,
+            "encrypted_file_path": str(message.fileData),
+            "file_signature": message.signature,
+            "file_iv": message.iv,
+        }
+    else:
+        frame = {
+            "message_type": "new_message",
+            "encrypted_message": message.content,
+            "message_signature": message.signature,
+            "iv": message.iv,
+        }
+    # replayed messages can be our own (sent from another device)
+    frame["senderUsername"] = message.senderUsername
+    frame["message_id"] = message.id
+    frame["replayed"] = True
+    return frame
 
-    connected_users = (
-        set()
-    )  # Class variable to store connected users sets cannot contain the same value
+
+class ChatConsumer(AsyncWebsocketConsumer):
+    """
+    One websocket per room: ws/chat/<room id>/
+    the room handling itself works on self.rooms (room id -> RoomSubscription), so
+    MultiplexChatConsumer can reuse it for many rooms over one connection
+    """
+
+    heartbeat_task = None
+    pin_task = None
+    # time.monotonic() until which the sender doesnt have to be pinned to the primary again
+    pinned_until = 0
+    use_msgpack = False
+    rooms = {}
+    # multiplexed connections tag every room frame with its room_id
+    tag_frames = False
 
     async def connect(self):
+        self.rooms = {}
+
         if self.scope["user"].is_authenticated:
             print("user:", self.scope["user"].username, "has joined")
             pass
         else:
             await self.close()
+            return
 
-        # adds users ID to the connected user set
-        self.connected_users.add(self.scope["user"].id)
+        room_id = self.scope["url_route"]["kwargs"]["roomNum"]
 
-        self.room_group_name = f"chat_{self.scope['url_route']['kwargs']['roomNum']}"  # creates varible for that object (user) that connected that stores the room group name
+        # only the 2 members of the room, while they are friends (api/authz.py)
+        if not await self.has_room_access(room_id):
+            await self.close()
+            return
 
         # another varible the stores the room number from ws../chat/<num>
-        self.room_number = self.scope["url_route"]["kwargs"]["roomNum"]
+        self.room_number = room_id
+        self.room_group_name = f"chat_{room_id}"  # creates varible for that object (user) that connected that stores the room group name
+
+        # msgpack clients get binary frames, everyone else json (api/protocol.py)
+        self.use_msgpack = wants_msgpack(self.scope)
+
+        await self.join_room(room_id)
+
+        if MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            await self.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+        else:
+            await self.accept()
+
+        # reconnecting clients send the id of the newest message they have and get what they missed
+        query = parse_qs(self.scope.get("query_string", b"").decode("utf8"))
+        last_message_id = get_last_message_id(query.get("last_message_id", [None])[0])
+        if last_message_id is not None:
+            await self.replay_messages(room_id, last_message_id)
+
+    async def join_room(self, room_id):
+        from api.presence import get_presence
+
+        self.rooms[room_id] = RoomSubscription(
+            room_id,
+            TypingState(
+                lambda is_typing: self.forward_typing_state(room_id, is_typing),
+                min_interval=settings.TYPING_MIN_INTERVAL,
+                timeout=settings.TYPING_TIMEOUT,
+            ),
+        )
+
+        # registers this connection as online in the room (shared between workers when using redis presence)
+        presence = get_presence()
+        await presence.join(room_id, self.scope["user"].id, self.channel_name)
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.presence_heartbeat())
 
         # creates a specific group with the group_name such as chat_5 etc, so only the users in chat_5 can talk in that group
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        group_name = self.rooms[room_id].group_name
+        self.rooms[room_id].joined_at = timezone.now()
+        await self.channel_layer.group_add(group_name, self.channel_name)
 
         await self.channel_layer.group_send(
-            self.room_group_name,  # send to only this group
+            group_name,  # send to only this group
             {
                 "type": "user_connected",
                 "message_type": "user_joined",
+                "room_id": room_id,
                 "joined_user_id": self.scope["user"].id,
                 "connected_username": self.scope["user"].username,
-                # Send the list of connected users
-                "connected_users": list(self.connected_users),
+                # Send the list of users connected to this room
+                "connected_users": await presence.room_members(room_id),
             },
         )
 
-        await self.updateLastTimeOnline()
-        await self.accept()
+        await self.updateLastTimeOnline(room_id)
+
+    async def leave_room(self, room_id):
+        from api.presence import get_presence
+
+        room = self.rooms.pop(room_id, None)
+        if room is None:
+            return
+
+        # tells the room we stopped typing, if we were
+        await room.typing_state.close()
+
+        # only marks the user offline in this room once their last connection to it is gone
+        presence = get_presence()
+        await presence.leave(room_id, self.scope["user"].id, self.channel_name)
+
+        await self.channel_layer.group_send(
+            room.group_name,
+            {
+                "type": "leave_chatroom",
+                "message_type": "user_disconnected",
+                "room_id": room_id,
+                "disconnected_user_id": self.scope["user"].id,
+                "disconnected_username": self.scope["user"].username,
+                "connected_users": await presence.room_members(room_id),
+            },
+        )
+        await self.channel_layer.group_discard(room.group_name, self.channel_name)
+        await self.updateLastTimeOnline(room_id)
 
     @database_sync_to_async
-    def saveMessageToDB(self, message, message_signature, message_iv):
-        from api.models import AppUser, ChatRoom, Message
+    def get_messages_after(self, room_id, message_id, limit):
+        from api.models import Message
+
+        # range scan on the (chat_room, id) index
+        return list(
+            Message.objects.filter(chat_room_id=room_id, id__gt=message_id).order_by("id")[
+                :limit
+            ]
+        )
 
-        chat_room = ChatRoom.objects.get(id=self.room_number)
+    async def replay_messages(self, room_id, last_message_id):
+        """
+        Sends the messages of the room after last_message_id, oldest first, in batches of
+        CHAT_REPLAY_BATCH_SIZE, then a replay_complete frame. Live events are only handled
+        once this returns (a consumer handles one event at a time), live messages that were
+        also replayed are dropped in chat_message / new_upload
+        """
+        from api.persistence import get_message_writer
+
+        room = self.rooms[room_id]
+        # messages are queued before they are broadcast, anything this process broadcast before we joined gets written now
+        try:
+            await get_message_writer().flush()
+        except Exception as e:
+            # the failed batch stays queued for the next flush, what is committed is still replayed
+            print("flush before replay failed:", e)
 
-        # create message object
-        Message = Message.objects.create(
-            chat_room=chat_room,
-            sender=AppUser.objects.get(id=self.scope["user"].id),
-            content=message,
-            senderUsername=self.scope["user"].username,
-            signature=message_signature,
-            iv=message_iv,
+        # only messages written around the time we joined can still be waiting for us as live events
+        dedupe_after = room.joined_at - timedelta(
+            seconds=settings.CHAT_REPLAY_DEDUPE_WINDOW
+        )
+        batch_size = settings.CHAT_REPLAY_BATCH_SIZE
+        max_messages = settings.CHAT_REPLAY_MAX_MESSAGES
+
+        cursor = last_message_id
+        replayed = 0
+        final_pass = False
+        while True:
+            limit = min(batch_size, max_messages - replayed)
+            if limit <= 0:
+                break
+            batch = await self.get_messages_after(room_id, cursor, limit)
+
+            for message in batch:
+                if message.timestamp >= dedupe_after and message.delivery_id:
+                    room.replayed_ids.add(str(message.delivery_id))
+                await self.send_room_message(room_id, replay_frame(message))
+            if batch:
+                cursor = batch[-1].id
+                replayed += len(batch)
+
+            if len(batch) < limit:
+                if final_pass:
+                    break
+                # other workers write what they broadcast within MESSAGE_WRITER_FLUSH_INTERVAL,
+                # one more pass after that so nothing sent before we joined the group is missed
+                final_pass = True
+                waited = (timezone.now() - room.joined_at).total_seconds()
+                if waited < settings.MESSAGE_WRITER_FLUSH_INTERVAL:
+                    await asyncio.sleep(settings.MESSAGE_WRITER_FLUSH_INTERVAL - waited)
+
+        # more than CHAT_REPLAY_MAX_MESSAGES missed, the client loads the rest with get_messages_from_db
+        has_more = replayed >= max_messages and bool(
+            await self.get_messages_after(room_id, cursor, 1)
+        )
+        await self.send_room_message(
+            room_id,
+            {
+                "message_type": "replay_complete",
+                "last_message_id": cursor,
+                "has_more": has_more,
+            },
         )
 
-        chat_room.numOfMessages += 1
-        chat_room.save()
+    def is_replayed(self, room_id, delivery_id):
+        # a live event for a message the client already got from replay_messages
+        replayed_ids = self.rooms[room_id].replayed_ids
+        if delivery_id in replayed_ids:
+            replayed_ids.discard(delivery_id)
+            return True
+        return False
+
+    async def has_room_access(self, room_id):
+        from api.authz import cached_room_access, can_use_room
+
+        # answered from memory for every message, the db is only asked after a cache entry expired or was invalidated
+        allowed = cached_room_access(room_id, self.scope["user"].id)
+        if allowed is None:
+            allowed = await database_sync_to_async(can_use_room)(
+                room_id, self.scope["user"].id
+            )
+        return allowed
+
+    async def send_message(self, payload):
+        await self.send(**encode(payload, self.use_msgpack))
+
+    async def send_room_message(self, room_id, payload):
+        if self.tag_frames:
+            payload = {"room_id": room_id, **payload}
+        await self.send_message(payload)
+
+    def event_room(self, data):
+        # the subscription a group event is for, None when we left the room meanwhile
+        room_id = data.get("room_id")
+        if room_id is None and len(self.rooms) == 1:
+            # event from a worker that doesnt send the room id yet
+            return next(iter(self.rooms))
+        return room_id if room_id in self.rooms else None
+
+    async def forward_typing_state(self, room_id, is_typing):
+        if is_typing:
+            await self.channel_layer.group_send(
+                f"chat_{room_id}",
+                {
+                    "type": "user_typing_message",
+                    "message_type": "user_typing",
+                    "room_id": room_id,
+                    "sender_id": self.scope[
+                        "user"
+                    ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
+                },
+            )
+        else:
+            await self.channel_layer.group_send(
+                f"chat_{room_id}",
+                {
+                    "type": "user_stopped_typing_message",
+                    "message_type": "user_stopped_typing",
+                    "room_id": room_id,
+                    "sender_id": self.scope[
+                        "user"
+                    ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
+                },
+            )
 
-    @database_sync_to_async
-    def updateLastTimeOnline(self):
-        from api.models import AppUser, ChatRoom
+    async def presence_heartbeat(self):
+        from api.presence import get_presence
+
+        # keeps the rooms of this connection from expiring in the presence registry
+        presence = get_presence()
+        while True:
+            await asyncio.sleep(presence.ttl / 3)
+            for room_id in list(self.rooms):
+                try:
+                    await presence.heartbeat(
+                        room_id, self.scope["user"].id, self.channel_name
+                    )
+                except Exception as e:
+                    print("presence heartbeat failed:", e)
+
+    def pin_to_primary(self):
+        from api.routers import apin_to_primary
+
+        # the sender reads from the primary for a while after writing (api/routers.py). the pin
+        # lasts 1.5 sticky intervals and is renewed at most every half interval, so every write
+        # stays covered for REPLICA_STICKY_SECONDS with one cache write per connection and interval
+        if not settings.DATABASE_REPLICAS:
+            return
+        now = time.monotonic()
+        if now < self.pinned_until:
+            return
+        self.pinned_until = now + settings.REPLICA_STICKY_SECONDS / 2
+
+        async def pin():
+            try:
+                await apin_to_primary(
+                    self.scope["user"].id, settings.REPLICA_STICKY_SECONDS * 3 / 2
+                )
+            except Exception as e:
+                # tried again with the next message
+                self.pinned_until = 0
+                print("pinning to the primary failed:", e)
 
-        chatroom_object = ChatRoom.objects.get(id=self.room_number)
-        current_user = AppUser.objects.get(id=self.scope["user"].id)
+        # not awaited, the message doesnt wait for the cache
+        self.pin_task = asyncio.create_task(pin())
 
-        current_time = datetime.now()
-        formatted_datetime = current_time.strftime("%Y-%m-%d %H:%M:%S.%f")
+    async def saveMessageToDB(
+        self, room_id, message, message_signature, message_iv, delivery_id=None
+    ):
+        from api.persistence import get_message_writer
+
+        self.pin_to_primary()
+
+        # queued and written in a batch by the message writer, see api/persistence.py
+        get_message_writer().add(
+            {
+                "room_id": room_id,
+                "sender_id": self.scope["user"].id,
+                "sender_username": self.scope["user"].username,
+                "content": message,
+                "signature": message_signature,
+                "iv": message_iv,
+                "delivery_id": delivery_id,
+            }
+        )
 
-        if chatroom_object.user1 == current_user:
-            chatroom_object.user1_last_online = formatted_datetime
-        elif chatroom_object.user2 == current_user:
-            chatroom_object.user2_last_online = formatted_datetime
+    async def updateLastTimeOnline(self, room_id):
+        from api.last_seen import get_last_seen_writer
 
-        chatroom_object.save()
+        # recorded in memory and written in batches, see api/last_seen.py
+        get_last_seen_writer().touch(room_id, self.scope["user"].id)
 
     @database_sync_to_async
     def get_username(self, user_id):
-        from api.models import AppUser, ChatRoom, Message
+        from api.lookups import get_user_info
 
-        return AppUser.objects.get(id=user_id).username
+        return get_user_info(user_id)["username"]
 
     @database_sync_to_async
-    def upload_file(self, data):
+    def upload_file(self, room_id, data):
         import os
 
-        from api.models import AppUser, ChatRoom, Message
-        from api.serializers import MessageSerializer
+        from api.dbwriter import run_write
+        from api.inbox import save_message
+        from api.lookups import get_room_info
+        from api.models import Message
         from django.core.files.base import ContentFile
 
-        current_user = AppUser.objects.get(id=self.scope["user"].id)
-        chatroom_object = ChatRoom.objects.get(id=self.room_number)
+        # the user comes from the scope and the room from the room cache, no lookups needed before the insert
+        if get_room_info(room_id) is None:
+            return False, {}
 
         file_to_upload = data.get("file")  # base64 of file
+        if file_to_upload is None:
+            return False, {}
 
         # hides file name but keeps extension
-        _, file_extension = os.path.splitext(data.get("fileName"))
+        _, file_extension = os.path.splitext(data.get("fileName") or "")
         newfile_name = f"file{file_extension}"
 
         file_to_upload = ContentFile(file_to_upload, name=newfile_name)
@@ -125,122 +427,309 @@ class ChatConsumer(AsyncWebsocketConsumer):
         signature_data = data.get("signature")
         iv_data = data.get("iv")
 
-        to_save = {
-            "chat_room": chatroom_object.id,
-            "sender": current_user.id,
-            "senderUsername": current_user.username,
-            "fileData": file_to_upload,
-            "isFile": True,
+        instance = Message(
+            chat_room_id=room_id,
+            sender_id=self.scope["user"].id,
+            senderUsername=self.scope["user"].username,
+            isFile=True,
+            signature=signature_data,
+            iv=iv_data,
+            delivery_id=uuid.uuid4(),
+        )
+        instance.fileData.save(newfile_name, file_to_upload, save=False)
+        instance.fileName = str(os.path.basename(str(instance.fileData)))
+        run_write(save_message, instance)
+
+        # we cannot directly send the file data through websocket (inefficent, so what we will do is upload and save it, then send the url path to the clients, then they can use that to download the file)
+        return True, {
+            "filePath": str(instance.fileData),
+            "fileName": instance.fileName,
             "signature": signature_data,
             "iv": iv_data,
+            "delivery_id": str(instance.delivery_id),
         }
-        seralizer = MessageSerializer(data=to_save)
-        if seralizer.is_valid():
-            instance = seralizer.save()
-            instance.fileName = str(os.path.basename(str(instance.fileData)))
-            instance.save()
-            # we cannot directly send the file data through websocket (inefficent, so what we will do is upload and save it, then send the url path to the clients, then they can use that to download the file)
 
-            to_save["filePath"] = str(instance.fileData)
-            # gets the updated filename after we make the file, as if 2 files have the same name django will add extra characters to make it unique
-            to_save["fileName"] = instance.fileName
+    @database_sync_to_async
+    def store_chunked_upload(self, upload):
+        from api.dbwriter import run_write
+        from api.inbox import save_message
+        from api.models import Message
+        from api.uploads import PartFile, discard_upload
+
+        message = Message(
+            chat_room_id=upload["room_id"],
+            sender_id=self.scope["user"].id,
+            senderUsername=self.scope["user"].username,
+            isFile=True,
+            signature=upload["signature"],
+            iv=upload["iv"],
+            delivery_id=uuid.uuid4(),
+        )
+        # the .part file is moved into MEDIA_ROOT, not read back into memory
+        with open(upload["part_path"], "rb") as part_file:
+            message.fileData.save(
+                f"file{upload['file_extension']}", PartFile(part_file), save=False
+            )
+        message.fileName = str(os.path.basename(str(message.fileData)))
+        run_write(save_message, message)
+        discard_upload(upload["upload_id"])
+
+        return {
+            "filePath": str(message.fileData),
+            "fileName": message.fileName,
+            "signature": message.signature,
+            "iv": message.iv,
+            "delivery_id": str(message.delivery_id),
+        }
+
+    async def send_upload_error(self, upload_id, error, room_id=None):
+        payload = {
+            "message_type": "upload_error",
+            "upload_id": upload_id,
+            "error": str(error),
+            "offset": error.offset,
+        }
+        if room_id is None:
+            await self.send_message(payload)
+        else:
+            await self.send_room_message(room_id, payload)
+
+    async def handle_upload_begin(self, room_id, data):
+        from api.uploads import UploadError, begin_upload
+
+        try:
+            upload_id, offset = await sync_to_async(begin_upload)(
+                self.scope["user"].id, room_id, data
+            )
+        except (UploadError, ValueError, TypeError) as e:
+            await self.send_upload_error(
+                data.get("upload_id"), UploadError(str(e)), room_id
+            )
+            return
+
+        # tells the client where to (re)start sending chunks from
+        await self.send_room_message(
+            room_id,
+            {"message_type": "upload_ready", "upload_id": upload_id, "offset": offset},
+        )
+
+    def can_upload_to(self, room_id):
+        from api.authz import cached_room_access, can_use_room
+
+        # runs in the upload thread, a chunk's room is only known once its upload is loaded
+        if room_id not in self.rooms:
+            return False
+        allowed = cached_room_access(room_id, self.scope["user"].id)
+        if allowed is None:
+            allowed = can_use_room(room_id, self.scope["user"].id)
+        return allowed
+
+    async def handle_upload_chunk(self, upload_id, offset, chunk):
+        from api.uploads import UploadError, append_chunk
 
-            # we dont need to send the full file data through the websocket
-            to_save.pop("fileData")
+        # chunks are matched to their upload (and room) by upload id, the room is checked like any room frame
+        try:
+            offset = await database_sync_to_async(append_chunk)(
+                self.scope["user"].id, upload_id, offset, chunk, self.can_upload_to
+            )
+        except (UploadError, ValueError, TypeError) as e:
+            if not isinstance(e, UploadError):
+                e = UploadError(str(e))
+            await self.send_upload_error(upload_id, e)
+            return
+
+        await self.send_message(
+            {"message_type": "upload_progress", "upload_id": upload_id, "offset": offset}
+        )
 
-            return True, to_save
+    async def handle_upload_end(self, room_id, data):
+        from api.uploads import UploadError, finish_upload
 
-        return False, {}
+        try:
+            upload = await sync_to_async(finish_upload)(
+                self.scope["user"].id, data.get("upload_id")
+            )
+            if upload["room_id"] != room_id:
+                raise UploadError("Upload belongs to another chatroom")
+        except UploadError as e:
+            await self.send_upload_error(data.get("upload_id"), e, room_id)
+            return
 
-    async def receive(self, text_data):
+        uploaded = await self.store_chunked_upload(upload)
+        await self.send_room_message(
+            room_id,
+            {
+                "message_type": "upload_complete",
+                "upload_id": upload["upload_id"],
+                "encrypted_file_path": uploaded["filePath"],
+            },
+        )
+        # only the stored path goes to the room, never the file itself
+        await self.broadcast_upload(room_id, uploaded)
+
+    async def broadcast_upload(self, room_id, data):
+        self.pin_to_primary()
+        await self.channel_layer.group_send(
+            f"chat_{room_id}",
+            {
+                "type": "new_upload",
+                "message_type": "new_upload",
+                "room_id": room_id,
+                "encrypted_file_path": data["filePath"],
+                "file_signature": data["signature"],
+                "file_name": data["fileName"],
+                "iv": data["iv"],
+                "delivery_id": data["delivery_id"],
+                "sender_id": self.scope[
+                    "user"
+                ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
+                # sent along so the receivers dont have to look the username up
+                "sender_username": self.scope["user"].username,
+            },
+        )
+
+    def parse_frame(self, text_data, bytes_data):
         # takes regualr string dict and turns it into json | Must send DICT OR JSON message format | JSON-formatted string into a Python object
+        if bytes_data is not None:
+            return decode_msgpack(bytes_data)
+        return json.loads(text_data)
+
+    async def receive_chunk_frame(self, bytes_data):
+        from api.uploads import UploadError, parse_chunk_frame
+
+        # binary frames from json clients are upload chunks, see api/uploads.py for the frame layout
+        try:
+            header, chunk = parse_chunk_frame(bytes_data)
+        except UploadError as e:
+            await self.send_upload_error(None, e)
+            return
+        await self.handle_upload_chunk(header.get("upload_id"), header.get("offset"), chunk)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # unfriended / removed while connected
+        if not await self.has_room_access(self.room_number):
+            await self.close(code=4003)
+            return
+
+        if bytes_data is not None and not self.use_msgpack:
+            await self.receive_chunk_frame(bytes_data)
+            return
+
         try:
-            text_data_json = json.loads(text_data)
+            text_data_json = self.parse_frame(text_data, bytes_data)
         except Exception as e:
             print(e)
             await self.disconnect(close_code=1011)
             return
-        if text_data_json["message_type"] == "user_typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "user_typing_message",
-                    "message_type": "user_typing",
-                    "sender_id": self.scope[
-                        "user"
-                    ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
-                },
+        if not isinstance(text_data_json, dict):
+            await self.send_message({"message_type": "error", "error": "Invalid frame"})
+            return
+        await self.handle_room_frame(self.room_number, text_data_json)
+
+    async def handle_room_frame(self, room_id, text_data_json):
+        from api.uploads import UploadError
+
+        room = self.rooms[room_id]
+        message_type = text_data_json.get("message_type")
+        if not isinstance(message_type, str):
+            # answered for this room only, a multiplexed connection keeps its other rooms
+            await self.send_room_message(
+                room_id, {"message_type": "error", "error": "Missing or invalid message_type"}
             )
-        elif text_data_json["message_type"] == "user_stopped_typing":
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "user_stopped_typing_message",
-                    "message_type": "user_stopped_typing",
-                    "sender_id": self.scope[
-                        "user"
-                    ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
-                },
+            return
+
+        if message_type == "user_typing":
+            # only typing state changes reach the room, see api/typing_indicators.py
+            await room.typing_state.typing()
+        elif message_type == "user_stopped_typing":
+            await room.typing_state.stopped()
+        elif message_type == "new_message":
+            missing = [
+                key
+                for key in ("encrypted_message", "message_signature", "iv")
+                if key not in text_data_json
+            ]
+            if missing:
+                await self.send_room_message(
+                    room_id,
+                    {"message_type": "error", "error": f"Missing {', '.join(missing)}"},
+                )
+                return
+
+            # queued before it is broadcast, so a reconnecting client that flushes the writer
+            # before replaying (see replay_messages) cant miss it
+            delivery_id = str(uuid.uuid4())
+            await self.saveMessageToDB(
+                room_id,
+                text_data_json["encrypted_message"],
+                text_data_json["message_signature"],
+                text_data_json["iv"],
+                delivery_id,
             )
-        elif text_data_json["message_type"] == "new_message":
+
             await self.channel_layer.group_send(
-                self.room_group_name,
+                room.group_name,
                 {
                     "type": "chat_message",
                     "message_type": "new_message",
+                    "room_id": room_id,
                     "encrypted_message": text_data_json["encrypted_message"],
                     "message_signature": text_data_json["message_signature"],
                     "iv": text_data_json["iv"],
+                    "delivery_id": delivery_id,
                     "sender_id": self.scope[
                         "user"
                     ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
                 },
             )
-
-            await self.saveMessageToDB(
-                text_data_json["encrypted_message"],
-                text_data_json["message_signature"],
-                text_data_json["iv"],
-            )
-        elif text_data_json["message_type"] == "new_upload":
-            successful_upload, data = await self.upload_file(text_data_json)
+        elif message_type == "new_upload":
+            # whole file in one frame, kept for older clients (new clients use upload_begin/chunk/end)
+            successful_upload, data = await self.upload_file(room_id, text_data_json)
             if successful_upload:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "new_upload",
-                        "message_type": "new_upload",
-                        "encrypted_file_path": data["filePath"],
-                        "file_signature": data["signature"],
-                        "file_name": data["fileName"],
-                        "iv": data["iv"],
-                        "sender_id": self.scope[
-                            "user"
-                        ].id,  # this refers to the ID fo the user who is sending the message | in the chat_message func, it would refer to the ID of the user who is recieveing the message
-                    },
+                await self.broadcast_upload(room_id, data)
+        elif message_type == "upload_begin":
+            await self.handle_upload_begin(room_id, text_data_json)
+        elif message_type == "upload_chunk":
+            # text version of a chunk frame for clients that cant send binary frames
+            # (msgpack clients send the chunk as raw bytes in "data")
+            try:
+                chunk = text_data_json["data"]
+                if not isinstance(chunk, bytes):
+                    chunk = base64.b64decode(chunk)
+            except (KeyError, ValueError, TypeError):
+                await self.send_upload_error(
+                    text_data_json.get("upload_id"),
+                    UploadError("Invalid chunk data"),
+                    room_id,
                 )
+                return
+            await self.handle_upload_chunk(
+                text_data_json.get("upload_id"), text_data_json.get("offset"), chunk
+            )
+        elif message_type == "upload_end":
+            await self.handle_upload_end(room_id, text_data_json)
 
     async def disconnect(self, close_code):
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
 
-        self.connected_users.remove(self.scope["user"].id)
+        if not self.rooms:
+            # connection was refused in connect() (or never subscribed to a room)
+            return
 
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                "type": "leave_chatroom",
-                "message_type": "user_disconnected",
-                "disconnected_user_id": self.scope["user"].id,
-                "disconnected_username": self.scope["user"].username,
-                "connected_users": list(self.connected_users),
-            },
-        )
-        await self.updateLastTimeOnline()
+        for room_id in list(self.rooms):
+            await self.leave_room(room_id)
 
         await self.close(close_code)
 
     # chatroom handlers:
 
     async def user_connected(self, data):
+        room_id = self.event_room(data)
+        if room_id is None:
+            return
+
         # Handle the user_connected message here
         joined_user_id = data["joined_user_id"]
         connected_username = data["connected_username"]
@@ -249,21 +738,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # don't send it to the user sending the message | removed because when user connectes and a user is already in chatroom we need to send the connected users list so it can update online/offline status
         # if self.scope["user"].id != joined_user_id: ^^
 
-        # opposite of json.loads | converts python object to json style string
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "message_type": "user_joined",
-                    "joined_user_id": joined_user_id,
-                    "connected_username": connected_username,
-                    "connected_users": connected_users,
-                }
-            )
+        # encoded as json or msgpack depending on the client, see send_message
+        await self.send_room_message(
+            room_id,
+            {
+                "message_type": "user_joined",
+                "joined_user_id": joined_user_id,
+                "connected_username": connected_username,
+                "connected_users": connected_users,
+            },
         )
         # You can add additional logic here, such as notifying other users in the group
 
     # runs for every user in the room_group_name group when we call group_send and have this as the function ^
     async def chat_message(self, data):
+        room_id = self.event_room(data)
+        if room_id is None or self.is_replayed(room_id, data.get("delivery_id")):
+            return
+
         # Handle the user_connected message here
         encrypted_message = data["encrypted_message"]
         message_signature = data["message_signature"]
@@ -273,78 +765,194 @@ class ChatConsumer(AsyncWebsocketConsumer):
         print("encrypted message", encrypted_message)
         # don't send it to the user sending the message
         if self.scope["user"].id != sender_id:
-            # opposite of json.loads | converts python object to json style string
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "message_type": "new_message",
-                        "encrypted_message": encrypted_message,
-                        "message_signature": message_signature,
-                        "iv": iv,
-                    }
-                )
+            # encoded as json or msgpack depending on the client, see send_message
+            await self.send_room_message(
+                room_id,
+                {
+                    "message_type": "new_message",
+                    "encrypted_message": encrypted_message,
+                    "message_signature": message_signature,
+                    "iv": iv,
+                },
             )
 
     async def new_upload(self, data):
+        room_id = self.event_room(data)
+        if room_id is None or self.is_replayed(room_id, data.get("delivery_id")):
+            return
+
         encrypted_file_path = data["encrypted_file_path"]
         file_name = data["file_name"]
         file_signature = data["file_signature"]
         file_iv = data["iv"]
-        senderUsername = await self.get_username(data["sender_id"])
+        senderUsername = data.get("sender_username")
+        if senderUsername is None:
+            # event from a worker that doesnt send the username yet
+            senderUsername = await self.get_username(data["sender_id"])
         # this gives the correct sender user ID ^^^^
 
-        await self.send(
-            text_data=json.dumps(
-                {
-                    "message_type": "new_upload",
-                    "file_name": file_name,
-                    "encrypted_file_path": encrypted_file_path,
-                    "file_signature": file_signature,
-                    "file_iv": file_iv,
-                    "senderUsername": senderUsername,
-                }
-            )
+        await self.send_room_message(
+            room_id,
+            {
+                "message_type": "new_upload",
+                "file_name": file_name,
+                "encrypted_file_path": encrypted_file_path,
+                "file_signature": file_signature,
+                "file_iv": file_iv,
+                "senderUsername": senderUsername,
+            },
         )
 
     async def user_typing_message(self, data):
+        room_id = self.event_room(data)
         sender_id = data["sender_id"]  # this gives the correct sender user ID ^^^^
-        if self.scope["user"].id != sender_id:
-            # opposite of json.loads | converts python object to json style string
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "message_type": "user_typing_message",
-                    }
-                )
+        if room_id is not None and self.scope["user"].id != sender_id:
+            # encoded as json or msgpack depending on the client, see send_message
+            await self.send_room_message(
+                room_id,
+                {
+                    "message_type": "user_typing_message",
+                },
             )
 
     async def user_stopped_typing_message(self, data):
+        room_id = self.event_room(data)
         sender_id = data["sender_id"]  # this gives the correct sender user ID ^^^^
-        if self.scope["user"].id != sender_id:
-            # opposite of json.loads | converts python object to json style string
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "message_type": "user_stopped_typing_message",
-                    }
-                )
+        if room_id is not None and self.scope["user"].id != sender_id:
+            # encoded as json or msgpack depending on the client, see send_message
+            await self.send_room_message(
+                room_id,
+                {
+                    "message_type": "user_stopped_typing_message",
+                },
             )
 
     async def leave_chatroom(self, data):
+        room_id = self.event_room(data)
+        if room_id is None:
+            return
+
         disconnected_user_id = data["disconnected_user_id"]
         disconnected_username = data["disconnected_username"]
         connected_users = data["connected_users"]
 
         # don't send it to the user sending the message
         if self.scope["user"].id != disconnected_user_id:
-            # opposite of json.loads | converts python object to json style string
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "message_type": "user_disconnected",
-                        "disconnected_user_id": disconnected_user_id,
-                        "disconnected_username": disconnected_username,
-                        "connected_users": connected_users,
-                    }
-                )
+            # encoded as json or msgpack depending on the client, see send_message
+            await self.send_room_message(
+                room_id,
+                {
+                    "message_type": "user_disconnected",
+                    "disconnected_user_id": disconnected_user_id,
+                    "disconnected_username": disconnected_username,
+                    "connected_users": connected_users,
+                },
+            )
+
+
+class MultiplexChatConsumer(ChatConsumer):
+    """
+    One websocket per user for all of their rooms: ws/chat/
+    the client sends {"message_type": "subscribe", "room_id": ..} / "unsubscribe", every
+    room frame in both directions carries its "room_id", otherwise the frames are the
+    same as on ws/chat/<room id>/ (upload chunk frames are matched by upload id)
+    """
+
+    tag_frames = True
+
+    async def connect(self):
+        self.rooms = {}
+
+        if not self.scope["user"].is_authenticated:
+            await self.close()
+            return
+
+        self.use_msgpack = wants_msgpack(self.scope)
+        if MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []):
+            await self.accept(subprotocol=MSGPACK_SUBPROTOCOL)
+        else:
+            await self.accept()
+
+    async def subscribe(self, room_id, last_message_id=None):
+        if room_id in self.rooms:
+            await self.send_room_message(room_id, {"message_type": "subscribed"})
+            return
+
+        if len(self.rooms) >= settings.MULTIPLEX_MAX_ROOMS:
+            error = "Too many rooms"
+        elif not await self.has_room_access(room_id):
+            error = "Access denied"
+        else:
+            # subscribed is sent before the join broadcast reaches us
+            await self.send_room_message(room_id, {"message_type": "subscribed"})
+            await self.join_room(room_id)
+            if last_message_id is not None:
+                await self.replay_messages(room_id, last_message_id)
+            return
+
+        await self.send_room_message(
+            room_id, {"message_type": "subscribe_error", "error": error}
+        )
+
+    async def unsubscribe(self, room_id, reason=None):
+        await self.leave_room(room_id)
+        payload = {"message_type": "unsubscribed"}
+        if reason:
+            payload["reason"] = reason
+        await self.send_room_message(room_id, payload)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        if bytes_data is not None and not self.use_msgpack:
+            await self.receive_chunk_frame(bytes_data)
+            return
+
+        try:
+            frame = self.parse_frame(text_data, bytes_data)
+        except Exception as e:
+            print(e)
+            await self.disconnect(close_code=1011)
+            return
+
+        # lists, numbers etc are valid json / msgpack but not frames
+        if not isinstance(frame, dict):
+            await self.send_message({"message_type": "error", "error": "Invalid frame"})
+            return
+
+        try:
+            room_ids = frame.get("room_ids")
+            if room_ids is None:
+                room_ids = [frame["room_id"]]
+            elif not isinstance(room_ids, list) or not room_ids:
+                raise ValueError("room_ids must be a non empty list")
+            room_ids = [int(room_id) for room_id in room_ids]
+        except (KeyError, TypeError, ValueError):
+            await self.send_message(
+                {"message_type": "error", "error": "Missing or invalid room_id"}
+            )
+            return
+
+        message_type = frame.get("message_type")
+        if message_type == "subscribe":
+            # message ids are global, one last_message_id works for all the rooms
+            last_message_id = get_last_message_id(frame.get("last_message_id"))
+            for room_id in room_ids:
+                await self.subscribe(room_id, last_message_id)
+            return
+        if message_type == "unsubscribe":
+            for room_id in room_ids:
+                await self.unsubscribe(room_id)
+            return
+
+        room_id = room_ids[0]
+        if room_id not in self.rooms:
+            await self.send_room_message(
+                room_id, {"message_type": "error", "error": "Not subscribed"}
             )
+            return
+
+        # unfriended / removed while connected, only this room is dropped
+        if not await self.has_room_access(room_id):
+            await self.unsubscribe(room_id, reason="Access denied")
+            return
+
+        await self.handle_room_frame(room_id, frame)
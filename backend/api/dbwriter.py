@@ -0,0 +1,125 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import connection, transaction
+
+# single writer thread for the sqlite deployment (SQLITE_PRODUCTION, see settings.py)
+# sqlite lets one connection write at a time. with every sync_to_async thread writing on its
+# own connection they queue on the file lock and fail with "database is locked" once the busy
+# timeout runs out. here the writes are handed to one thread that owns the only writing
+# connection, the jobs that are waiting together run in one transaction (one commit / fsync for
+# the whole group). reads dont go through here, with WAL they run next to the writer
+
+
+class DBWriter:
+    def __init__(self, max_batch):
+        self.max_batch = max_batch
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        # returns a Future with the result of fn, set once the transaction it ran in is committed
+        future = Future()
+        self._jobs.put((future, fn, args, kwargs))
+        self._ensure_thread()
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        if threading.current_thread() is self._thread:
+            # a job writing more, it is already inside the group transaction
+            return fn(*args, **kwargs)
+        return self.submit(fn, *args, **kwargs).result()
+
+    async def arun(self, fn, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="db-writer", daemon=True
+                )
+                self._thread.start()
+
+    def stop(self):
+        # writes what is already queued, then closes the writer thread and its connection
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and thread.is_alive():
+            self._jobs.put(None)
+            thread.join()
+
+    def _next_group(self):
+        # returns (jobs, stop), blocks until there is at least one job (or stop)
+        jobs = []
+        while len(jobs) < self.max_batch:
+            try:
+                job = self._jobs.get(block=not jobs)
+            except queue.Empty:
+                break
+            if job is None:
+                return jobs, True
+            jobs.append(job)
+        return jobs, False
+
+    def _run(self):
+        while True:
+            jobs, stop = self._next_group()
+            if jobs:
+                self._write_group(jobs)
+            if stop:
+                connection.close()
+                return
+
+    def _write_group(self, jobs):
+        results = []
+        try:
+            with transaction.atomic():
+                for future, fn, args, kwargs in jobs:
+                    # a savepoint per job, a failing job only rolls back itself
+                    try:
+                        with transaction.atomic():
+                            results.append((future, fn(*args, **kwargs), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+        except Exception as e:
+            # the commit failed, nothing of the group was written
+            results = [(future, None, e) for future, _, _, _ in jobs]
+            connection.close_if_unusable_or_obsolete()
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_db_writer = None
+_db_writer_lock = threading.Lock()
+
+
+def get_db_writer():
+    global _db_writer
+
+    if _db_writer is None:
+        with _db_writer_lock:
+            if _db_writer is None:
+                _db_writer = DBWriter(max_batch=settings.DB_WRITER_BATCH_SIZE)
+    return _db_writer
+
+
+def run_write(fn, *args, **kwargs):
+    """
+    Runs fn in a transaction and returns its result, on the writer thread when
+    DB_SINGLE_WRITER is on (blocks the calling thread until it is committed)
+    """
+    if settings.DB_SINGLE_WRITER:
+        return get_db_writer().run(fn, *args, **kwargs)
+    with transaction.atomic():
+        return fn(*args, **kwargs)
@@ -0,0 +1,106 @@
+from collections import defaultdict
+
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+# per user inbox summary (api.models.InboxEntry)
+# every code path that saves messages calls record_messages() in the same transaction,
+# which bumps the room counters and both members' inbox entries with a couple of UPDATEs
+# per room instead of clients working out last activity / unread counts from the history
+
+
+def create_inbox_entries(chatrooms):
+    # entries for both members of new rooms, safe to call for rooms that already have them
+    from api.models import InboxEntry
+
+    InboxEntry.objects.bulk_create(
+        [
+            InboxEntry(user_id=user_id, chat_room_id=chatroom.id)
+            for chatroom in chatrooms
+            for user_id in (chatroom.user1_id, chatroom.user2_id)
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def latest(field, value):
+    # the column only moves forward, batches from 2 writers can commit out of order
+    # (Coalesce as GREATEST is NULL on sqlite when one side is)
+    return Greatest(Coalesce(F(field), Value(value)), Value(value))
+
+
+def record_messages(messages):
+    """
+    Updates ChatRoom.numOfMessages / last_message_time and the InboxEntry of both members
+    for newly saved messages, call inside the transaction that saved them
+    """
+    from api.lookups import get_room_info
+    from api.models import ChatRoom, InboxEntry
+
+    rooms = defaultdict(list)
+    for message in messages:
+        rooms[message.chat_room_id].append(message)
+
+    now = timezone.now()
+    for room_id, room_messages in rooms.items():
+        last_message = max(room_messages, key=lambda message: message.id)
+
+        ChatRoom.objects.filter(id=room_id).update(
+            numOfMessages=F("numOfMessages") + len(room_messages),
+            last_message_time=latest("last_message_time", last_message.timestamp),
+            # update() skips auto_now
+            updated_at=now,
+        )
+
+        room = get_room_info(room_id)
+        if room is None:
+            continue
+
+        # a message is unread for the member that did not send it
+        unread = {
+            user_id: sum(1 for message in room_messages if message.sender_id != user_id)
+            for user_id in (room["user1_id"], room["user2_id"])
+        }
+        InboxEntry.objects.filter(chat_room_id=room_id).update(
+            last_message_id=latest("last_message_id", last_message.id),
+            last_message_time=latest("last_message_time", last_message.timestamp),
+            unread_count=F("unread_count")
+            + Case(
+                When(user_id=room["user1_id"], then=Value(unread[room["user1_id"]])),
+                default=Value(unread[room["user2_id"]]),
+            ),
+        )
+
+
+def save_message(message):
+    # saves a new file/message row and records it, pass to api.dbwriter.run_write
+    message.save()
+    record_messages([message])
+    return message
+
+
+def mark_read(user, chatroom, last_read_message_id=None):
+    """
+    Marks the room read up to last_read_message_id (everything when None)
+    returns the updated InboxEntry
+    """
+    from api.models import InboxEntry, Message
+
+    create_inbox_entries([chatroom])
+    entries = InboxEntry.objects.filter(user=user, chat_room=chatroom)
+
+    if last_read_message_id in (None, ""):
+        # one UPDATE, so a message recorded meanwhile is not lost
+        entries.update(last_read_message_id=F("last_message_id"), unread_count=0)
+    else:
+        last_read_message_id = int(last_read_message_id)
+        # messages after the read one, on the (chat_room, id) index
+        unread_count = (
+            Message.objects.filter(chat_room=chatroom, id__gt=last_read_message_id)
+            .exclude(sender=user)
+            .count()
+        )
+        entries.update(last_read_message_id=last_read_message_id, unread_count=unread_count)
+
+    return entries.get()
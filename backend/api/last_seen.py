@@ -0,0 +1,78 @@
+import threading
+
+from api.persistence import WriteBehindBuffer
+from django.conf import settings
+from django.utils import timezone
+
+# last time a user was seen in a chatroom (ChatRoom.user1_last_online / user2_last_online)
+# connects and disconnects only record the time in memory, the latest time per (room, user)
+# is written every LAST_SEEN_FLUSH_INTERVAL seconds with one bulk UPDATE per side of the room.
+# get_users_last_online asks this service first, so this worker never serves a stale value
+
+
+class LastSeenWriter(WriteBehindBuffer):
+    def __init__(self, flush_interval, batch_size):
+        super().__init__(flush_interval, batch_size)
+        self._latest = {}  # (room id, user id) -> last seen, until it is in the db
+        self._latest_lock = threading.Lock()
+
+    def touch(self, room_id, user_id):
+        seen_at = timezone.now()
+        with self._latest_lock:
+            self._latest[(room_id, user_id)] = seen_at
+        self.add((room_id, user_id, seen_at))
+
+    def get(self, room_id, user_id):
+        # last seen time that is not written yet, None if the db value is current
+        with self._latest_lock:
+            return self._latest.get((room_id, user_id))
+
+    def write_batch(self, items):
+        from api.lookups import get_room_info
+        from api.models import ChatRoom
+
+        # a user that reconnected 10 times since the last flush is still one row to update
+        latest = {}
+        for room_id, user_id, seen_at in items:
+            key = (room_id, user_id)
+            if key not in latest or seen_at > latest[key]:
+                latest[key] = seen_at
+
+        user1_updates = []
+        user2_updates = []
+        for (room_id, user_id), seen_at in latest.items():
+            room = get_room_info(room_id)
+            if room is None:
+                continue
+            if room["user1_id"] == user_id:
+                user1_updates.append(ChatRoom(id=room_id, user1_last_online=seen_at))
+            elif room["user2_id"] == user_id:
+                user2_updates.append(ChatRoom(id=room_id, user2_last_online=seen_at))
+
+        if user1_updates:
+            ChatRoom.objects.bulk_update(user1_updates, ["user1_last_online"])
+        if user2_updates:
+            ChatRoom.objects.bulk_update(user2_updates, ["user2_last_online"])
+
+        # written, reads can go to the db again unless there was a newer touch meanwhile
+        with self._latest_lock:
+            for key, seen_at in latest.items():
+                if self._latest.get(key) == seen_at:
+                    del self._latest[key]
+
+
+_last_seen_writer = None
+_last_seen_writer_lock = threading.Lock()
+
+
+def get_last_seen_writer():
+    global _last_seen_writer
+
+    if _last_seen_writer is None:
+        with _last_seen_writer_lock:
+            if _last_seen_writer is None:
+                _last_seen_writer = LastSeenWriter(
+                    flush_interval=settings.LAST_SEEN_FLUSH_INTERVAL,
+                    batch_size=settings.LAST_SEEN_BATCH_SIZE,
+                )
+    return _last_seen_writer
@@ -0,0 +1,44 @@
+from api.cache import TTLCache
+from django.conf import settings
+
+# small per-process caches of user and chatroom metadata for the consumers
+# (usernames, who is in a room), kept fresh by the post_save/post_delete handlers in api/signals.py
+
+user_cache = TTLCache(
+    "users", maxsize=settings.LOOKUP_CACHE_SIZE, ttl=settings.LOOKUP_CACHE_TTL
+)
+room_cache = TTLCache(
+    "rooms", maxsize=settings.LOOKUP_CACHE_SIZE, ttl=settings.LOOKUP_CACHE_TTL
+)
+
+
+def get_user_info(user_id):
+    # {"id", "username"} or None when the user does not exist
+    from api.models import AppUser
+
+    info = user_cache.get(user_id)
+    if info is None:
+        info = AppUser.objects.filter(id=user_id).values("id", "username").first()
+        if info is not None:
+            user_cache.set(user_id, info)
+    return info
+
+
+def get_room_info(room_id):
+    # {"id", "user1_id", "user2_id"} or None when the room does not exist
+    from api.models import ChatRoom
+
+    info = room_cache.get(room_id)
+    if info is None:
+        info = ChatRoom.objects.filter(id=room_id).values("id", "user1_id", "user2_id").first()
+        if info is not None:
+            room_cache.set(room_id, info)
+    return info
+
+
+def invalidate_user(user_id):
+    user_cache.delete(user_id)
+
+
+def invalidate_room(room_id):
+    room_cache.delete(room_id)
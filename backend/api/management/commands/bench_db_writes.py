@@ -0,0 +1,249 @@
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings
+from django.utils import timezone
+
+# write throughput benchmark for the sqlite deployment
+# many threads run the chat write paths (message inserts with their room / inbox updates and
+# last seen updates, through api.dbwriter.run_write like the consumers) against a throwaway
+# sqlite file while reader threads page through room history. every mode gets a fresh file:
+#   default     sqlite defaults, every thread writes on its own connection
+#   wal         the production PRAGMAs / BEGIN IMMEDIATE, still one writer per thread
+#   production  the PRAGMAs plus the single writer thread (SQLITE_PRODUCTION=1)
+#
+# python manage.py bench_db_writes --threads 16 --writes 200 --readers 4
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def production_options():
+    return {
+        "init_command": (
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT};"
+            "PRAGMA temp_store=MEMORY;"
+        ),
+        "transaction_mode": "IMMEDIATE",
+        "timeout": settings.SQLITE_BUSY_TIMEOUT / 1000,
+    }
+
+
+modes = {
+    # (OPTIONS, single writer thread)
+    "default": (lambda: {}, False),
+    "wal": (production_options, False),
+    "production": (production_options, True),
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark sqlite write throughput with the default settings and the production mode"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16, help="writing threads")
+        parser.add_argument("--writes", type=int, default=200, help="writes per thread")
+        parser.add_argument("--readers", type=int, default=4, help="threads reading history meanwhile")
+        parser.add_argument("--rooms", type=int, default=50)
+        parser.add_argument("--update-weight", type=float, default=0.3, help="share of last seen updates")
+        parser.add_argument("--modes", default="default,wal,production")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this file")
+        # release gate, production writes/s compared to default writes/s
+        parser.add_argument("--min-speedup", type=float, default=None)
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("bench_db_writes only runs against sqlite")
+
+        mode_names = [name.strip() for name in options["modes"].split(",") if name.strip()]
+        for name in mode_names:
+            if name not in modes:
+                raise CommandError(f"unknown mode {name!r}, use one of {', '.join(modes)}")
+
+        results = {}
+        for name in mode_names:
+            results[name] = self.run_mode(name, options)
+            self.report(name, results[name])
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as fh:
+                json.dump(results, fh, indent=2)
+        self.check_gates(results, options)
+
+    def run_mode(self, name, options):
+        from api.dbwriter import get_db_writer
+
+        get_options, single_writer = modes[name]
+        random.seed(options["seed"])
+
+        # never touch the real database, a file so WAL / locking behave like production
+        db_dir = tempfile.TemporaryDirectory()
+        db_settings = connection.settings_dict
+        old_test_name = db_settings["TEST"].get("NAME")
+        old_options = db_settings.get("OPTIONS", {})
+        db_settings["TEST"]["NAME"] = os.path.join(db_dir.name, "bench.sqlite3")
+
+        connections.close_all()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        db_settings["OPTIONS"] = get_options()
+        connections.close_all()
+        try:
+            with override_settings(DB_SINGLE_WRITER=single_writer):
+                room_ids = self.seed(options)
+                result = self.run_load(room_ids, options)
+                # the writer thread keeps a connection to this file
+                get_db_writer().stop()
+        finally:
+            connections.close_all()
+            db_settings["OPTIONS"] = old_options
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            db_settings["TEST"]["NAME"] = old_test_name
+            db_dir.cleanup()
+        return result
+
+    def seed(self, options):
+        from api.inbox import create_inbox_entries
+        from api.models import AppUser, ChatRoom
+
+        users = AppUser.objects.bulk_create(
+            [AppUser(username=f"bench_user_{i}") for i in range(options["rooms"] * 2)]
+        )
+        rooms = ChatRoom.objects.bulk_create(
+            [
+                ChatRoom(user1=users[i], user2=users[i + 1])
+                for i in range(0, len(users), 2)
+            ]
+        )
+        create_inbox_entries(rooms)
+        return [(room.id, room.user1_id) for room in rooms]
+
+    def run_load(self, room_ids, options):
+        from api.dbwriter import run_write
+        from api.inbox import save_message
+        from api.models import ChatRoom, Message
+
+        def touch_last_seen(room_id):
+            ChatRoom.objects.filter(id=room_id).update(user1_last_online=timezone.now())
+
+        start = threading.Barrier(options["threads"] + options["readers"] + 1)
+        writers_done = threading.Event()
+        lock = threading.Lock()
+        latencies = []
+        counts = {"writes": 0, "locked": 0, "reads": 0}
+
+        def writer(thread_index):
+            rng = random.Random(options["seed"] + thread_index)
+            own_latencies = []
+            writes = locked = 0
+            start.wait()
+            try:
+                for i in range(options["writes"]):
+                    room_id, sender_id = rng.choice(room_ids)
+                    started = time.perf_counter()
+                    try:
+                        if rng.random() < options["update_weight"]:
+                            run_write(touch_last_seen, room_id)
+                        else:
+                            run_write(
+                                save_message,
+                                Message(
+                                    chat_room_id=room_id,
+                                    sender_id=sender_id,
+                                    senderUsername="bench",
+                                    content=f"{thread_index}-{i}",
+                                    signature="c2lnbmF0dXJl",
+                                    iv=f"iv-{thread_index}-{i}",
+                                ),
+                            )
+                    except OperationalError:
+                        # database is locked, the write is lost
+                        locked += 1
+                        continue
+                    own_latencies.append(time.perf_counter() - started)
+                    writes += 1
+            finally:
+                connection.close()
+                with lock:
+                    latencies.extend(own_latencies)
+                    counts["writes"] += writes
+                    counts["locked"] += locked
+
+        def reader(thread_index):
+            rng = random.Random(-thread_index)
+            reads = 0
+            start.wait()
+            try:
+                while not writers_done.is_set():
+                    room_id, _ = rng.choice(room_ids)
+                    list(Message.objects.filter(chat_room_id=room_id).order_by("-id")[:50])
+                    reads += 1
+            except OperationalError:
+                pass
+            finally:
+                connection.close()
+                with lock:
+                    counts["reads"] += reads
+
+        writer_threads = [threading.Thread(target=writer, args=(i,)) for i in range(options["threads"])]
+        reader_threads = [threading.Thread(target=reader, args=(i,)) for i in range(options["readers"])]
+        for thread in writer_threads + reader_threads:
+            thread.start()
+
+        start.wait()
+        started = time.perf_counter()
+        for thread in writer_threads:
+            thread.join()
+        seconds = time.perf_counter() - started
+        writers_done.set()
+        for thread in reader_threads:
+            thread.join()
+
+        return {
+            "writes": counts["writes"],
+            "locked_errors": counts["locked"],
+            "seconds": seconds,
+            "writes_per_second": counts["writes"] / seconds,
+            "write_latency_p50_ms": percentile(latencies, 50) * 1000,
+            "write_latency_p99_ms": percentile(latencies, 99) * 1000,
+            "reads_per_second": counts["reads"] / seconds,
+        }
+
+    def report(self, name, results):
+        self.stdout.write(f"{name}")
+        self.stdout.write(
+            f"  writes                {results['writes']} in {results['seconds']:.2f}s"
+            f" ({results['writes_per_second']:.1f}/s), {results['locked_errors']} database is locked"
+        )
+        self.stdout.write(f"  write latency p50     {results['write_latency_p50_ms']:.2f} ms")
+        self.stdout.write(f"  write latency p99     {results['write_latency_p99_ms']:.2f} ms")
+        self.stdout.write(f"  reads/s meanwhile     {results['reads_per_second']:.1f}")
+
+    def check_gates(self, results, options):
+        if options["min_speedup"] is None:
+            return
+        if "default" not in results or "production" not in results:
+            raise CommandError("--min-speedup needs the default and production modes")
+
+        speedup = results["production"]["writes_per_second"] / max(
+            results["default"]["writes_per_second"], 1e-9
+        )
+        self.stdout.write(f"speedup                 {speedup:.2f}x")
+        if speedup < options["min_speedup"]:
+            raise CommandError(
+                f"benchmark gates failed: speedup {speedup:.2f}x (limit {options['min_speedup']})"
+            )
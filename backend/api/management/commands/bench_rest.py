@@ -0,0 +1,225 @@
+import contextlib
+import io
+import json
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+# times the REST endpoints against the data in the current database (see seed_data)
+# every request runs as one of --sample-users seeded users with a room and a friend,
+# and the number of queries of each request is recorded next to its latency.
+# --save writes the results, --baseline compares against a saved run and fails the
+# command when an endpoint does more queries or got slower than --tolerance allows
+#
+# python manage.py seed_data --users 10000 --messages 2000000
+# python manage.py bench_rest --save bench_rest.json
+# python manage.py bench_rest --baseline bench_rest.json
+
+# name -> (method, url name (or a function of the sample giving the url), request data for a sample)
+# endpoints that create/change data (register, friend requests, set_SK, uploads..)
+# are left out so the benchmark can be run again and again on the same data,
+# mark_chatroom_read is in as marking a room read again changes nothing
+endpoints = {
+    "verify_token": ("post", "verify_token", lambda s: {}),
+    "get_chatrooms": ("get", "get_chatrooms", lambda s: {}),
+    "get_friends": ("get", "get_friends", lambda s: {}),
+    "get_pending_friends": ("get", "get_pending_friends", lambda s: {}),
+    "get_inbox": ("get", "get_inbox", lambda s: {}),
+    "bootstrap": ("get", "bootstrap", lambda s: {}),
+    "get_public": ("post", "get_public", lambda s: {"get_username": s["friend"]}),
+    "get_public_keys": ("post", "get_public_keys", lambda s: {"usernames": [s["friend"], s["username"]]}),
+    "get_user_SK": ("post", "get_user_SK", lambda s: {"friend_username": s["friend"]}),
+    "handleChat": ("post", "handleChat", lambda s: {"user_to_message": s["friend_id"]}),
+    "handle_chatroom": ("post", "handle_chatroom", lambda s: {"user_to_chat": s["friend"]}),
+    "get_users_last_online": (
+        "post",
+        "get_users_last_online",
+        lambda s: {"user_to_get": s["friend"], "chatroom_id": s["room_id"]},
+    ),
+    "get_messages_from_db (page)": (
+        "post",
+        "get_messages_from_db",
+        lambda s: {"chatroom_id": s["room_id"], "page_size": 50},
+    ),
+    # no cursor / page_size, what old clients send (the newest legacy page)
+    "get_messages_from_db (legacy)": (
+        "post",
+        "get_messages_from_db",
+        lambda s: {"chatroom_id": s["room_id"]},
+    ),
+    # catching up from the oldest message, one full sync page
+    "sync": ("post", "sync", lambda s: {"since_message_id": 0}),
+    "mark_chatroom_read": ("post", "mark_chatroom_read", lambda s: {"chatroom_id": s["room_id"]}),
+    # seed_data makes no files, a room without one benchmarks the access check (404)
+    "download_file": (
+        "get",
+        lambda s: reverse("download_file", args=[s["file_path"]]),
+        lambda s: {},
+    ),
+    # api/async_views.py
+    "async get_chatrooms": ("get", "async_get_chatrooms", lambda s: {}),
+    "async get_friends": ("get", "async_get_friends", lambda s: {}),
+    "async get_pending_friends": ("get", "async_get_pending_friends", lambda s: {}),
+    "async get_public": ("post", "async_get_public", lambda s: {"get_username": s["friend"]}),
+    "async get_user_SK": ("post", "async_get_user_SK", lambda s: {"friend_username": s["friend"]}),
+    "async get_messages_from_db (page)": (
+        "post",
+        "async_get_messages_from_db",
+        lambda s: {"chatroom_id": s["room_id"], "page_size": 50},
+    ),
+}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = "Time the REST endpoints against seeded data and record their query counts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--prefix", default="seed_", help="username prefix used by seed_data")
+        parser.add_argument("--sample-users", type=int, default=20)
+        parser.add_argument("--iterations", type=int, default=50, help="requests per endpoint")
+        parser.add_argument("--warmup", type=int, default=5, help="untimed requests per endpoint")
+        parser.add_argument("--endpoint", action="append", dest="only", help="only run this endpoint (repeatable)")
+        parser.add_argument("--save", default=None, help="write the results to this json file")
+        parser.add_argument("--baseline", default=None, help="compare against results saved with --save")
+        parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown against the baseline")
+
+    def handle(self, *args, **options):
+        from rest_framework.test import APIClient
+
+        samples = self.get_samples(options)
+        selected = options["only"] or list(endpoints)
+        unknown = set(selected) - set(endpoints)
+        if unknown:
+            raise CommandError(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+        client = APIClient()
+        results = {}
+        for name in selected:
+            method, url_name, build_data = endpoints[name]
+            url = url_name if callable(url_name) else reverse(url_name)
+
+            timings = []
+            queries = []
+            statuses = set()
+            for i in range(options["warmup"] + options["iterations"]):
+                sample = samples[i % len(samples)]
+                client.credentials(HTTP_AUTHORIZATION=f"Token {sample['token']}")
+                request = getattr(client, method)
+                data = build_data(sample)
+                sample_url = url(sample) if callable(url) else url
+
+                # some views print, keep that out of the output
+                with CaptureQueriesContext(connection) as captured, contextlib.redirect_stdout(io.StringIO()):
+                    started = time.perf_counter()
+                    if method == "get":
+                        response = request(sample_url)
+                    else:
+                        response = request(sample_url, data, format="json")
+                    elapsed = time.perf_counter() - started
+                # file responses keep the file open
+                response.close()
+
+                if i < options["warmup"]:
+                    continue
+                timings.append(elapsed * 1000)
+                queries.append(len(captured))
+                statuses.add(response.status_code)
+
+            results[name] = {
+                "status": sorted(statuses),
+                "p50_ms": percentile(timings, 50),
+                "p95_ms": percentile(timings, 95),
+                "mean_ms": statistics.fmean(timings),
+                "queries": max(queries),
+                "mean_queries": statistics.fmean(queries),
+            }
+
+        self.report(results)
+
+        if options["save"]:
+            with open(options["save"], "w") as fh:
+                json.dump(results, fh, indent=2)
+        if options["baseline"]:
+            self.compare(results, options)
+
+    def get_samples(self, options):
+        from api.models import AppUser, ChatRoom, Message
+        from rest_framework.authtoken.models import Token
+
+        rooms = (
+            ChatRoom.objects.filter(user1__username__startswith=options["prefix"])
+            .select_related("user1", "user2")
+            .order_by("user1_id", "id")
+        )
+        samples = []
+        seen_users = set()
+        for room in rooms.iterator():
+            if room.user1_id in seen_users:
+                continue
+            seen_users.add(room.user1_id)
+            token, _ = Token.objects.get_or_create(user=room.user1)
+            file_path = (
+                Message.objects.filter(chat_room=room, isFile=True)
+                .exclude(fileData="")
+                .values_list("fileData", flat=True)
+                .first()
+            )
+            samples.append(
+                {
+                    "token": token.key,
+                    "username": room.user1.username,
+                    "room_id": room.id,
+                    "friend": room.user2.username,
+                    "friend_id": room.user2_id,
+                    "file_path": file_path or "uploads/missing.bin",
+                }
+            )
+            if len(samples) == options["sample_users"]:
+                break
+
+        if not samples:
+            raise CommandError(
+                f"no users starting with {options['prefix']!r} with a chatroom, run seed_data first"
+            )
+        return samples
+
+    def report(self, results):
+        self.stdout.write(
+            f"{'endpoint':<34} {'status':>8} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9} {'queries':>8}"
+        )
+        for name, result in results.items():
+            status_codes = ",".join(str(code) for code in result["status"])
+            self.stdout.write(
+                f"{name:<34} {status_codes:>8} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                f"{result['mean_ms']:>9.2f} {result['queries']:>8}"
+            )
+
+    def compare(self, results, options):
+        with open(options["baseline"]) as fh:
+            baseline = json.load(fh)
+
+        regressions = []
+        for name, result in results.items():
+            before = baseline.get(name)
+            if before is None:
+                continue
+            if result["queries"] > before["queries"]:
+                regressions.append(f"{name}: {before['queries']} -> {result['queries']} queries")
+            if result["p95_ms"] > before["p95_ms"] * (1 + options["tolerance"]):
+                regressions.append(
+                    f"{name}: p95 {before['p95_ms']:.2f} -> {result['p95_ms']:.2f} ms"
+                )
+
+        if regressions:
+            raise CommandError("regressions against the baseline:\n" + "\n".join(regressions))
+        self.stdout.write("no regressions against the baseline")
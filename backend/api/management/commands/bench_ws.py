@@ -0,0 +1,363 @@
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import random
+import os
+import tempfile
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+# load / fan-out benchmark for the chat websocket
+# runs backend.asgi.application in process against a throwaway test database and an in memory
+# (or local redis) channel layer, opens a websocket per simulated client and reports
+# connections/s, fan-out latency, db writes per message and memory per connection
+#
+# python manage.py bench_ws --rooms 500 --connections-per-user 2 --actions 20
+
+
+class WriteCounter:
+    # counts INSERT/UPDATE/DELETE statements on every db connection (the consumers use a thread pool)
+
+    def __init__(self):
+        self.writes = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        if sql.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            self.writes += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+# how long a client waits for the server to answer an upload frame
+UPLOAD_TIMEOUT = 30
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = "Benchmark ChatConsumer connection rate, fan-out latency and db writes under load"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=250, help="number of chatrooms (2 users each)")
+        parser.add_argument("--connections-per-user", type=int, default=2, help="websockets (tabs) per user")
+        parser.add_argument("--actions", type=int, default=10, help="actions sent by every connection")
+        parser.add_argument("--message-weight", type=float, default=0.7)
+        parser.add_argument("--typing-weight", type=float, default=0.25)
+        parser.add_argument("--upload-weight", type=float, default=0.05)
+        parser.add_argument("--upload-size", type=int, default=64 * 1024, help="bytes per simulated upload")
+        parser.add_argument("--connect-concurrency", type=int, default=200)
+        parser.add_argument("--redis", default=None, help="redis url for the channel layer, in memory when not set")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--json", dest="json_path", default=None, help="also write the results to this file")
+        # release gates, the command exits with an error when one of them is missed
+        parser.add_argument("--min-connections-per-second", type=float, default=None)
+        parser.add_argument("--max-p99-ms", type=float, default=None)
+        parser.add_argument("--max-db-writes-per-message", type=float, default=None)
+        parser.add_argument("--max-memory-per-connection-kb", type=float, default=None)
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+
+        if options["redis"]:
+            settings.CHANNEL_LAYERS = {
+                "default": {
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": [options["redis"]]},
+                }
+            }
+        else:
+            settings.CHANNEL_LAYERS = {
+                "default": {
+                    "BACKEND": "channels.layers.InMemoryChannelLayer",
+                    "CONFIG": {"capacity": 100000},
+                }
+            }
+
+        # never touch the real database or media files
+        media_root = tempfile.TemporaryDirectory()
+        media_settings = override_settings(
+            MEDIA_ROOT=media_root.name,
+            CHUNKED_UPLOAD_DIR=os.path.join(media_root.name, "tmp_uploads"),
+        )
+        media_settings.enable()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            clients = self.seed(options)
+            # the consumers print on every connect / message, keep that out of the results
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = asyncio.run(self.run(clients, options))
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            media_settings.disable()
+            media_root.cleanup()
+
+        self.report(results, options)
+        self.check_gates(results, options)
+
+    def seed(self, options):
+        from api.models import AppUser, ChatRoom, Friendship
+        from rest_framework.authtoken.models import Token
+
+        users = AppUser.objects.bulk_create(
+            [AppUser(username=f"bench_user_{i}") for i in range(options["rooms"] * 2)]
+        )
+        tokens = Token.objects.bulk_create(
+            [Token(key=Token.generate_key(), user=user) for user in users]
+        )
+        rooms = ChatRoom.objects.bulk_create(
+            [
+                ChatRoom(user1=users[i], user2=users[i + 1])
+                for i in range(0, len(users), 2)
+            ]
+        )
+        # only friends can use a room (api/authz.py)
+        Friendship.objects.bulk_create(
+            [
+                Friendship(from_user=users[i], to_user=users[i + 1], status="accepted")
+                for i in range(0, len(users), 2)
+            ]
+        )
+
+        clients = []
+        for room_index, room in enumerate(rooms):
+            for token in tokens[room_index * 2 : room_index * 2 + 2]:
+                for _ in range(options["connections_per_user"]):
+                    clients.append({"room_id": room.id, "token": token.key})
+        return clients
+
+    async def run(self, clients, options):
+        from api.last_seen import get_last_seen_writer
+        from api.persistence import get_message_writer
+        from backend.asgi import application
+        from channels.testing import WebsocketCommunicator
+
+        write_counter = WriteCounter()
+        connection_created.connect(write_counter.install)
+
+        # connect phase
+        tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0]
+        semaphore = asyncio.Semaphore(options["connect_concurrency"])
+
+        async def open_client(client):
+            async with semaphore:
+                communicator = WebsocketCommunicator(
+                    application, f"/ws/chat/{client['room_id']}/?token={client['token']}"
+                )
+                connected, _ = await communicator.connect(timeout=30)
+                if not connected:
+                    raise RuntimeError("websocket connection was refused")
+                client["communicator"] = communicator
+
+        connect_started = time.perf_counter()
+        await asyncio.gather(*(open_client(client) for client in clients))
+        connect_seconds = time.perf_counter() - connect_started
+        memory_per_connection = (tracemalloc.get_traced_memory()[0] - memory_before) / len(clients)
+        tracemalloc.stop()
+
+        # let the join broadcasts and connect time writes settle before measuring
+        await asyncio.sleep(0.5)
+        await get_last_seen_writer().flush()
+        for client in clients:
+            while not client["communicator"].output_queue.empty():
+                client["communicator"].output_queue.get_nowait()
+        writes_before = write_counter.writes
+
+        latencies = []
+        received = {"new_message": 0, "new_upload": 0, "typing": 0}
+
+        async def read_client(client):
+            queue = client["communicator"].output_queue
+            while True:
+                output = await queue.get()
+                if output.get("type") == "websocket.close":
+                    # wake up a client waiting on an upload, it fails with the close code
+                    client["closed"] = output.get("code")
+                    client["upload_ready"].put_nowait(None)
+                    client["upload_done"].put_nowait(None)
+                    return
+                if output.get("type") != "websocket.send" or not output.get("text"):
+                    continue
+                frame = json.loads(output["text"])
+                message_type = frame.get("message_type")
+                if message_type == "new_message":
+                    received["new_message"] += 1
+                    sent_at = float(base64.b64decode(frame["encrypted_message"]))
+                    latencies.append(time.perf_counter() - sent_at)
+                elif message_type == "new_upload":
+                    received["new_upload"] += 1
+                elif message_type in ("user_typing_message", "user_stopped_typing_message"):
+                    received["typing"] += 1
+                elif message_type == "upload_ready":
+                    client["upload_ready"].put_nowait(frame)
+                elif message_type == "upload_complete":
+                    client["upload_done"].put_nowait(frame)
+
+        weights = [options["message_weight"], options["typing_weight"], options["upload_weight"]]
+        upload_payload = random.randbytes(options["upload_size"])
+        sent = {"new_message": 0, "typing": 0, "upload": 0}
+
+        async def wait_for_upload_frame(client, name):
+            try:
+                frame = await asyncio.wait_for(client[name].get(), UPLOAD_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise CommandError(f"no {name} frame from the server after {UPLOAD_TIMEOUT}s")
+            if frame is None:
+                raise CommandError(
+                    f"the server closed the websocket (code {client['closed']}) while waiting for {name}"
+                )
+            return frame
+
+        async def drive_client(client):
+            communicator = client["communicator"]
+            for _ in range(options["actions"]):
+                action = random.choices(["message", "typing", "upload"], weights)[0]
+                if action == "message":
+                    sent["new_message"] += 1
+                    await communicator.send_to(
+                        text_data=json.dumps(
+                            {
+                                "message_type": "new_message",
+                                # the send time, base64 like a real ciphertext
+                                "encrypted_message": base64.b64encode(
+                                    repr(time.perf_counter()).encode()
+                                ).decode(),
+                                "message_signature": "c2lnbmF0dXJl",
+                                "iv": "aXZpdml2aXZpdg==",
+                            }
+                        )
+                    )
+                elif action == "typing":
+                    sent["typing"] += 1
+                    await communicator.send_to(text_data=json.dumps({"message_type": "user_typing"}))
+                    await communicator.send_to(text_data=json.dumps({"message_type": "user_stopped_typing"}))
+                else:
+                    sent["upload"] += 1
+                    await communicator.send_to(
+                        text_data=json.dumps(
+                            {
+                                "message_type": "upload_begin",
+                                "fileName": "bench.bin",
+                                "size": len(upload_payload),
+                                "signature": "c2lnbmF0dXJl",
+                                "iv": "aXZpdml2aXZpdg==",
+                            }
+                        )
+                    )
+                    ready = await wait_for_upload_frame(client, "upload_ready")
+                    header = json.dumps({"upload_id": ready["upload_id"], "offset": 0}).encode()
+                    await communicator.send_to(
+                        bytes_data=len(header).to_bytes(4, "big") + header + upload_payload
+                    )
+                    await communicator.send_to(
+                        text_data=json.dumps({"message_type": "upload_end", "upload_id": ready["upload_id"]})
+                    )
+                    await wait_for_upload_frame(client, "upload_done")
+                # yield so every client gets to send
+                await asyncio.sleep(0)
+
+        for client in clients:
+            client["closed"] = None
+            client["upload_ready"] = asyncio.Queue()
+            client["upload_done"] = asyncio.Queue()
+        readers = [asyncio.create_task(read_client(client)) for client in clients]
+
+        drive_started = time.perf_counter()
+        await asyncio.gather(*(drive_client(client) for client in clients))
+
+        # every message goes to the connections of the other user in the room
+        expected = sent["new_message"] * options["connections_per_user"]
+        deadline = time.perf_counter() + 60
+        while received["new_message"] < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        drive_seconds = time.perf_counter() - drive_started
+
+        await get_message_writer().flush()
+        message_writes = write_counter.writes - writes_before
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(
+            *(client["communicator"].disconnect() for client in clients), return_exceptions=True
+        )
+        await get_message_writer().flush()
+        await get_last_seen_writer().flush()
+        connection_created.disconnect(write_counter.install)
+
+        return {
+            "clients": len(clients),
+            "rooms": options["rooms"],
+            "connect_seconds": connect_seconds,
+            "connections_per_second": len(clients) / connect_seconds,
+            "memory_per_connection_bytes": memory_per_connection,
+            "messages_sent": sent["new_message"],
+            "messages_delivered": received["new_message"],
+            "typing_actions": sent["typing"],
+            "typing_frames_delivered": received["typing"],
+            "uploads": sent["upload"],
+            "drive_seconds": drive_seconds,
+            "messages_per_second": sent["new_message"] / drive_seconds if drive_seconds else 0,
+            "fanout_latency_p50_ms": percentile(latencies, 50) * 1000,
+            "fanout_latency_p99_ms": percentile(latencies, 99) * 1000,
+            "db_writes": message_writes,
+            "db_writes_per_message": message_writes / max(sent["new_message"] + sent["upload"], 1),
+        }
+
+    def report(self, results, options):
+        self.stdout.write(f"clients                 {results['clients']} in {results['rooms']} rooms")
+        self.stdout.write(f"connections/s           {results['connections_per_second']:.1f}")
+        self.stdout.write(f"memory/connection       {results['memory_per_connection_bytes'] / 1024:.1f} KiB")
+        self.stdout.write(
+            f"messages                {results['messages_delivered']} delivered / {results['messages_sent']} sent"
+            f" ({results['messages_per_second']:.1f} sent/s)"
+        )
+        self.stdout.write(
+            f"typing                  {results['typing_frames_delivered']} frames delivered for {results['typing_actions']} typing bursts"
+        )
+        self.stdout.write(f"uploads                 {results['uploads']}")
+        self.stdout.write(f"fan-out latency p50     {results['fanout_latency_p50_ms']:.2f} ms")
+        self.stdout.write(f"fan-out latency p99     {results['fanout_latency_p99_ms']:.2f} ms")
+        self.stdout.write(f"db writes/message       {results['db_writes_per_message']:.3f}")
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as fh:
+                json.dump(results, fh, indent=2)
+
+    def check_gates(self, results, options):
+        failed = []
+        if results["messages_delivered"] < results["messages_sent"] * options["connections_per_user"]:
+            failed.append("not every message was delivered")
+
+        gates = [
+            ("min_connections_per_second", "connections_per_second", 1, "min"),
+            ("max_p99_ms", "fanout_latency_p99_ms", 1, "max"),
+            ("max_db_writes_per_message", "db_writes_per_message", 1, "max"),
+            ("max_memory_per_connection_kb", "memory_per_connection_bytes", 1024, "max"),
+        ]
+        for option, result, scale, kind in gates:
+            limit = options[option]
+            if limit is None:
+                continue
+            value = results[result] / scale
+            if (kind == "min" and value < limit) or (kind == "max" and value > limit):
+                failed.append(f"{result} {value:.2f} (limit {limit})")
+
+        if failed:
+            raise CommandError("benchmark gates failed: " + ", ".join(failed))
@@ -0,0 +1,224 @@
+import base64
+import random
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+# fills the database with a synthetic population for benchmarking (see bench_rest)
+# every user is friends with the next --friends users, has --pending requests to and
+# --rejected requests from the users after that, and every friendship has a chatroom.
+# messages are spread over the rooms with a long tail (a few busy rooms, many quiet ones)
+#
+# python manage.py seed_data --users 10000 --messages 2000000
+
+
+class Command(BaseCommand):
+    help = "Seed users, friendships in every status, chatrooms and messages with bulk inserts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--friends", type=int, default=10, help="accepted friendships per user")
+        parser.add_argument("--pending", type=int, default=3, help="pending requests per user")
+        parser.add_argument("--rejected", type=int, default=1, help="rejected requests per user")
+        parser.add_argument("--messages", type=int, default=100000, help="total number of messages")
+        parser.add_argument("--message-size", type=int, default=256, help="bytes of (fake) ciphertext per message")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--prefix", default="seed_", help="username prefix of the seeded users")
+        parser.add_argument("--password", default="benchmark-password")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        from api.models import AppUser
+
+        random.seed(options["seed"])
+
+        users = options["users"]
+        per_user = options["friends"] + options["pending"] + options["rejected"]
+        if users <= per_user:
+            raise CommandError("--users has to be larger than --friends + --pending + --rejected")
+        if AppUser.objects.filter(username__startswith=options["prefix"]).exists():
+            raise CommandError(
+                f"users starting with {options['prefix']!r} already exist, use another --prefix"
+            )
+
+        started = time.perf_counter()
+        users = self.seed_users(options)
+        friendships = self.seed_friendships(users, options)
+        rooms = self.seed_rooms(friendships, options)
+        messages = self.seed_messages(users, rooms, options)
+
+        self.stdout.write(
+            f"seeded {len(users)} users, {friendships.count()} friendships, {len(rooms)} rooms "
+            f"and {messages} messages in {time.perf_counter() - started:.1f}s"
+        )
+
+    def seed_users(self, options):
+        from api.models import AppUser
+
+        # hashing once, every seeded user has the same password
+        password = make_password(options["password"])
+        AppUser.objects.bulk_create(
+            (
+                AppUser(
+                    username=f"{options['prefix']}{i}",
+                    password=password,
+                    public_key=f"{options['prefix']}public_key_{i}",
+                )
+                for i in range(options["users"])
+            ),
+            batch_size=options["batch_size"],
+        )
+        # not every backend returns the ids from bulk_create, read them back
+        users = list(
+            AppUser.objects.filter(username__startswith=options["prefix"])
+            .only("id", "username")
+            .order_by("id")
+        )
+        self.stdout.write(f"users: {len(users)}")
+        return users
+
+    def seed_friendships(self, users, options):
+        from api.models import Friendship
+
+        statuses = (
+            [Friendship.ACCEPTED] * options["friends"]
+            + [Friendship.PENDING] * options["pending"]
+            + [Friendship.REJECTED] * options["rejected"]
+        )
+
+        def build():
+            # with few users the offsets wrap around and reach a pair from the other side
+            # (a -> b and b -> a), every pair gets only its first friendship (and room)
+            pairs = set()
+            for index, from_user in enumerate(users):
+                for offset, friendship_status in enumerate(statuses, start=1):
+                    to_user = users[(index + offset) % len(users)]
+                    pair = (min(from_user.id, to_user.id), max(from_user.id, to_user.id))
+                    if pair in pairs:
+                        continue
+                    pairs.add(pair)
+                    accepted = friendship_status == Friendship.ACCEPTED
+                    yield Friendship(
+                        from_user=from_user,
+                        to_user=to_user,
+                        from_user_name=from_user.username,
+                        to_user_name=to_user.username,
+                        status=friendship_status,
+                        # the keys are unique, so only accepted friendships get (fake) ones
+                        from_user_SK=f"sk_{from_user.id}_{to_user.id}" if accepted else None,
+                        to_user_SK=f"sk_{to_user.id}_{from_user.id}" if accepted else None,
+                    )
+
+        Friendship.objects.bulk_create(build(), batch_size=options["batch_size"])
+        friendships = Friendship.objects.filter(
+            from_user__username__startswith=options["prefix"]
+        )
+        self.stdout.write(f"friendships: {friendships.count()}")
+        return friendships
+
+    def seed_rooms(self, friendships, options):
+        from api.inbox import create_inbox_entries
+        from api.models import ChatRoom
+
+        pairs = friendships.filter(status="accepted").values_list("from_user_id", "to_user_id")
+        ChatRoom.objects.bulk_create(
+            (ChatRoom(user1_id=min(pair), user2_id=max(pair)) for pair in pairs.iterator()),
+            batch_size=options["batch_size"],
+        )
+        rooms = list(
+            ChatRoom.objects.filter(user1__username__startswith=options["prefix"])
+            .values_list("id", "user1_id", "user2_id")
+            .order_by("id")
+        )
+        create_inbox_entries(
+            ChatRoom(id=room_id, user1_id=user1_id, user2_id=user2_id)
+            for room_id, user1_id, user2_id in rooms
+        )
+        self.stdout.write(f"rooms: {len(rooms)}")
+        return rooms
+
+    def seed_messages(self, users, rooms, options):
+        from api.models import ChatRoom, InboxEntry, Message
+        from django.db.models import Count, Max
+
+        total = options["messages"]
+        batch_size = options["batch_size"]
+        if not total or not rooms:
+            return 0
+
+        # long tail: room n gets a share proportional to 1 / n
+        shuffled = random.sample(rooms, len(rooms))
+        weights = [1 / rank for rank in range(1, len(shuffled) + 1)]
+        content = base64.b64encode(random.randbytes(options["message_size"])).decode()
+        signature = base64.b64encode(random.randbytes(64)).decode()
+        usernames = {user.id: user.username for user in users}
+
+        created = 0
+        while created < total:
+            count = min(batch_size, total - created)
+            batch = []
+            for room_id, user1_id, user2_id in random.choices(shuffled, weights, k=count):
+                sender_id = user1_id if random.random() < 0.5 else user2_id
+                batch.append(
+                    Message(
+                        chat_room_id=room_id,
+                        sender_id=sender_id,
+                        senderUsername=usernames[sender_id],
+                        content=content,
+                        signature=signature,
+                        iv=base64.b64encode(random.randbytes(12)).decode(),
+                    )
+                )
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            created += count
+            self.stdout.write(f"messages: {created}/{total}", ending="\r")
+        self.stdout.write("")
+
+        # the counters the message writer keeps up to date (room counters and inbox entries)
+        seeded_messages = Message.objects.filter(
+            chat_room__user1__username__startswith=options["prefix"]
+        )
+        stats = {
+            row["chat_room_id"]: row
+            for row in seeded_messages.values("chat_room_id").annotate(
+                count=Count("id"), last_id=Max("id"), last=Max("timestamp")
+            )
+        }
+        ChatRoom.objects.bulk_update(
+            [
+                ChatRoom(id=room_id, numOfMessages=row["count"], last_message_time=row["last"])
+                for room_id, row in stats.items()
+            ],
+            ["numOfMessages", "last_message_time"],
+            batch_size=batch_size,
+        )
+
+        sent = {
+            (row["chat_room_id"], row["sender_id"]): row["count"]
+            for row in seeded_messages.values("chat_room_id", "sender_id").annotate(count=Count("id"))
+        }
+        entries = []
+        for entry_id, user_id, room_id in InboxEntry.objects.filter(
+            chat_room__user1__username__startswith=options["prefix"]
+        ).values_list("id", "user_id", "chat_room_id"):
+            row = stats.get(room_id)
+            if row is None:
+                continue
+            entries.append(
+                InboxEntry(
+                    id=entry_id,
+                    last_message_id=row["last_id"],
+                    last_message_time=row["last"],
+                    # everything the other member sent is unread
+                    unread_count=row["count"] - sent.get((room_id, user_id), 0),
+                )
+            )
+        InboxEntry.objects.bulk_update(
+            entries,
+            ["last_message_id", "last_message_time", "unread_count"],
+            batch_size=batch_size,
+        )
+        return created
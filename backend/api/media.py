@@ -0,0 +1,129 @@
+import os
+import re
+
+from api.storage import blob_name_pattern
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.http import (FileResponse, HttpResponse, HttpResponseNotModified,
+                         StreamingHttpResponse)
+from django.utils.http import http_date, parse_etags, quote_etag
+
+# file responses for the download_file view
+# supports conditional requests (ETag / If-None-Match), single Range requests (resumable downloads),
+# and can hand the actual file transfer to the web server (X-Accel-Redirect / X-Sendfile)
+
+range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+stream_block_size = 64 * 1024
+
+
+def file_etag(name, stat):
+    # content addressed blobs (api/storage.py) already have their hash in the name
+    if blob_name_pattern.search(name):
+        return quote_etag(os.path.splitext(os.path.basename(name))[0])
+    return quote_etag(f"{stat.st_size:x}-{stat.st_mtime_ns:x}")
+
+
+def parse_range(header, size):
+    """
+    Returns (start, end) (inclusive) for a single "bytes=" range, None when the header should be
+    ignored and raises ValueError when the range cant be satisfied
+    """
+    match = range_pattern.match(header.strip())
+    if not match:
+        # multiple ranges / other units, we answer with the whole file
+        return None
+
+    start, end = match.groups()
+    if start == "" and end == "":
+        return None
+
+    if start == "":
+        # last N bytes
+        length = int(end)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = size - 1 if end == "" else min(int(end), size - 1)
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable range")
+    return start, end
+
+
+def read_range(path, start, end):
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            block = fh.read(min(stream_block_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+
+
+def media_response(request, name):
+    path = default_storage.path(name)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return HttpResponse(status=404)
+
+    etag = file_etag(name, stat)
+    last_modified = http_date(stat.st_mtime)
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == "*"):
+        response = HttpResponseNotModified()
+        response["ETag"] = etag
+        return response
+
+    sendfile = settings.MEDIA_SENDFILE
+    if sendfile:
+        # the web server sends the file (zero copy, handles Range itself), we only did the auth check
+        response = HttpResponse(content_type="application/octet-stream")
+        if sendfile == "x-accel-redirect":
+            response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + name
+        else:
+            response["X-Sendfile"] = path
+        response["ETag"] = etag
+        response["Last-Modified"] = last_modified
+        return response
+
+    byte_range = None
+    range_header = request.META.get("HTTP_RANGE")
+    if_range = request.META.get("HTTP_IF_RANGE")
+    # If-Range: only send the partial content when the client still has the same version
+    if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{stat.st_size}"
+            return response
+
+    if byte_range is None:
+        # under WSGI FileResponse goes through wsgi.file_wrapper (sendfile)
+        response = FileResponse(open(path, "rb"), content_type="application/octet-stream")
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            read_range(path, start, end),
+            status=206,
+            content_type="application/octet-stream",
+        )
+        response["Content-Length"] = str(end - start + 1)
+        response["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+
+    response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    response["Last-Modified"] = last_modified
+    # the files are encrypted, but they are still only for the members of the chatroom
+    if blob_name_pattern.search(name):
+        # a blob name always means the same bytes
+        response["Cache-Control"] = "private, max-age=31536000, immutable"
+    else:
+        response["Cache-Control"] = "private, no-cache"
+    return response
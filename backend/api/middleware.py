@@ -1,10 +1,14 @@
 from urllib.parse import parse_qs
 
+from api.authentication import get_cached_token, token_cache
+from api.routers import end_request, start_request
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from channels.db import database_sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
 from django.http import Http404, HttpResponse, HttpResponseForbidden
 from django.shortcuts import render
+from django.urls import Resolver404, resolve
 from rest_framework.authtoken.models import Token
 
 
@@ -23,14 +27,66 @@ class TokenAuthMiddleware:
         if not token_name:
             scope["user"] = AnonymousUser()
         else:
-            # Use a sync_to_async function to interact with the ORM
-            scope["user"] = await self.get_user(token_name[0])
+            # most handshakes (reconnects) are answered by the token cache without touching the db
+            cached = get_cached_token(token_name[0])
+            if cached is not None and cached[0].is_active:
+                scope["user"] = cached[0]
+            else:
+                # Use a sync_to_async function to interact with the ORM
+                scope["user"] = await self.get_user(token_name[0])
         return await self.inner(scope, receive, send)
 
     @database_sync_to_async
     def get_user(self, token_name):
         try:
-            token = Token.objects.get(key=token_name)
-            return token.user
+            token = Token.objects.select_related("user").get(key=token_name)
         except Token.DoesNotExist:
             return AnonymousUser()
+
+        if not token.user.is_active:
+            return AnonymousUser()
+
+        token_cache.set(token_name, (token.user, token))
+        return token.user
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets the read only endpoints (settings.REPLICA_READ_VIEWS) read from a replica, see api/routers.py
+    works for the sync and the async views
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def replica_reads(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return False
+        try:
+            match = resolve(request.path_info)
+        except Resolver404:
+            return False
+        return match.url_name in settings.REPLICA_READ_VIEWS
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+
+        token = start_request(request, self.replica_reads(request))
+        try:
+            return self.get_response(request)
+        finally:
+            end_request(token)
+
+    async def __acall__(self, request):
+        # the state is a context variable, sync_to_async copies it into the orm threads
+        token = start_request(request, self.replica_reads(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            end_request(token)
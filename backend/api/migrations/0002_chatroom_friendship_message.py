@@ -0,0 +1,70 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:33
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appuser',
+            name='public_key',
+            field=models.TextField(null=True, unique=True),
+        ),
+        migrations.CreateModel(
+            name='ChatRoom',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user1_last_online', models.DateTimeField(blank=True, null=True)),
+                ('user2_last_online', models.DateTimeField(blank=True, null=True)),
+                ('numOfMessages', models.IntegerField(default=0)),
+                ('last_message_time', models.DateTimeField(blank=True, null=True)),
+                ('user1', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chatroom_user1', to=settings.AUTH_USER_MODEL)),
+                ('user2', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chatroom_user2', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Friendship',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('from_user_SK', models.TextField(null=True, unique=True)),
+                ('to_user_SK', models.TextField(null=True, unique=True)),
+                ('from_user_name', models.TextField(blank=True, null=True)),
+                ('to_user_name', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('accepted', 'Accepted'), ('rejected', 'Rejected')], default='pending', max_length=10)),
+                ('from_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='from_friend', to=settings.AUTH_USER_MODEL)),
+                ('to_user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='to_friend', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('from_user', 'to_user', 'status')},
+            },
+        ),
+        migrations.AddField(
+            model_name='appuser',
+            name='friends',
+            field=models.ManyToManyField(related_name='friend_of', through='api.Friendship', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('senderUsername', models.CharField(blank=True, max_length=200, null=True)),
+                ('content', models.TextField(blank=True, max_length=100000, null=True)),
+                ('fileData', models.FileField(blank=True, null=True, upload_to='uploads/')),
+                ('isFile', models.BooleanField(default=False)),
+                ('fileName', models.TextField(blank=True, null=True)),
+                ('signature', models.TextField(blank=True, max_length=100000, null=True)),
+                ('iv', models.TextField(blank=True, max_length=100000, null=True)),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='api.chatroom')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+def canonicalize_chatrooms(apps, schema_editor):
+    # put every room in (lowest user id, highest user id) order and fold duplicate rooms
+    # for the same pair into the oldest one before the unique constraint is added
+    ChatRoom = apps.get_model("api", "ChatRoom")
+    Message = apps.get_model("api", "Message")
+
+    # rooms with yourself are kept as they are, (id, id) is already in canonical order and the
+    # constraint allows user1 == user2 so their messages and files survive
+    kept_rooms = {}
+    for room in ChatRoom.objects.order_by("id"):
+        if room.user1_id > room.user2_id:
+            room.user1_id, room.user2_id = room.user2_id, room.user1_id
+            room.user1_last_online, room.user2_last_online = (
+                room.user2_last_online,
+                room.user1_last_online,
+            )
+            swapped = True
+        else:
+            swapped = False
+
+        pair = (room.user1_id, room.user2_id)
+        kept_room = kept_rooms.get(pair)
+        if kept_room is None:
+            kept_rooms[pair] = room
+            if swapped:
+                room.save()
+            continue
+
+        # duplicate room, move its messages into the room we keep
+        Message.objects.filter(chat_room_id=room.id).update(chat_room_id=kept_room.id)
+        kept_room.numOfMessages += room.numOfMessages
+        for field in ("user1_last_online", "user2_last_online", "last_message_time"):
+            value = getattr(room, field)
+            if value and (getattr(kept_room, field) is None or value > getattr(kept_room, field)):
+                setattr(kept_room, field, value)
+        kept_room.save()
+        room.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_chatroom_friendship_message'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['to_user', 'status'], name='friendship_to_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='friendship',
+            index=models.Index(fields=['from_user', 'status'], name='friendship_from_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_room', 'id'], name='message_room_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat_room', 'timestamp'], name='message_room_timestamp_idx'),
+        ),
+        migrations.RunPython(canonicalize_chatrooms, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.UniqueConstraint(fields=('user1', 'user2'), name='unique_chatroom_user_pair'),
+        ),
+        migrations.AddConstraint(
+            model_name='chatroom',
+            constraint=models.CheckConstraint(condition=models.Q(('user1__lte', models.F('user2'))), name='chatroom_user_pair_ordered'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_chat_indexes_and_canonical_rooms'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='fileData',
+            field=models.FileField(blank=True, db_index=True, null=True, upload_to='uploads/'),
+        ),
+    ]
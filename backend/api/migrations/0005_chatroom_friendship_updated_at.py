@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_filedata_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='friendship',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
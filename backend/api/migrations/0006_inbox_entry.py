@@ -0,0 +1,61 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:50
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def create_inbox_entries(apps, schema_editor):
+    # an entry for both members of every existing room, with the room's last message
+    # (unread counts start at 0, there is no read state to derive them from)
+    ChatRoom = apps.get_model("api", "ChatRoom")
+    InboxEntry = apps.get_model("api", "InboxEntry")
+    Message = apps.get_model("api", "Message")
+
+    last_messages = {
+        row["chat_room_id"]: row["last_id"]
+        for row in Message.objects.values("chat_room_id").annotate(last_id=Max("id"))
+    }
+
+    entries = []
+    for room in ChatRoom.objects.all().iterator():
+        # a set, a room with yourself (user1 == user2, see 0003) gets one entry
+        for user_id in {room.user1_id, room.user2_id}:
+            entries.append(
+                InboxEntry(
+                    user_id=user_id,
+                    chat_room_id=room.id,
+                    last_message_id=last_messages.get(room.id),
+                    last_message_time=room.last_message_time,
+                    last_read_message_id=last_messages.get(room.id),
+                )
+            )
+    InboxEntry.objects.bulk_create(entries, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_chatroom_friendship_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('last_message_time', models.DateTimeField(blank=True, null=True)),
+                ('last_read_message_id', models.BigIntegerField(blank=True, null=True)),
+                ('unread_count', models.IntegerField(default=0)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='api.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(models.F('user'), models.OrderBy(models.F('last_message_time'), descending=True), name='inbox_user_activity_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'chat_room'), name='unique_inbox_entry')],
+            },
+        ),
+        migrations.RunPython(create_inbox_entries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_inbox_entry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='delivery_id',
+            field=models.UUIDField(blank=True, editable=False, null=True),
+        ),
+    ]
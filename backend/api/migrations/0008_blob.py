@@ -0,0 +1,40 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:51
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_blob_refs(apps, schema_editor):
+    # the messages already pointing at every stored upload
+    Blob = apps.get_model("api", "Blob")
+    Message = apps.get_model("api", "Message")
+
+    refs = (
+        Message.objects.exclude(fileData="")
+        .exclude(fileData__isnull=True)
+        .values("fileData")
+        .annotate(refs=Count("id"))
+    )
+    Blob.objects.bulk_create(
+        [Blob(name=row["fileData"], refs=row["refs"]) for row in refs.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_message_delivery_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refs', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_blob_refs, migrations.RunPython.noop),
+    ]
@@ -41,6 +41,30 @@ class ChatRoom(models.Model):
 
     numOfMessages = models.IntegerField(default=0)
     last_message_time = models.DateTimeField(null=True, blank=True)
+    # last change of the fields clients see, the sync endpoint returns rooms changed since a time
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # rooms are stored with the pair in canonical order (user1.id <= user2.id, equal for the
+        # rooms some users have with themselves from before this constraint)
+        # so looking up the room of 2 users is one probe on this unique index, and 2 concurrent
+        # handle_chatroom calls cant both create a room for the same pair
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user1", "user2"], name="unique_chatroom_user_pair"
+            ),
+            models.CheckConstraint(
+                condition=models.Q(user1__lte=models.F("user2")),
+                name="chatroom_user_pair_ordered",
+            ),
+        ]
+
+    @staticmethod
+    def canonical_pair(user1, user2):
+        # returns the 2 users in the order they are stored in (lowest id first)
+        if user1.id > user2.id:
+            return user2, user1
+        return user1, user2
 
 
 class Message(models.Model):
@@ -52,12 +76,27 @@ class Message(models.Model):
     )
     senderUsername = models.CharField(max_length=200, null=True, blank=True)
     content = models.TextField(max_length=100000, null=True, blank=True)
-    fileData = models.FileField(upload_to="uploads/", null=True, blank=True)
+    # indexed because blobs are shared between messages, see api/storage.py
+    fileData = models.FileField(
+        upload_to="uploads/", null=True, blank=True, db_index=True
+    )
     isFile = models.BooleanField(default=False)
     fileName = models.TextField(null=True, blank=True)
     signature = models.TextField(max_length=100000, null=True, blank=True)
     iv = models.TextField(max_length=100000, null=True, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
+    # given by the server when the message is sent (before the write behind buffer gives it an id),
+    # the live event carries it too so a reconnecting client doesnt get a replayed message twice
+    delivery_id = models.UUIDField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # history pages and "messages after id" lookups for a room
+            models.Index(fields=["chat_room", "id"], name="message_room_id_idx"),
+            models.Index(
+                fields=["chat_room", "timestamp"], name="message_room_timestamp_idx"
+            ),
+        ]
 
 
 class Friendship(models.Model):
@@ -84,7 +123,52 @@ class Friendship(models.Model):
     from_user_name = models.TextField(null=True, blank=True)
     to_user_name = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # see ChatRoom.updated_at
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
 
     class Meta:
         unique_together = ("from_user", "to_user", "status")
+        indexes = [
+            # get_friends / get_pending_friends filter on one side of the friendship + status
+            models.Index(fields=["to_user", "status"], name="friendship_to_status_idx"),
+            models.Index(
+                fields=["from_user", "status"], name="friendship_from_status_idx"
+            ),
+        ]
+
+
+class InboxEntry(models.Model):
+    # one row per (user, chatroom), kept up to date as messages are saved (api/inbox.py)
+    # so the inbox of a user is one query on inbox_user_activity_idx
+    user = models.ForeignKey(
+        AppUser, on_delete=models.CASCADE, related_name="inbox_entries"
+    )
+    chat_room = models.ForeignKey(
+        ChatRoom, on_delete=models.CASCADE, related_name="inbox_entries"
+    )
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_time = models.DateTimeField(null=True, blank=True)
+    last_read_message_id = models.BigIntegerField(null=True, blank=True)
+    unread_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "chat_room"], name="unique_inbox_entry"
+            ),
+        ]
+        indexes = [
+            models.Index(
+                "user",
+                models.F("last_message_time").desc(),
+                name="inbox_user_activity_idx",
+            ),
+        ]
+
+
+class Blob(models.Model):
+    # number of messages pointing at a stored upload (api/storage.py), counted before the storage
+    # looks for the file and decremented when a message is deleted, the file goes with the last one
+    name = models.CharField(max_length=255, unique=True)
+    refs = models.IntegerField(default=0)
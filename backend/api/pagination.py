@@ -0,0 +1,79 @@
+from django.conf import settings
+
+# keyset (cursor) pagination for message history
+# we page on the message id instead of using OFFSET, so fetching a page deep into a
+# room's history costs the same as fetching the newest one (index seek on (chat_room, id))
+
+
+def legacy_page_size():
+    # requests without any cursor (old clients) get at most one full page, newest first
+    return getattr(settings, "MESSAGE_PAGE_SIZE_MAX", 200)
+
+
+def set_cursor_headers(response, next_cursor, has_more):
+    # old clients get a plain list, where to continue is in the headers (pass it back as before_id)
+    response["X-Next-Cursor"] = "" if next_cursor is None else str(next_cursor)
+    response["X-Has-More"] = "true" if has_more else "false"
+    return response
+
+
+def get_page_size(requested_size):
+    default_size = getattr(settings, "MESSAGE_PAGE_SIZE", 50)
+    max_size = getattr(settings, "MESSAGE_PAGE_SIZE_MAX", 200)
+
+    if requested_size in (None, ""):
+        return default_size
+
+    page_size = int(requested_size)
+    if page_size < 1:
+        raise ValueError("page_size must be a positive integer")
+    return min(page_size, max_size)
+
+
+def _page_queryset(queryset, before_id, after_id, page_size):
+    # returns (queryset of page_size + 1 rows, page size, walking forwards)
+    if before_id not in (None, "") and after_id not in (None, ""):
+        raise ValueError("before_id and after_id cannot be used together")
+
+    page_size = get_page_size(page_size)
+
+    if after_id not in (None, ""):
+        # walking forwards
+        return queryset.filter(id__gt=int(after_id)).order_by("id")[: page_size + 1], page_size, True
+
+    # walking backwards from the newest message (or from before_id)
+    if before_id not in (None, ""):
+        queryset = queryset.filter(id__lt=int(before_id))
+    return queryset.order_by("-id")[: page_size + 1], page_size, False
+
+
+def _build_page(rows, page_size, after_id, forwards):
+    has_more = len(rows) > page_size
+    page = rows[:page_size]
+    if forwards:
+        next_cursor = page[-1].id if page else int(after_id)
+        return page, next_cursor, has_more
+
+    page.reverse()
+    next_cursor = page[0].id if (page and has_more) else None
+    return page, next_cursor, has_more
+
+
+def paginate_messages(queryset, before_id=None, after_id=None, page_size=None):
+    """
+    Returns (messages, next_cursor, has_more) for a Message queryset
+
+    - after_id: messages newer than after_id, oldest first (next_cursor is the newest id, pass it back as after_id)
+    - before_id: messages older than before_id (next_cursor is the oldest id, pass it back as before_id)
+    - neither: the newest page of the room, same cursor rules as before_id
+
+    messages are always returned in chronological order (ascending id)
+    """
+    page_queryset, page_size, forwards = _page_queryset(queryset, before_id, after_id, page_size)
+    return _build_page(list(page_queryset), page_size, after_id, forwards)
+
+
+async def apaginate_messages(queryset, before_id=None, after_id=None, page_size=None):
+    # paginate_messages for async views
+    page_queryset, page_size, forwards = _page_queryset(queryset, before_id, after_id, page_size)
+    return _build_page([message async for message in page_queryset], page_size, after_id, forwards)
@@ -0,0 +1,191 @@
+import asyncio
+import atexit
+import threading
+
+from api.dbwriter import run_write
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import OperationalError, transaction
+
+# write-behind persistence for the chat consumers
+# instead of every websocket message doing its own round trips to the db, messages are
+# buffered per process and written in batches by a background task
+
+
+class WriteBehindBuffer:
+    """
+    Buffers items in memory and hands them to write_batch() every flush_interval seconds,
+    or sooner once batch_size items are waiting. Subclasses implement write_batch()
+    """
+
+    def __init__(self, flush_interval, batch_size):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        # only one batch is written at a time so batches hit the db in the order they were queued
+        self._flush_lock = threading.Lock()
+
+        self._flush_task = None
+        self._flush_loop = None
+        self._wakeup = None
+
+        # whatever is still buffered when the process exits gets written
+        atexit.register(self.drain)
+
+    def add(self, item):
+        with self._pending_lock:
+            self._pending.append(item)
+            pending_count = len(self._pending)
+
+        self._ensure_flusher()
+        if pending_count >= self.batch_size and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending_count(self):
+        with self._pending_lock:
+            return len(self._pending)
+
+    def write_batch(self, items):
+        raise NotImplementedError
+
+    def flush_sync(self):
+        # runs in a db thread (or at exit), returns the number of items written
+        with self._flush_lock:
+            with self._pending_lock:
+                items, self._pending = self._pending, []
+
+            if not items:
+                return 0
+
+            try:
+                # on the single writer thread in the sqlite production mode (api/dbwriter.py)
+                run_write(self.write_batch, items)
+            except OperationalError:
+                # db locked / connection dropped, put the batch back in front so it is retried on the next flush
+                self._requeue(items)
+                raise
+            except Exception as e:
+                # one bad item (IntegrityError, DataError..) fails the whole batch, find it by writing them one by one
+                print(f"{type(self).__name__} batch failed, writing its items one by one:", e)
+                return self._write_one_by_one(items)
+            except BaseException:
+                self._requeue(items)
+                raise
+
+            return len(items)
+
+    def _requeue(self, items):
+        with self._pending_lock:
+            self._pending = items + self._pending
+
+    def _write_one_by_one(self, items):
+        written = 0
+        for index, item in enumerate(items):
+            try:
+                run_write(self.write_batch, [item])
+            except OperationalError:
+                # the db went away meanwhile, the rest is retried on the next flush
+                self._requeue(items[index:])
+                raise
+            except Exception as e:
+                # can never be written, dropped so it doesnt hold back everything queued after it
+                print(f"{type(self).__name__} dropped an item that cannot be written:", e, item)
+            except BaseException:
+                self._requeue(items[index:])
+                raise
+            else:
+                written += 1
+        return written
+
+    async def flush(self):
+        return await database_sync_to_async(self.flush_sync)()
+
+    def drain(self):
+        # flushes until the buffer is empty, used on shutdown
+        while self.pending_count():
+            self.flush_sync()
+
+    def _ensure_flusher(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (management command, shell etc), the caller has to flush
+            return
+
+        if (
+            self._flush_task is not None
+            and not self._flush_task.done()
+            and self._flush_loop is loop
+        ):
+            return
+
+        self._flush_loop = loop
+        self._wakeup = asyncio.Event()
+        self._flush_task = loop.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+            if not self.pending_count():
+                continue
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"{type(self).__name__} flush failed:", e)
+
+
+class MessageWriter(WriteBehindBuffer):
+    """
+    Batches chat messages into one bulk INSERT per flush, plus the room counter and
+    inbox UPDATEs for every room in the batch (api/inbox.py)
+    """
+
+    def write_batch(self, items):
+        from api.inbox import record_messages
+        from api.models import Message
+
+        with transaction.atomic():
+            messages = Message.objects.bulk_create(
+                [
+                    Message(
+                        chat_room_id=item["room_id"],
+                        sender_id=item["sender_id"],
+                        senderUsername=item["sender_username"],
+                        content=item["content"],
+                        signature=item["signature"],
+                        iv=item["iv"],
+                        delivery_id=item.get("delivery_id"),
+                    )
+                    for item in items
+                ]
+            )
+
+            # room counters and both members' inbox entries
+            record_messages(messages)
+
+        return messages
+
+
+_message_writer = None
+_message_writer_lock = threading.Lock()
+
+
+def get_message_writer():
+    global _message_writer
+
+    if _message_writer is None:
+        with _message_writer_lock:
+            if _message_writer is None:
+                _message_writer = MessageWriter(
+                    flush_interval=settings.MESSAGE_WRITER_FLUSH_INTERVAL,
+                    batch_size=settings.MESSAGE_WRITER_BATCH_SIZE,
+                )
+    return _message_writer
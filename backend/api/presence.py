@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# who is online, shared by every ChatConsumer
+# every websocket connection is registered under its channel name with an expiry time,
+# a user counts as online (in a room or at all) while at least one of their connections
+# is still alive, so closing one of 2 tabs does not mark the user offline.
+# a multiplexed connection is in several rooms, its user entry is kept per room it is in
+# and only goes away when it leaves the last one
+# connections refresh their expiry with heartbeat(), so a worker that dies without
+# running disconnect() only leaves stale entries behind for PRESENCE_TTL seconds
+
+
+class BasePresence:
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    async def join(self, room_id, user_id, connection_id):
+        raise NotImplementedError
+
+    async def leave(self, room_id, user_id, connection_id):
+        raise NotImplementedError
+
+    async def heartbeat(self, room_id, user_id, connection_id):
+        raise NotImplementedError
+
+    async def room_members(self, room_id):
+        # ids of the users with at least one live connection to the room
+        raise NotImplementedError
+
+    async def is_online(self, user_id):
+        raise NotImplementedError
+
+
+class InMemoryPresence(BasePresence):
+    """
+    Presence for a single process (runserver, tests, one daphne worker)
+    """
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self._rooms = {}  # room id -> {(user id, connection id): expires at}
+        self._users = {}  # user id -> {connection id: {room id: expires at}}
+        self._lock = threading.Lock()
+
+    def _touch(self, room_id, user_id, connection_id):
+        expires_at = time.monotonic() + self.ttl
+        with self._lock:
+            self._rooms.setdefault(room_id, {})[(user_id, connection_id)] = expires_at
+            self._users.setdefault(user_id, {}).setdefault(connection_id, {})[room_id] = expires_at
+
+    async def join(self, room_id, user_id, connection_id):
+        self._touch(room_id, user_id, connection_id)
+
+    async def heartbeat(self, room_id, user_id, connection_id):
+        self._touch(room_id, user_id, connection_id)
+
+    async def leave(self, room_id, user_id, connection_id):
+        with self._lock:
+            room = self._rooms.get(room_id, {})
+            room.pop((user_id, connection_id), None)
+            if not room:
+                self._rooms.pop(room_id, None)
+
+            connections = self._users.get(user_id, {})
+            rooms = connections.get(connection_id, {})
+            rooms.pop(room_id, None)
+            if not rooms:
+                connections.pop(connection_id, None)
+            if not connections:
+                self._users.pop(user_id, None)
+
+    async def room_members(self, room_id):
+        now = time.monotonic()
+        with self._lock:
+            room = self._rooms.get(room_id, {})
+            for key in [key for key, expires_at in room.items() if expires_at <= now]:
+                del room[key]
+            return sorted({user_id for user_id, _ in room})
+
+    async def is_online(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            connections = self._users.get(user_id, {})
+            return any(
+                expires_at > now
+                for rooms in connections.values()
+                for expires_at in rooms.values()
+            )
+
+
+class RedisPresence(BasePresence):
+    """
+    Presence shared by every worker, stored in the channel layer's redis
+
+    presence:room:<room id> is a sorted set of "<user id>:<connection id>" and
+    presence:user:<user id> a sorted set of "<connection id>:<room id>", both scored by expiry time
+    """
+
+    key_prefix = "presence"
+
+    def __init__(self, ttl, host=None):
+        super().__init__(ttl)
+        self.host = host or settings.CHANNEL_LAYERS["default"]["CONFIG"]["hosts"][0]
+        self._client = None
+        self._client_loop = None
+
+    def _get_client(self):
+        import redis.asyncio as redis
+
+        # redis.asyncio connections belong to the event loop they were made on
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._client_loop is not loop:
+            if isinstance(self.host, str):
+                self._client = redis.Redis.from_url(self.host)
+            elif isinstance(self.host, dict):
+                host = dict(self.host)
+                address = host.pop("address", None)
+                if address:
+                    self._client = redis.Redis.from_url(address, **host)
+                else:
+                    self._client = redis.Redis(**host)
+            else:
+                self._client = redis.Redis(host=self.host[0], port=self.host[1])
+            self._client_loop = loop
+        return self._client
+
+    def _room_key(self, room_id):
+        return f"{self.key_prefix}:room:{room_id}"
+
+    def _user_key(self, user_id):
+        return f"{self.key_prefix}:user:{user_id}"
+
+    async def _touch(self, room_id, user_id, connection_id):
+        now = time.time()
+        room_key = self._room_key(room_id)
+        user_key = self._user_key(user_id)
+
+        pipe = self._get_client().pipeline(transaction=False)
+        pipe.zadd(room_key, {f"{user_id}:{connection_id}": now + self.ttl})
+        pipe.zadd(user_key, {f"{connection_id}:{room_id}": now + self.ttl})
+        # the keys themselves go away once nobody refreshes them anymore
+        pipe.expire(room_key, int(self.ttl * 2))
+        pipe.expire(user_key, int(self.ttl * 2))
+        await pipe.execute()
+
+    async def join(self, room_id, user_id, connection_id):
+        await self._touch(room_id, user_id, connection_id)
+
+    async def heartbeat(self, room_id, user_id, connection_id):
+        await self._touch(room_id, user_id, connection_id)
+
+    async def leave(self, room_id, user_id, connection_id):
+        pipe = self._get_client().pipeline(transaction=False)
+        pipe.zrem(self._room_key(room_id), f"{user_id}:{connection_id}")
+        pipe.zrem(self._user_key(user_id), f"{connection_id}:{room_id}")
+        await pipe.execute()
+
+    async def room_members(self, room_id):
+        room_key = self._room_key(room_id)
+
+        pipe = self._get_client().pipeline(transaction=False)
+        pipe.zremrangebyscore(room_key, "-inf", time.time())
+        pipe.zrange(room_key, 0, -1)
+        _, members = await pipe.execute()
+
+        return sorted({int(member.split(b":", 1)[0]) for member in members})
+
+    async def is_online(self, user_id):
+        count = await self._get_client().zcount(
+            self._user_key(user_id), time.time(), "+inf"
+        )
+        return count > 0
+
+
+_presence = None
+
+
+def get_presence():
+    global _presence
+
+    if _presence is None:
+        backend = import_string(settings.PRESENCE_BACKEND)
+        _presence = backend(ttl=settings.PRESENCE_TTL)
+    return _presence
@@ -0,0 +1,67 @@
+import base64
+import binascii
+import json
+from urllib.parse import parse_qs
+
+import msgpack
+
+# wire format of the chat websocket
+# json text frames are the default, clients can ask for msgpack binary frames with the
+# "onionchat.msgpack" subprotocol or ?protocol=msgpack. In msgpack mode the ciphertext,
+# signature and iv fields (binary_fields, only these) travel as raw bytes instead of base64
+# strings. Inside the server (channel layer, db) they stay strings as json clients sent them,
+# json frames are never rewritten or rejected for their encoding, so json and msgpack clients
+# can share a room
+
+MSGPACK_SUBPROTOCOL = "onionchat.msgpack"
+
+binary_fields = (
+    "encrypted_message",
+    "message_signature",
+    "iv",
+    "file_signature",
+    "file_iv",
+    "signature",
+)
+
+
+def wants_msgpack(scope):
+    if MSGPACK_SUBPROTOCOL in scope.get("subprotocols", []):
+        return True
+    query = parse_qs(scope.get("query_string", b"").decode("utf8"))
+    return query.get("protocol", [""])[0] == "msgpack"
+
+
+def _to_bytes(value):
+    if not isinstance(value, str):
+        return value
+    try:
+        return base64.b64decode(value, validate=True)
+    except binascii.Error:
+        # json clients can use another encoding (hex, url safe or wrapped base64), it is theirs
+        # to decode and goes out as the string they sent
+        return value
+
+
+def encode(payload, use_msgpack):
+    # returns the kwargs for AsyncWebsocketConsumer.send
+    if not use_msgpack:
+        return {"text_data": json.dumps(payload)}
+
+    payload = {
+        key: _to_bytes(value) if key in binary_fields else value
+        for key, value in payload.items()
+    }
+    return {"bytes_data": msgpack.packb(payload, use_bin_type=True)}
+
+
+def decode_msgpack(frame):
+    # msgpack frame -> the same dict a json client would have sent (upload chunk data stays bytes)
+    payload = msgpack.unpackb(frame, raw=False)
+    if not isinstance(payload, dict):
+        raise ValueError("Frame is not a map")
+
+    for key in binary_fields:
+        if isinstance(payload.get(key), bytes):
+            payload[key] = base64.b64encode(payload[key]).decode("ascii")
+    return payload
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import time
+
+from api.cache import TTLCache
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import quote_etag
+
+# batch public key lookups (get_public_keys view)
+# username -> {"public_key", "version"}, the version is a hash of the key so clients can
+# tell which keys changed. set_public writes the new key through, the AppUser post_save
+# handler (api/signals.py) drops the entry on any other change
+#
+# the entries are per process (username -> (cached at, entry)). a change is also published in
+# django's cache as the time it committed, the other workers drop what they cached before it on
+# their next lookup. that needs a cache shared by the workers (CACHE_REDIS_URL, like the replica
+# pins of api/routers.py), with the default local memory cache the other workers only see the
+# change once their entry expires (PUBLIC_KEY_CACHE_TTL)
+public_key_cache = TTLCache(
+    "public_keys",
+    maxsize=settings.PUBLIC_KEY_CACHE_SIZE,
+    ttl=settings.PUBLIC_KEY_CACHE_TTL,
+)
+
+
+def key_version(public_key):
+    if public_key is None:
+        return None
+    return hashlib.sha256(public_key.encode()).hexdigest()[:16]
+
+
+def key_entry(public_key):
+    return {"public_key": public_key, "version": key_version(public_key)}
+
+
+def lookup_public_keys(usernames):
+    """
+    Returns {username: {"public_key", "version"}} for the usernames that exist,
+    the ones that are not cached are read with one query
+    """
+    from api.models import AppUser
+
+    keys = {}
+    missing = []
+    cached = {}
+    for username in usernames:
+        hit = public_key_cache.get(username)
+        if hit is None:
+            missing.append(username)
+        else:
+            cached[username] = hit
+
+    if cached:
+        # one round trip for the change times of all the cached keys
+        changed = cache.get_many([changed_key(username) for username in cached])
+        for username, (cached_at, entry) in cached.items():
+            changed_at = changed.get(changed_key(username))
+            if changed_at is not None and changed_at > cached_at:
+                missing.append(username)
+            else:
+                keys[username] = entry
+
+    if missing:
+        cached_at = time.time()
+        for username, public_key in AppUser.objects.filter(
+            username__in=missing
+        ).values_list("username", "public_key"):
+            entry = key_entry(public_key)
+            public_key_cache.set(username, (cached_at, entry))
+            keys[username] = entry
+
+    return keys
+
+
+def keys_etag(keys):
+    # one ETag for the whole answer, changes when any key (or the set of users) changes
+    versions = sorted((username, entry["version"]) for username, entry in keys.items())
+    return quote_etag(hashlib.sha256(json.dumps(versions).encode()).hexdigest()[:32])
+
+
+def changed_key(username):
+    return f"public_key_changed:{username}"
+
+
+def set_cached_public_key(username, public_key):
+    public_key_cache.set(username, (time.time(), key_entry(public_key)))
+
+
+def publish_public_key_change(username):
+    # kept as long as an entry cached before the change can live
+    cache.set(changed_key(username), time.time(), settings.PUBLIC_KEY_CACHE_TTL)
+
+
+def invalidate_public_key(username):
+    public_key_cache.delete(username)
+    # after the commit, a worker reading the user before that would cache the old key again
+    transaction.on_commit(lambda: publish_public_key_change(username))
@@ -0,0 +1,108 @@
+import contextvars
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+
+# primary / read replica routing (DATABASE_REPLICA_URLS in settings.py)
+# writes always go to the primary. reads only go to a replica inside the read only endpoints
+# (settings.REPLICA_READ_VIEWS, marked by ReplicaRoutingMiddleware) for an authenticated user.
+# a user who wrote something in the last REPLICA_STICKY_SECONDS reads from the primary, so
+# they always see their own writes even when the replicas lag behind
+
+_request_state = contextvars.ContextVar("db_request_state", default=None)
+
+
+class RequestState:
+    def __init__(self, request, replica_reads):
+        self.request = request
+        self.replica_reads = replica_reads
+        self.replica = None
+        self.pinned = None  # None until the user is known
+        self.wrote = False
+
+    def user_id(self):
+        # request.user is replaced by the DRF authentication (or async_api_view), until then it is
+        # django's lazy session user, we dont evaluate it here (it would query the db)
+        user = self.request.__dict__.get("user")
+        if user is None or isinstance(user, SimpleLazyObject) or not user.is_authenticated:
+            return None
+        return user.id
+
+
+def pin_key(user_id):
+    return f"db_primary:{user_id}"
+
+
+def pin_to_primary(user_id):
+    # the cache is shared between workers when CACHE_REDIS_URL is set
+    if settings.DATABASE_REPLICAS:
+        cache.set(pin_key(user_id), True, settings.REPLICA_STICKY_SECONDS)
+
+
+async def apin_to_primary(user_id, seconds=None):
+    if settings.DATABASE_REPLICAS:
+        await cache.aset(
+            pin_key(user_id), True, seconds or settings.REPLICA_STICKY_SECONDS
+        )
+
+
+def start_request(request, replica_reads):
+    # returns the token for end_request, called by ReplicaRoutingMiddleware
+    return _request_state.set(RequestState(request, replica_reads))
+
+
+def end_request(token):
+    _request_state.reset(token)
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS:
+            return None
+
+        state = _request_state.get()
+        if state is None or not state.replica_reads or state.wrote:
+            return "default"
+
+        if state.pinned is None:
+            user_id = state.user_id()
+            if user_id is None:
+                # token lookup etc before the user is known
+                return "default"
+            state.pinned = bool(cache.get(pin_key(user_id)))
+        if state.pinned:
+            return "default"
+
+        # one replica per request, its reads see one consistent snapshot
+        if state.replica is None:
+            state.replica = random.choice(settings.DATABASE_REPLICAS)
+        return state.replica
+
+    def db_for_write(self, model, **hints):
+        if not settings.DATABASE_REPLICAS:
+            return None
+
+        state = _request_state.get()
+        if state is not None and not state.wrote:
+            # the rest of this request and the user's next requests read from the primary
+            state.wrote = True
+            user_id = state.user_id()
+            if user_id is not None:
+                pin_to_primary(user_id)
+        # also for objects that were read from a replica
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if not settings.DATABASE_REPLICAS:
+            return None
+        # the replicas hold the same data as the primary
+        databases = {"default", *settings.DATABASE_REPLICAS}
+        return obj1._state.db in databases and obj2._state.db in databases
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas get the schema from the primary
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
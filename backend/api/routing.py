@@ -2,4 +2,8 @@ from django.urls import path
 
 from . import consumers  # your WebSocket consumer
 
-url_patterns = [path("ws/chat/<int:roomNum>/", consumers.ChatConsumer.as_asgi())]
+url_patterns = [
+    # one connection per user for all of their rooms
+    path("ws/chat/", consumers.MultiplexChatConsumer.as_asgi()),
+    path("ws/chat/<int:roomNum>/", consumers.ChatConsumer.as_asgi()),
+]
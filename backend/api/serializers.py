@@ -1,6 +1,6 @@
 import os
 
-from api.models import AppUser, ChatRoom, Friendship, Message
+from api.models import AppUser, ChatRoom, Friendship, InboxEntry, Message
 from django.contrib.auth.hashers import make_password
 from rest_framework import serializers
 
@@ -119,3 +119,34 @@ class FriendshipSerializer(serializers.ModelSerializer):
 
     def get_to_user_name(self, obj):
         return obj.to_user.username if obj.to_user else None
+
+
+class InboxEntrySerializer(serializers.ModelSerializer):
+    # pass context={"user_id": ..} so the other member of the room can be returned
+    chatroom_id = serializers.IntegerField(source="chat_room_id")
+    other_user = serializers.SerializerMethodField()
+    other_username = serializers.SerializerMethodField()
+
+    class Meta:
+        model = InboxEntry
+        fields = [
+            "chatroom_id",
+            "other_user",
+            "other_username",
+            "last_message_id",
+            "last_message_time",
+            "last_read_message_id",
+            "unread_count",
+        ]
+
+    def get_other_member(self, obj):
+        chat_room = obj.chat_room
+        if chat_room.user1_id == self.context["user_id"]:
+            return chat_room.user2
+        return chat_room.user1
+
+    def get_other_user(self, obj):
+        return self.get_other_member(obj).id
+
+    def get_other_username(self, obj):
+        return self.get_other_member(obj).username
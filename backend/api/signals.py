@@ -0,0 +1,64 @@
+from api.authentication import invalidate_token, invalidate_user_tokens
+from api.authz import invalidate_friends
+from api.inbox import create_inbox_entries
+from api.lookups import invalidate_room, invalidate_user
+from api.public_keys import invalidate_public_key
+from api.storage import release_blob
+from api.models import AppUser, ChatRoom, Friendship, Message
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+# keeps the in-process caches in line with the db
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=Token)
+def token_saved(sender, instance, created, **kwargs):
+    # a rotated token is a new key for the same user, drop whatever was cached for that user
+    invalidate_user_tokens(instance.user_id)
+
+
+@receiver(post_save, sender=AppUser)
+@receiver(post_delete, sender=AppUser)
+def user_changed(sender, instance, **kwargs):
+    # cached users would otherwise keep an old is_active / public_key etc
+    invalidate_user_tokens(instance.id)
+    invalidate_user(instance.id)
+    invalidate_public_key(instance.username)
+
+
+@receiver(post_save, sender=ChatRoom)
+@receiver(post_delete, sender=ChatRoom)
+def chatroom_changed(sender, instance, **kwargs):
+    invalidate_room(instance.id)
+
+
+@receiver(post_save, sender=Friendship)
+@receiver(post_delete, sender=Friendship)
+def friendship_changed(sender, instance, **kwargs):
+    # sent / accepted / rejected requests change who may chat with whom
+    invalidate_friends(instance.from_user_id, instance.to_user_id)
+
+
+@receiver(post_save, sender=ChatRoom)
+def chatroom_created(sender, instance, created, **kwargs):
+    # both members get their (empty) inbox entry with the room
+    if created:
+        create_inbox_entries([instance])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    # uploaded blobs are shared (api/storage.py), only remove the file when no message uses it anymore
+    name = instance.fileData.name
+    if not name:
+        return
+
+    storage = instance.fileData.storage
+    transaction.on_commit(lambda: release_blob(storage, name))
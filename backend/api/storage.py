@@ -0,0 +1,87 @@
+import hashlib
+import os
+import re
+
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# content addressed storage for uploaded files
+# a file is stored as <upload dir>/ab/cd/abcdef...<ext> where abcdef... is the sha256 of its content,
+# so the same encrypted blob uploaded (forwarded) several times is only written to disk once.
+# Message.fileData rows point at the blob, it is removed when the last one is deleted (see api/signals.py)
+#
+# the messages of a blob are counted in api.models.Blob. an upload claims the blob before looking
+# for the file and a delete removes the file with the row still locked, so an upload of the same
+# content either keeps the file or waits and writes it again. a message that is never saved after
+# its upload leaves the count one too high, which only keeps the file
+
+blob_name_pattern = re.compile(r"(^|/)[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}[^/]*$")
+
+
+class BlobExists(Exception):
+    pass
+
+
+def claim_blob(name):
+    from api.models import Blob
+
+    with transaction.atomic():
+        if Blob.objects.filter(name=name).update(refs=F("refs") + 1):
+            return
+        try:
+            with transaction.atomic():
+                Blob.objects.create(name=name, refs=1)
+        except IntegrityError:
+            # created by a concurrent upload of the same content
+            Blob.objects.filter(name=name).update(refs=F("refs") + 1)
+
+
+def release_blob(storage, name):
+    from api.models import Blob
+
+    with transaction.atomic():
+        # locks the row until commit, a claim_blob for the same name waits for the file delete
+        Blob.objects.filter(name=name).update(refs=F("refs") - 1)
+        if Blob.objects.filter(name=name, refs__lte=0).delete()[0]:
+            storage.delete(name)
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def content_hash(self, content):
+        digest = hashlib.sha256()
+        if hasattr(content, "temporary_file_path"):
+            with open(content.temporary_file_path(), "rb") as fh:
+                for block in iter(lambda: fh.read(1024 * 1024), b""):
+                    digest.update(block)
+        else:
+            for chunk in content.chunks():
+                # the websocket upload stores the base64 text as is, FileSystemStorage writes it as utf-8
+                digest.update(chunk.encode() if isinstance(chunk, str) else chunk)
+        return digest.hexdigest()
+
+    def blob_name(self, name, digest):
+        directory, file_name = os.path.split(name)
+        _, extension = os.path.splitext(file_name)
+        return os.path.join(directory, digest[:2], digest[2:4], f"{digest}{extension.lower()}")
+
+    def get_available_name(self, name, max_length=None):
+        # names are picked from the content in _save, so there is nothing to rename,
+        # an existing blob with the same name already has the same bytes
+        if blob_name_pattern.search(name) and self.exists(name):
+            raise BlobExists(name)
+        return name
+
+    def _save(self, name, content):
+        name = self.blob_name(name, self.content_hash(content))
+        claim_blob(name)
+
+        if self.exists(name):
+            # already stored, nothing to write
+            return name
+
+        try:
+            return super()._save(name, content)
+        except BlobExists:
+            # someone else stored the same content while we were writing
+            return name
@@ -0,0 +1,111 @@
+import datetime
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+# delta sync for clients coming back online
+# instead of get_chatrooms + the full history of every room, the client keeps a watermark:
+# the id of the newest message it has (message ids only grow) and the server time of its
+# last sync. one call returns the new messages of all its rooms (oldest first, bounded, keep
+# calling while has_more) plus the rooms and friendships that changed since that time
+#
+# ids and timestamps are taken before the writing transaction commits, concurrent writers can
+# commit out of order (message 11 visible while 10 is still being written). so the watermarks
+# are held back by SYNC_LOOKBACK_SECONDS: next_message_id never passes a message newer than that
+# and "since" re-reads that window. rows in the window can be returned twice, clients merge by id
+
+
+def get_sync_limit(requested_limit):
+    if requested_limit in (None, ""):
+        return settings.SYNC_PAGE_SIZE
+
+    limit = int(requested_limit)
+    if limit < 1:
+        raise ValueError("limit must be a positive integer")
+    return min(limit, settings.SYNC_PAGE_SIZE_MAX)
+
+
+def parse_since(since):
+    if since in (None, ""):
+        return None
+    parsed = parse_datetime(str(since))
+    if parsed is None:
+        raise ValueError("since must be an ISO 8601 datetime")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+def settled_message_id(room_ids, server_time):
+    # newest message of the rooms stamped before the lookback window, a watermark (next_message_id,
+    # bootstrap's last_message_id) up to it cant skip a message that is still committing
+    from api.models import Message
+
+    settled = server_time - datetime.timedelta(seconds=settings.SYNC_LOOKBACK_SECONDS)
+    newest = Message.objects.filter(chat_room__in=room_ids, timestamp__lt=settled).aggregate(
+        newest=Max("id")
+    )["newest"]
+    return newest or 0
+
+
+def sync_changes(user, since_message_id=None, since=None, limit=None):
+    """
+    Returns (messages, chatrooms, friendships, next_message_id, has_more, server_time)
+
+    - since_message_id: newest message id the client has, None for a first sync which returns
+      no messages, only the watermark to start from
+    - since: server_time of the previous sync, rooms/friendships changed after it are returned
+      (all of them when None)
+    """
+    from api.models import ChatRoom, Friendship, Message
+
+    limit = get_sync_limit(limit)
+    since = parse_since(since)
+    # taken before reading, anything changing while we read is returned again next time
+    server_time = timezone.now()
+    lookback = datetime.timedelta(seconds=settings.SYNC_LOOKBACK_SECONDS)
+    # messages stamped before this have committed, a watermark up to them skips nothing
+    settled = server_time - lookback
+
+    member_rooms = ChatRoom.objects.filter(Q(user1=user) | Q(user2=user))
+    rooms = member_rooms
+    friendships = Friendship.objects.filter(Q(from_user=user) | Q(to_user=user))
+    if since is not None:
+        rooms = rooms.filter(updated_at__gt=since - lookback)
+        friendships = friendships.filter(updated_at__gt=since - lookback)
+
+    if since_message_id in (None, ""):
+        messages = []
+        has_more = False
+        next_message_id = settled_message_id(member_rooms.values("id"), server_time)
+    else:
+        since_message_id = int(since_message_id)
+        # one range scan per room on the (chat_room, id) index
+        messages = list(
+            Message.objects.filter(
+                chat_room__in=member_rooms.values("id"),
+                id__gt=since_message_id,
+            ).order_by("id")[: limit + 1]
+        )
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+        # up to the first message that could still have an older one committing behind it,
+        # the ones after it are sent now and again next time
+        next_message_id = since_message_id
+        for message in messages:
+            if message.timestamp >= settled:
+                break
+            next_message_id = message.id
+        # a page that is all in the window would be returned again, the next sync gets the rest
+        has_more = has_more and next_message_id > since_message_id
+
+    return (
+        messages,
+        list(rooms.select_related("user1", "user2")),
+        list(friendships.select_related("from_user", "to_user")),
+        next_message_id,
+        has_more,
+        server_time,
+    )
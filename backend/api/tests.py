@@ -1,3 +1,1757 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from unittest import mock
+
+import fakeredis
+import msgpack
+from api import uploads
+from api.authentication import token_cache
+from api.authz import cached_room_access, can_use_room, friends_cache, get_friend_ids
+from api.consumers import ChatConsumer
+from api.dbwriter import DBWriter
+from api.inbox import record_messages
+from api.last_seen import LastSeenWriter, get_last_seen_writer
+from api.lookups import get_room_info, room_cache
+from api.media import media_response
+from api.middleware import ReplicaRoutingMiddleware
+from api.models import AppUser, Blob, ChatRoom, Friendship, InboxEntry, Message
+from api.persistence import MessageWriter, WriteBehindBuffer, get_message_writer
+from api.presence import InMemoryPresence, RedisPresence
+from api.public_keys import (
+    changed_key,
+    lookup_public_keys,
+    public_key_cache,
+    publish_public_key_change,
+)
+from api.protocol import decode_msgpack, encode
+from api.routers import PrimaryReplicaRouter
+from api.typing_indicators import TypingState
+from backend.asgi import application
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
 
 # Create your tests here.
+
+
+class ListQueryCountTests(APITestCase):
+    # the list endpoints have to run the same number of queries no matter how many rows they return
+
+    def setUp(self):
+        self.user = AppUser.objects.create(username="queryuser")
+        self.client.force_authenticate(user=self.user)
+        self.others = []
+
+    def add_users(self, count):
+        start = len(self.others)
+        for i in range(start, start + count):
+            self.others.append(
+                AppUser.objects.create(username=f"otheruser{i}")
+            )
+        return self.others[start:]
+
+    def add_room(self, other):
+        user1, user2 = ChatRoom.canonical_pair(self.user, other)
+        return ChatRoom.objects.create(user1=user1, user2=user2)
+
+    def count_queries(self, method, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data
+
+    def test_get_chatrooms_query_count(self):
+        for other in self.add_users(1):
+            self.add_room(other)
+        one_room_queries, data = self.count_queries("get", "/api/get_chatrooms")
+        self.assertEqual(len(data), 1)
+
+        for other in self.add_users(10):
+            self.add_room(other)
+        many_room_queries, data = self.count_queries("get", "/api/get_chatrooms")
+        self.assertEqual(len(data), 11)
+        self.assertEqual(many_room_queries, one_room_queries)
+        self.assertTrue(all(room["username_1"] and room["username_2"] for room in data))
+
+    def test_get_friends_query_count(self):
+        for other in self.add_users(1):
+            Friendship.objects.create(from_user=other, to_user=self.user, status="accepted")
+        one_friend_queries, data = self.count_queries("get", "/api/get_friends/")
+        self.assertEqual(len(data), 1)
+
+        for i, other in enumerate(self.add_users(10)):
+            # friendships in both directions
+            if i % 2:
+                Friendship.objects.create(from_user=other, to_user=self.user, status="accepted")
+            else:
+                Friendship.objects.create(from_user=self.user, to_user=other, status="accepted")
+        many_friend_queries, data = self.count_queries("get", "/api/get_friends/")
+        self.assertEqual(len(data), 11)
+        self.assertEqual(many_friend_queries, one_friend_queries)
+        self.assertTrue(all(f["from_user_name"] and f["to_user_name"] for f in data))
+
+    def test_get_pending_friends_query_count(self):
+        for other in self.add_users(1):
+            Friendship.objects.create(from_user=other, to_user=self.user)
+        one_pending_queries, data = self.count_queries("get", "/api/get_pending_friends/")
+        self.assertEqual(len(data), 1)
+
+        for other in self.add_users(10):
+            Friendship.objects.create(from_user=other, to_user=self.user)
+        many_pending_queries, data = self.count_queries("get", "/api/get_pending_friends/")
+        self.assertEqual(len(data), 11)
+        self.assertEqual(many_pending_queries, one_pending_queries)
+
+    def test_bootstrap_query_count(self):
+        def add_friends(count):
+            for i, other in enumerate(self.add_users(count)):
+                other.public_key = f"key-{other.username}"
+                other.save()
+                self.add_room(other)
+                if i % 2:
+                    Friendship.objects.create(
+                        from_user=other,
+                        to_user=self.user,
+                        status="accepted",
+                        to_user_SK=f"sk-{other.id}",
+                    )
+                else:
+                    Friendship.objects.create(
+                        from_user=self.user,
+                        to_user=other,
+                        status="accepted",
+                        from_user_SK=f"sk-{other.id}",
+                    )
+            for other in self.add_users(count):
+                Friendship.objects.create(from_user=other, to_user=self.user)
+
+        add_friends(1)
+        few_queries, data = self.count_queries("get", "/api/bootstrap/")
+        self.assertEqual((len(data["friends"]), len(data["pending_friends"])), (1, 1))
+
+        add_friends(10)
+        many_queries, data = self.count_queries("get", "/api/bootstrap/")
+        self.assertEqual(many_queries, few_queries)
+        # token auth is mocked by force_authenticate, these are the bootstrap queries only
+        self.assertEqual(many_queries, 4)
+        self.assertEqual(len(data["friends"]), 11)
+        self.assertEqual(len(data["pending_friends"]), 11)
+        self.assertEqual(len(data["chatrooms"]), 11)
+        self.assertEqual(len(data["inbox"]), 11)
+        self.assertEqual(len(data["last_online"]), 11)
+        # friends and the users who sent a request
+        self.assertEqual(len(data["public_keys"]), 22)
+        friend = self.others[0]
+        self.assertEqual(
+            data["public_keys"][friend.username]["public_key"], f"key-{friend.username}"
+        )
+        self.assertEqual(data["session_keys"][friend.username], f"sk-{friend.id}")
+        self.assertEqual(data["session_keys"][self.others[3].username], f"sk-{self.others[3].id}")
+
+
+class AsyncViewTests(APITestCase):
+    # the async views (api/async_views.py) have to answer exactly like the DRF ones
+
+    def setUp(self):
+        self.user = AppUser.objects.create(username="asyncuser", public_key="key-1")
+        self.friend = AppUser.objects.create(username="asyncfriend", public_key="key-2")
+        self.pending = AppUser.objects.create(username="asyncpending")
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+
+        Friendship.objects.create(
+            from_user=self.user,
+            to_user=self.friend,
+            status="accepted",
+            from_user_SK="sk-user",
+            to_user_SK="sk-friend",
+        )
+        Friendship.objects.create(from_user=self.pending, to_user=self.user)
+        user1, user2 = ChatRoom.canonical_pair(self.user, self.friend)
+        self.room = ChatRoom.objects.create(user1=user1, user2=user2)
+        for i in range(5):
+            Message.objects.create(
+                chat_room=self.room, sender=self.friend, content=f"message {i}"
+            )
+
+    def assertSameResponse(self, method, name, data=None):
+        sync_response = getattr(self.client, method)(f"/api/{name}/", data, format="json")
+        async_response = getattr(self.client, method)(
+            f"/api/async/{name}/", data, format="json"
+        )
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        if sync_response.content:
+            self.assertEqual(async_response.json(), sync_response.json())
+
+    def test_responses_match_sync_views(self):
+        self.assertSameResponse("get", "get_chatrooms")
+        self.assertSameResponse("get", "get_friends")
+        self.assertSameResponse("get", "get_pending_friends")
+        self.assertSameResponse("post", "get_messages_from_db", {"chatroom_id": self.room.id})
+        self.assertSameResponse(
+            "post", "get_messages_from_db", {"chatroom_id": self.room.id, "page_size": 2}
+        )
+        self.assertSameResponse("post", "get_public", {"get_username": "asyncfriend"})
+        self.assertSameResponse("post", "get_public", {"get_username": "nobody"})
+        self.assertSameResponse("post", "get_user_SK", {"friend_username": "asyncfriend"})
+        self.assertSameResponse("post", "get_user_SK", {"friend_username": "asyncpending"})
+
+    def test_requires_token(self):
+        self.client.credentials()
+        response = self.client.get("/api/async/get_chatrooms/")
+        self.assertEqual(response.status_code, 401)
+
+        self.client.credentials(HTTP_AUTHORIZATION="Token invalid")
+        response = self.client.get("/api/async/get_chatrooms/")
+        self.assertEqual(response.status_code, 401)
+
+
+class MessageHistoryTests(APITestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create(username="historyuser")
+        self.friend = AppUser.objects.create(username="historyfriend")
+        self.client.force_authenticate(user=self.user)
+        self.room = ChatRoom.objects.create(user1=self.user, user2=self.friend)
+        self.messages = [
+            Message.objects.create(chat_room=self.room, sender=self.user, content=f"message {i}")
+            for i in range(7)
+        ]
+        self.ids = [message.id for message in self.messages]
+
+    def history(self, **data):
+        response = self.client.post(
+            "/api/get_messages_from_db/", {"chatroom_id": self.room.id, **data}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_cursor_boundaries(self):
+        data = self.history(page_size=3).data
+        self.assertEqual([m["id"] for m in data["messages"]], self.ids[4:])
+        self.assertEqual(data["next_cursor"], self.ids[4])
+        self.assertTrue(data["has_more"])
+
+        # the cursor message itself is not returned again
+        data = self.history(page_size=3, before_id=data["next_cursor"]).data
+        self.assertEqual([m["id"] for m in data["messages"]], self.ids[1:4])
+        self.assertTrue(data["has_more"])
+
+        # exactly the last page
+        data = self.history(page_size=1, before_id=data["next_cursor"]).data
+        self.assertEqual([m["id"] for m in data["messages"]], self.ids[:1])
+        self.assertFalse(data["has_more"])
+        self.assertIsNone(data["next_cursor"])
+
+        data = self.history(page_size=3, after_id=self.ids[3]).data
+        self.assertEqual([m["id"] for m in data["messages"]], self.ids[4:])
+        self.assertEqual(data["next_cursor"], self.ids[-1])
+        self.assertFalse(data["has_more"])
+
+    def test_equal_timestamps_keep_a_stable_order(self):
+        Message.objects.filter(chat_room=self.room).update(timestamp=timezone.now())
+
+        seen = []
+        before_id = None
+        while True:
+            cursor = {"before_id": before_id} if before_id else {}
+            data = self.history(page_size=2, **cursor).data
+            seen = [m["id"] for m in data["messages"]] + seen
+            if not data["has_more"]:
+                break
+            before_id = data["next_cursor"]
+        self.assertEqual(seen, self.ids)
+
+    @override_settings(MESSAGE_PAGE_SIZE_MAX=5)
+    def test_request_without_cursor_is_capped(self):
+        response = self.history()
+        self.assertEqual([m["id"] for m in response.data], self.ids[2:])
+        self.assertEqual(response["X-Has-More"], "true")
+        self.assertEqual(response["X-Next-Cursor"], str(self.ids[2]))
+
+        # the async views do their own token authentication
+        token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {token.key}")
+        response = self.client.post(
+            "/api/async/get_messages_from_db/", {"chatroom_id": self.room.id}, format="json"
+        )
+        self.assertEqual([m["id"] for m in response.json()], self.ids[2:])
+        self.assertEqual(response["X-Next-Cursor"], str(self.ids[2]))
+
+
+# no lookback, the messages and changes made in a test are already settled
+@override_settings(SYNC_LOOKBACK_SECONDS=0)
+class SyncTests(APITestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create(username="syncuser")
+        self.friend = AppUser.objects.create(username="syncfriend")
+        self.stranger = AppUser.objects.create(username="syncstranger")
+        self.client.force_authenticate(user=self.user)
+
+        self.room = self.add_room(self.user, self.friend)
+        self.other_room = self.add_room(self.friend, self.stranger)
+        self.friendship = Friendship.objects.create(
+            from_user=self.friend, to_user=self.user, status="accepted"
+        )
+
+    def add_room(self, user1, user2):
+        user1, user2 = ChatRoom.canonical_pair(user1, user2)
+        return ChatRoom.objects.create(user1=user1, user2=user2)
+
+    def add_messages(self, room, count):
+        return [
+            Message.objects.create(chat_room=room, sender=room.user1, content=f"message {i}")
+            for i in range(count)
+        ]
+
+    def sync(self, **data):
+        response = self.client.post("/api/sync/", data, format="json")
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_first_sync_returns_watermark(self):
+        messages = self.add_messages(self.room, 3)
+        self.add_messages(self.other_room, 2)
+
+        data = self.sync()
+        self.assertEqual(data["messages"], [])
+        self.assertEqual(data["next_message_id"], messages[-1].id)
+        self.assertEqual([room["id"] for room in data["chatrooms"]], [self.room.id])
+        self.assertEqual([f["id"] for f in data["friendships"]], [self.friendship.id])
+
+    def test_only_new_messages_of_own_rooms(self):
+        watermark = self.sync()["next_message_id"]
+        new_messages = self.add_messages(self.room, 5)
+        self.add_messages(self.other_room, 5)
+
+        data = self.sync(since_message_id=watermark, limit=3)
+        self.assertEqual([m["id"] for m in data["messages"]], [m.id for m in new_messages[:3]])
+        self.assertTrue(data["has_more"])
+
+        data = self.sync(since_message_id=data["next_message_id"], limit=3)
+        self.assertEqual([m["id"] for m in data["messages"]], [m.id for m in new_messages[3:]])
+        self.assertFalse(data["has_more"])
+
+    def test_changed_rooms_and_friendships_since(self):
+        first = self.sync()
+        data = self.sync(since_message_id=first["next_message_id"], since=first["server_time"])
+        self.assertEqual(data["chatrooms"], [])
+        self.assertEqual(data["friendships"], [])
+
+        self.friendship.status = "rejected"
+        self.friendship.save()
+        data = self.sync(since_message_id=first["next_message_id"], since=first["server_time"])
+        self.assertEqual([f["id"] for f in data["friendships"]], [self.friendship.id])
+        self.assertEqual(data["chatrooms"], [])
+
+    @override_settings(SYNC_LOOKBACK_SECONDS=5)
+    def test_late_commit_is_not_skipped(self):
+        (old,) = self.add_messages(self.room, 1)
+        Message.objects.filter(id=old.id).update(timestamp=timezone.now() - timedelta(minutes=1))
+        # the second message got its id first but commits after the third one is visible
+        late, visible = self.add_messages(self.room, 2)
+        late_id = late.id
+        late.delete()
+
+        data = self.sync(since_message_id=old.id - 1)
+        self.assertEqual([m["id"] for m in data["messages"]], [old.id, visible.id])
+        self.assertEqual(data["next_message_id"], old.id)
+
+        Message.objects.create(id=late_id, chat_room=self.room, sender=self.user, content="late")
+        data = self.sync(since_message_id=data["next_message_id"])
+        self.assertEqual([m["id"] for m in data["messages"]], [late_id, visible.id])
+
+    @override_settings(SYNC_LOOKBACK_SECONDS=5)
+    def test_change_committed_after_sync_is_returned(self):
+        first = self.sync()
+        # stamped before the first sync read, committed after it
+        Friendship.objects.filter(id=self.friendship.id).update(
+            status="rejected", updated_at=first["server_time"] - timedelta(seconds=1)
+        )
+        data = self.sync(since_message_id=first["next_message_id"], since=first["server_time"])
+        self.assertEqual([f["id"] for f in data["friendships"]], [self.friendship.id])
+
+    @override_settings(SYNC_LOOKBACK_SECONDS=5)
+    def test_bootstrap_watermark_is_held_back(self):
+        settled, recent = self.add_messages(self.room, 2)
+        Message.objects.filter(id=settled.id).update(
+            timestamp=timezone.now() - timedelta(minutes=1)
+        )
+        response = self.client.get("/api/bootstrap/")
+        # the same watermark a first sync gives, not the newest message
+        self.assertEqual(response.data["last_message_id"], settled.id)
+        self.assertEqual(self.sync()["next_message_id"], settled.id)
+
+    def test_invalid_watermark(self):
+        response = self.client.post("/api/sync/", {"since": "yesterday"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class InboxTests(APITestCase):
+    def setUp(self):
+        self.user = AppUser.objects.create(username="inboxuser")
+        self.client.force_authenticate(user=self.user)
+        self.friends = [AppUser.objects.create(username=f"inboxfriend{i}") for i in range(3)]
+        self.rooms = []
+        for friend in self.friends:
+            user1, user2 = ChatRoom.canonical_pair(self.user, friend)
+            self.rooms.append(ChatRoom.objects.create(user1=user1, user2=user2))
+
+    def write_messages(self, room, sender, count):
+        items = [
+            {
+                "room_id": room.id,
+                "sender_id": sender.id,
+                "sender_username": sender.username,
+                "content": "message",
+                "signature": "signature",
+                "iv": "iv",
+            }
+            for _ in range(count)
+        ]
+        return get_message_writer().write_batch(items)
+
+    def test_inbox_sorted_by_activity_with_unread_counts(self):
+        self.write_messages(self.rooms[0], self.friends[0], 2)
+        self.write_messages(self.rooms[2], self.user, 1)
+        messages = self.write_messages(self.rooms[1], self.friends[1], 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/get_inbox/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+
+        self.assertEqual(
+            [(e["chatroom_id"], e["unread_count"]) for e in response.data],
+            [(self.rooms[1].id, 3), (self.rooms[2].id, 0), (self.rooms[0].id, 2)],
+        )
+        self.assertEqual(response.data[0]["last_message_id"], messages[-1].id)
+        self.assertEqual(response.data[0]["other_username"], "inboxfriend1")
+
+        # the sender of the messages has nothing unread
+        entry = InboxEntry.objects.get(user=self.friends[1], chat_room=self.rooms[1])
+        self.assertEqual(entry.unread_count, 0)
+        self.assertEqual(ChatRoom.objects.get(id=self.rooms[1].id).numOfMessages, 3)
+
+    def test_late_batch_does_not_move_last_message_back(self):
+        older, newer = self.write_messages(self.rooms[0], self.friends[0], 2)
+        Message.objects.filter(id=older.id).update(timestamp=newer.timestamp - timedelta(seconds=1))
+        older.refresh_from_db()
+        # the batch of another writer with the older message commits last
+        record_messages([older])
+
+        entry = InboxEntry.objects.get(user=self.user, chat_room=self.rooms[0])
+        self.assertEqual(
+            (entry.last_message_id, entry.last_message_time), (newer.id, newer.timestamp)
+        )
+        self.assertEqual(entry.unread_count, 3)
+        room = ChatRoom.objects.get(id=self.rooms[0].id)
+        self.assertEqual(room.last_message_time, newer.timestamp)
+
+    def test_mark_read(self):
+        messages = self.write_messages(self.rooms[0], self.friends[0], 4)
+
+        response = self.client.post(
+            "/api/mark_chatroom_read/",
+            {"chatroom_id": self.rooms[0].id, "last_read_message_id": messages[1].id},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["unread_count"], 2)
+
+        response = self.client.post(
+            "/api/mark_chatroom_read/", {"chatroom_id": self.rooms[0].id}, format="json"
+        )
+        self.assertEqual(response.data["unread_count"], 0)
+        self.assertEqual(response.data["last_read_message_id"], messages[-1].id)
+
+        stranger = AppUser.objects.create(username="inboxstranger")
+        self.client.force_authenticate(user=stranger)
+        response = self.client.post(
+            "/api/mark_chatroom_read/", {"chatroom_id": self.rooms[0].id}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TokenCacheTests(APITestCase):
+    def setUp(self):
+        token_cache.clear()
+        self.user = AppUser.objects.create(username="tokenuser")
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token.key}")
+
+    def verify(self):
+        # status code and the number of token lookups it took
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post("/api/verify_token/")
+        lookups = [query for query in queries if "authtoken_token" in query["sql"]]
+        return response.status_code, len(lookups)
+
+    def test_second_request_is_a_cache_hit(self):
+        self.assertEqual(self.verify(), (200, 1))
+        self.assertEqual(self.verify(), (200, 0))
+
+    def test_deleted_token(self):
+        self.verify()
+        self.token.delete()
+        self.assertEqual(self.verify()[0], 401)
+
+    def test_rotated_token(self):
+        self.verify()
+        self.token.delete()
+        new_token = Token.objects.create(user=self.user)
+        self.assertEqual(self.verify()[0], 401)
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {new_token.key}")
+        self.assertEqual(self.verify(), (200, 1))
+
+    def test_deactivated_user(self):
+        self.verify()
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.verify()[0], 401)
+
+
+class PublicKeyTests(APITestCase):
+    def setUp(self):
+        public_key_cache.clear()
+        cache.clear()
+        self.user = AppUser.objects.create(username="keyuser", public_key="key-0")
+        self.client.force_authenticate(user=self.user)
+        for i in range(1, 4):
+            AppUser.objects.create(username=f"keyfriend{i}", public_key=f"key-{i}")
+
+    def test_batch_lookup_is_one_query_then_cached(self):
+        usernames = ["keyfriend1", "keyfriend2", "keyfriend3", "nobody"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/get_public_keys/", {"usernames": usernames}, format="json"
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(response.data["keys"]["keyfriend2"]["public_key"], "key-2")
+        self.assertEqual(response.data["missing"], ["nobody"])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/get_public_keys/?usernames=keyfriend1,keyfriend2")
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(set(response.data["keys"]), {"keyfriend1", "keyfriend2"})
+
+    def test_conditional_request_and_set_public(self):
+        url = "/api/get_public_keys/?usernames=keyuser,keyfriend1"
+        response = self.client.get(url)
+        etag = response["ETag"]
+        version = response.data["keys"]["keyuser"]["version"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.client.post("/api/set_public/", {"public_key": "key-new"}, format="json")
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["keys"]["keyuser"]["public_key"], "key-new")
+        self.assertNotEqual(response.data["keys"]["keyuser"]["version"], version)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_bootstrap_caches_only_primary_reads(self):
+        friend = AppUser.objects.get(username="keyfriend1")
+        Friendship.objects.create(from_user=self.user, to_user=friend, status="accepted")
+
+        # rows read from a replica (the bootstrap view is in REPLICA_READ_VIEWS)
+        with mock.patch("api.bootstrap.DEFAULT_DB_ALIAS", "replica_0"):
+            response = self.client.get("/api/bootstrap/")
+        self.assertEqual(response.data["public_keys"]["keyfriend1"]["public_key"], "key-1")
+        self.assertIsNone(public_key_cache.get("keyfriend1"))
+
+        self.client.get("/api/bootstrap/")
+        _, entry = public_key_cache.get("keyfriend1")
+        self.assertEqual(entry["public_key"], "key-1")
+
+    def test_change_published_by_another_worker(self):
+        self.assertEqual(lookup_public_keys(["keyfriend1"])["keyfriend1"]["public_key"], "key-1")
+
+        # saved by another worker, this one only hears of it through the shared cache
+        AppUser.objects.filter(username="keyfriend1").update(public_key="key-rotated")
+        self.assertEqual(lookup_public_keys(["keyfriend1"])["keyfriend1"]["public_key"], "key-1")
+        publish_public_key_change("keyfriend1")
+        self.assertEqual(
+            lookup_public_keys(["keyfriend1"])["keyfriend1"]["public_key"], "key-rotated"
+        )
+        # cached again after the change, no query until the next one
+        with self.assertNumQueries(0):
+            lookup_public_keys(["keyfriend1"])
+
+    def test_change_is_published_on_commit(self):
+        friend = AppUser.objects.get(username="keyfriend1")
+        with self.captureOnCommitCallbacks(execute=True):
+            friend.public_key = "key-rotated"
+            friend.save()
+            self.assertIsNone(cache.get(changed_key("keyfriend1")))
+        self.assertIsNotNone(cache.get(changed_key("keyfriend1")))
+
+
+class DBWriterTests(TransactionTestCase):
+    def setUp(self):
+        user1 = AppUser.objects.create(username="writer1")
+        user2 = AppUser.objects.create(username="writer2")
+        self.chatroom = ChatRoom.objects.create(user1=user1, user2=user2)
+        self.writer = DBWriter(max_batch=10)
+        self.addCleanup(self.writer.stop)
+
+    def add_message(self, content):
+        return Message.objects.create(
+            chat_room=self.chatroom, sender_id=self.chatroom.user1_id, content=content
+        )
+
+    def test_failing_job_only_rolls_back_itself(self):
+        def fail():
+            self.add_message("rolled back")
+            raise ValueError("job failed")
+
+        first = self.writer.submit(self.add_message, "first")
+        failing = self.writer.submit(fail)
+        last = self.writer.submit(self.add_message, "last")
+
+        self.assertEqual(first.result().content, "first")
+        with self.assertRaises(ValueError):
+            failing.result()
+        self.assertEqual(last.result().content, "last")
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("content", flat=True)),
+            ["first", "last"],
+        )
+
+    def test_nested_run_on_writer_thread(self):
+        def outer():
+            return self.writer.run(self.add_message, "nested").id
+
+        message_id = self.writer.run(outer)
+        self.assertTrue(Message.objects.filter(id=message_id).exists())
+
+
+@override_settings(DATABASE_REPLICAS=["replica_0"])
+class ReplicaRouterTests(TestCase):
+    # only the routing decisions, no queries reach the (not configured) replica
+
+    def setUp(self):
+        cache.clear()
+        self.user = AppUser.objects.create(username="replicauser")
+        self.router = PrimaryReplicaRouter()
+        self.middleware = ReplicaRoutingMiddleware(self.view)
+        self.seen = []
+
+    def view(self, request):
+        self.seen.append(self.router.db_for_read(ChatRoom))  # before authentication
+        request.user = self.user
+        self.seen.append(self.router.db_for_read(ChatRoom))
+        if request.method == "POST":
+            self.seen.append(self.router.db_for_write(ChatRoom))
+            self.seen.append(self.router.db_for_read(ChatRoom))
+        return HttpResponse()
+
+    def request(self, method, path):
+        self.seen = []
+        self.middleware(getattr(RequestFactory(), method)(path))
+        return self.seen
+
+    def test_read_only_views_use_replica(self):
+        self.assertEqual(self.request("get", "/api/get_chatrooms/"), ["default", "replica_0"])
+        # POST, but it only reads
+        self.assertEqual(
+            self.request("post", "/api/get_messages_from_db/")[:2], ["default", "replica_0"]
+        )
+        self.assertEqual(self.request("get", "/api/verify_token/"), ["default", "default"])
+        self.assertEqual(self.router.db_for_read(ChatRoom), "default")  # outside a request
+
+    def test_read_your_writes(self):
+        self.assertEqual(
+            self.request("post", "/api/send_friend_request/"),
+            ["default", "default", "default", "default"],
+        )
+        # pinned to the primary after writing
+        self.assertEqual(self.request("get", "/api/get_friends/"), ["default", "default"])
+
+        cache.clear()
+        self.assertEqual(self.request("get", "/api/get_friends/"), ["default", "replica_0"])
+
+    @override_settings(REPLICA_STICKY_SECONDS=10)
+    async def test_consumer_pins_once_per_interval(self):
+        consumer = ChatConsumer()
+        consumer.scope = {"user": self.user}
+        with mock.patch("api.routers.apin_to_primary") as pin:
+            for _ in range(3):
+                consumer.pin_to_primary()
+            await consumer.pin_task
+            self.assertEqual(pin.await_count, 1)
+
+            # half an interval later
+            consumer.pinned_until = 0
+            consumer.pin_to_primary()
+            await consumer.pin_task
+            self.assertEqual(pin.await_count, 2)
+        # long enough to cover a write right before the renewal
+        pin.assert_awaited_with(self.user.id, 15)
+
+
+class RecordingBuffer(WriteBehindBuffer):
+    def __init__(self, flush_interval, batch_size, fail_with=None):
+        super().__init__(flush_interval, batch_size)
+        self.batches = []
+        self.fail_with = fail_with
+
+    def write_batch(self, items):
+        if self.fail_with is not None:
+            error, self.fail_with = self.fail_with, None
+            raise error
+        self.batches.append(list(items))
+
+
+class WriteBehindBufferTests(TransactionTestCase):
+    def setUp(self):
+        user1 = AppUser.objects.create(username="buffer1")
+        user2 = AppUser.objects.create(username="buffer2")
+        self.chatroom = ChatRoom.objects.create(user1=user1, user2=user2)
+
+    def message_item(self, content, room_id=None):
+        return {
+            "room_id": room_id or self.chatroom.id,
+            "sender_id": self.chatroom.user1_id,
+            "sender_username": "buffer1",
+            "content": content,
+            "signature": "sig",
+            "iv": f"iv-{content}",
+        }
+
+    async def test_flushes_once_batch_size_is_reached(self):
+        buffer = RecordingBuffer(flush_interval=60, batch_size=3)
+        buffer.add(1)
+        buffer.add(2)
+        await asyncio.sleep(0.1)
+        self.assertEqual(buffer.batches, [])
+
+        buffer.add(3)
+        await asyncio.sleep(0.1)
+        self.assertEqual(buffer.batches, [[1, 2, 3]])
+
+    async def test_flushes_on_interval(self):
+        buffer = RecordingBuffer(flush_interval=0.05, batch_size=100)
+        buffer.add(1)
+        await asyncio.sleep(0.3)
+        self.assertEqual(buffer.batches, [[1]])
+        self.assertEqual(buffer.pending_count(), 0)
+
+    def test_requeues_batch_when_db_is_unavailable(self):
+        buffer = RecordingBuffer(
+            flush_interval=60, batch_size=100, fail_with=OperationalError("database is locked")
+        )
+        buffer.add(1)
+        buffer.add(2)
+        with self.assertRaises(OperationalError):
+            buffer.flush_sync()
+        buffer.add(3)
+        self.assertEqual(buffer.pending_count(), 3)
+
+        self.assertEqual(buffer.flush_sync(), 3)
+        self.assertEqual(buffer.batches, [[1, 2, 3]])
+
+    def test_bad_item_is_dropped_and_the_rest_written(self):
+        writer = MessageWriter(flush_interval=60, batch_size=100)
+        writer.add(self.message_item("first"))
+        writer.add(self.message_item("bad", room_id=999999))  # no such room
+        writer.add(self.message_item("last"))
+
+        self.assertEqual(writer.flush_sync(), 2)
+        self.assertEqual(writer.pending_count(), 0)
+        self.assertEqual(
+            list(Message.objects.order_by("id").values_list("content", flat=True)),
+            ["first", "last"],
+        )
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.numOfMessages, 2)
+
+    def test_drain_at_exit(self):
+        with mock.patch("api.persistence.atexit.register") as register:
+            buffer = RecordingBuffer(flush_interval=60, batch_size=2)
+        register.assert_called_once_with(buffer.drain)
+
+        for item in range(5):
+            buffer.add(item)
+        buffer.drain()
+        self.assertEqual(buffer.pending_count(), 0)
+        self.assertEqual(sum(buffer.batches, []), [0, 1, 2, 3, 4])
+
+
+class CanonicalRoomsMigrationTests(TransactionTestCase):
+    # runs 0003 against rooms created with the 0002 schema
+    migrate_from = [("api", "0002_chatroom_friendship_message")]
+    migrate_to = [("api", "0003_chat_indexes_and_canonical_rooms")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        # back to the latest schema for the other tests
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_self_rooms_and_duplicates(self):
+        apps = self.migrate(self.migrate_from)
+        OldUser = apps.get_model("api", "AppUser")
+        OldChatRoom = apps.get_model("api", "ChatRoom")
+        OldMessage = apps.get_model("api", "Message")
+
+        user1 = OldUser.objects.create(username="migrate1")
+        user2 = OldUser.objects.create(username="migrate2")
+        self_room = OldChatRoom.objects.create(user1=user1, user2=user1)
+        OldMessage.objects.create(chat_room=self_room, sender=user1, content="to myself")
+        room = OldChatRoom.objects.create(user1=user1, user2=user2, numOfMessages=1)
+        OldMessage.objects.create(chat_room=room, sender=user1, content="first")
+        duplicate = OldChatRoom.objects.create(user1=user2, user2=user1, numOfMessages=1)
+        OldMessage.objects.create(chat_room=duplicate, sender=user2, content="second")
+
+        apps = self.migrate(self.migrate_to)
+        NewChatRoom = apps.get_model("api", "ChatRoom")
+        NewMessage = apps.get_model("api", "Message")
+
+        # the self room is kept with its messages, the duplicate is folded into the oldest room
+        self.assertEqual(
+            list(
+                NewChatRoom.objects.order_by("id").values_list(
+                    "id", "user1_id", "user2_id", "numOfMessages"
+                )
+            ),
+            [(self_room.id, user1.id, user1.id, 0), (room.id, user1.id, user2.id, 2)],
+        )
+        self.assertEqual(
+            list(NewMessage.objects.order_by("id").values_list("chat_room_id", "content")),
+            [(self_room.id, "to myself"), (room.id, "first"), (room.id, "second")],
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class ConsumerTestCase(TransactionTestCase):
+    # websocket tests through the whole asgi app (token auth, routing, consumers)
+    def setUp(self):
+        self.user = AppUser.objects.create(username="socket1")
+        self.friend = AppUser.objects.create(username="socket2")
+        self.room = ChatRoom.objects.create(user1=self.user, user2=self.friend)
+        Friendship.objects.create(from_user=self.user, to_user=self.friend, status="accepted")
+        self.tokens = {
+            user.id: Token.objects.create(user=user).key for user in (self.user, self.friend)
+        }
+        # what the consumers buffered is written before the tables are emptied
+        self.addCleanup(get_last_seen_writer().drain)
+        self.addCleanup(get_message_writer().drain)
+
+    async def connect(self, user, path, query=""):
+        communicator = WebsocketCommunicator(
+            application, f"{path}?token={self.tokens[user.id]}{query}"
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive_all(self, communicator, message_type=None):
+        # every frame until the socket is quiet, optionally only the ones of one type
+        frames = []
+        while not await communicator.receive_nothing(0.3):
+            frames.append(json.loads(await communicator.receive_from()))
+        if message_type is not None:
+            frames = [frame for frame in frames if frame["message_type"] == message_type]
+        return frames
+
+    def add_message(self, content, **fields):
+        return Message.objects.create(
+            chat_room=self.room,
+            sender=self.friend,
+            senderUsername=self.friend.username,
+            content=content,
+            iv=f"iv-{content}",
+            delivery_id=uuid.uuid4(),
+            **fields,
+        )
+
+
+class ReplayTests(ConsumerTestCase):
+    async def send_live(self, message, iv=None):
+        # the event the sender's consumer broadcasts for a new message
+        await get_channel_layer().group_send(
+            f"chat_{self.room.id}",
+            {
+                "type": "chat_message",
+                "message_type": "new_message",
+                "room_id": self.room.id,
+                "encrypted_message": message.content,
+                "message_signature": "signature",
+                "iv": iv or message.iv,
+                "delivery_id": str(message.delivery_id),
+                "sender_id": self.friend.id,
+            },
+        )
+
+    @override_settings(CHAT_REPLAY_BATCH_SIZE=2)
+    async def test_replay_in_order(self):
+        messages = [await database_sync_to_async(self.add_message)(f"m{i}") for i in range(5)]
+
+        socket = await self.connect(
+            self.user, f"/ws/chat/{self.room.id}/", f"&last_message_id={messages[0].id}"
+        )
+        frames = await self.receive_all(socket)
+        replayed = [frame for frame in frames if frame.get("replayed")]
+        self.assertEqual(
+            [frame["message_id"] for frame in replayed], [m.id for m in messages[1:]]
+        )
+        self.assertEqual(
+            [frame["encrypted_message"] for frame in replayed], ["m1", "m2", "m3", "m4"]
+        )
+        complete = [frame for frame in frames if frame["message_type"] == "replay_complete"]
+        self.assertEqual(
+            complete,
+            [{
+                "message_type": "replay_complete",
+                "last_message_id": messages[-1].id,
+                "has_more": False,
+            }],
+        )
+        await socket.disconnect()
+
+    async def test_live_event_of_replayed_message_is_dropped(self):
+        first = await database_sync_to_async(self.add_message)("first")
+        replayed = await database_sync_to_async(self.add_message)("replayed")
+
+        socket = await self.connect(
+            self.user, f"/ws/chat/{self.room.id}/", f"&last_message_id={first.id}"
+        )
+        await self.receive_all(socket)
+
+        # the broadcast of a replayed message arrives late, the client already has it
+        await self.send_live(replayed)
+        self.assertEqual(await self.receive_all(socket, "new_message"), [])
+
+        # another message reusing the iv is still delivered
+        other = await database_sync_to_async(self.add_message)("other")
+        await self.send_live(other, iv=replayed.iv)
+        frames = await self.receive_all(socket, "new_message")
+        self.assertEqual([frame["encrypted_message"] for frame in frames], ["other"])
+        await socket.disconnect()
+
+    async def test_replay_after_failed_flush(self):
+        first = await database_sync_to_async(self.add_message)("first")
+        committed = await database_sync_to_async(self.add_message)("committed")
+
+        with mock.patch.object(
+            MessageWriter, "flush", side_effect=OperationalError("database is locked")
+        ):
+            socket = await self.connect(
+                self.user, f"/ws/chat/{self.room.id}/", f"&last_message_id={first.id}"
+            )
+            frames = await self.receive_all(socket)
+        self.assertEqual(
+            [frame["message_id"] for frame in frames if frame.get("replayed")], [committed.id]
+        )
+        await socket.disconnect()
+
+
+def chunk_frame(upload_id, offset, chunk):
+    # binary upload_chunk frame, see api.uploads.parse_chunk_frame
+    header = json.dumps({"upload_id": upload_id, "offset": offset}).encode()
+    return len(header).to_bytes(4, "big") + header + chunk
+
+
+class MultiplexTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.stranger = AppUser.objects.create(username="socket3")
+        self.other_room = ChatRoom.objects.create(user1=self.friend, user2=self.stranger)
+        upload_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_dir.cleanup)
+        self.settings_override = override_settings(CHUNKED_UPLOAD_DIR=upload_dir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    async def request(self, socket, frame):
+        await socket.send_json_to(frame)
+        return json.loads(await socket.receive_from(2))
+
+    async def test_subscribe_and_unsubscribe(self):
+        socket = await self.connect(self.user, "/ws/chat/")
+        frame = await self.request(socket, {"message_type": "subscribe", "room_id": self.room.id})
+        self.assertEqual(frame, {"room_id": self.room.id, "message_type": "subscribed"})
+        await self.receive_all(socket)
+
+        friend_socket = await self.connect(self.friend, f"/ws/chat/{self.room.id}/")
+        await self.receive_all(socket)
+        message = {
+            "message_type": "new_message",
+            "encrypted_message": "hello",
+            "message_signature": "signature",
+            "iv": "iv",
+        }
+        await friend_socket.send_json_to(message)
+        frames = await self.receive_all(socket, "new_message")
+        self.assertEqual(
+            [(frame["room_id"], frame["encrypted_message"]) for frame in frames],
+            [(self.room.id, "hello")],
+        )
+
+        frame = await self.request(socket, {"message_type": "unsubscribe", "room_id": self.room.id})
+        self.assertEqual(frame, {"room_id": self.room.id, "message_type": "unsubscribed"})
+        await friend_socket.send_json_to(message)
+        self.assertEqual(await self.receive_all(socket, "new_message"), [])
+
+        await friend_socket.disconnect()
+        await socket.disconnect()
+
+    @override_settings(MULTIPLEX_MAX_ROOMS=1)
+    async def test_max_rooms(self):
+        third_room = await database_sync_to_async(ChatRoom.objects.create)(
+            user1=self.user, user2=self.stranger
+        )
+        await database_sync_to_async(Friendship.objects.create)(
+            from_user=self.user, to_user=self.stranger, status="accepted"
+        )
+        socket = await self.connect(self.user, "/ws/chat/")
+        await socket.send_json_to(
+            {"message_type": "subscribe", "room_ids": [self.room.id, third_room.id]}
+        )
+        frames = [
+            frame
+            for frame in await self.receive_all(socket)
+            if frame["message_type"] in ("subscribed", "subscribe_error")
+        ]
+        self.assertEqual(
+            frames,
+            [
+                {"room_id": self.room.id, "message_type": "subscribed"},
+                {
+                    "room_id": third_room.id,
+                    "message_type": "subscribe_error",
+                    "error": "Too many rooms",
+                },
+            ],
+        )
+        await socket.disconnect()
+
+    async def test_unauthorized_room(self):
+        socket = await self.connect(self.user, "/ws/chat/")
+        frame = await self.request(
+            socket, {"message_type": "subscribe", "room_id": self.other_room.id}
+        )
+        self.assertEqual(
+            frame,
+            {
+                "room_id": self.other_room.id,
+                "message_type": "subscribe_error",
+                "error": "Access denied",
+            },
+        )
+        frame = await self.request(
+            socket, {"message_type": "new_message", "room_id": self.other_room.id}
+        )
+        self.assertEqual(frame["error"], "Not subscribed")
+        await socket.disconnect()
+
+    async def test_invalid_frames(self):
+        socket = await self.connect(self.user, "/ws/chat/")
+        for frame in ([1, 2], 5, "subscribe"):
+            response = await self.request(socket, frame)
+            self.assertEqual(response, {"message_type": "error", "error": "Invalid frame"})
+        for frame in (
+            {"message_type": "subscribe"},
+            {"message_type": "subscribe", "room_id": "abc"},
+            {"message_type": "subscribe", "room_ids": str(self.room.id)},
+            {"message_type": "subscribe", "room_ids": []},
+        ):
+            response = await self.request(socket, frame)
+            self.assertEqual(
+                response, {"message_type": "error", "error": "Missing or invalid room_id"}
+            )
+
+        # the connection still works
+        frame = await self.request(socket, {"message_type": "subscribe", "room_id": self.room.id})
+        self.assertEqual(frame["message_type"], "subscribed")
+        await socket.disconnect()
+
+    async def test_malformed_room_frame_keeps_other_rooms(self):
+        third_room = await database_sync_to_async(ChatRoom.objects.create)(
+            user1=self.user, user2=self.stranger
+        )
+        await database_sync_to_async(Friendship.objects.create)(
+            from_user=self.user, to_user=self.stranger, status="accepted"
+        )
+        socket = await self.connect(self.user, "/ws/chat/")
+        await socket.send_json_to(
+            {"message_type": "subscribe", "room_ids": [self.room.id, third_room.id]}
+        )
+        await self.receive_all(socket)
+
+        frame = await self.request(socket, {"room_id": third_room.id})
+        self.assertEqual(
+            frame,
+            {
+                "room_id": third_room.id,
+                "message_type": "error",
+                "error": "Missing or invalid message_type",
+            },
+        )
+        frame = await self.request(
+            socket,
+            {"message_type": "new_message", "room_id": third_room.id, "encrypted_message": "x"},
+        )
+        self.assertEqual(
+            frame,
+            {
+                "room_id": third_room.id,
+                "message_type": "error",
+                "error": "Missing message_signature, iv",
+            },
+        )
+
+        # the socket and the other room still work
+        friend_socket = await self.connect(self.friend, f"/ws/chat/{self.room.id}/")
+        await self.receive_all(friend_socket)
+        await socket.send_json_to(
+            {
+                "message_type": "new_message",
+                "room_id": self.room.id,
+                "encrypted_message": "hello",
+                "message_signature": "signature",
+                "iv": "iv",
+            }
+        )
+        frames = await self.receive_all(friend_socket, "new_message")
+        self.assertEqual([frame["encrypted_message"] for frame in frames], ["hello"])
+        await friend_socket.disconnect()
+        await socket.disconnect()
+
+    async def test_chunk_frame_needs_room_access(self):
+        socket = await self.connect(self.user, "/ws/chat/")
+        await self.request(socket, {"message_type": "subscribe", "room_id": self.room.id})
+        await self.receive_all(socket)
+        frame = await self.request(
+            socket,
+            {
+                "message_type": "upload_begin",
+                "room_id": self.room.id,
+                "fileName": "a.txt",
+                "size": 6,
+            },
+        )
+        upload_id = frame["upload_id"]
+
+        await socket.send_to(bytes_data=chunk_frame(upload_id, 0, b"abc"))
+        frame = json.loads(await socket.receive_from(2))
+        self.assertEqual(
+            frame, {"message_type": "upload_progress", "upload_id": upload_id, "offset": 3}
+        )
+
+        # unfriended while uploading, the chunks of the room are refused
+        await database_sync_to_async(Friendship.objects.filter(from_user=self.user).delete)()
+        await socket.send_to(bytes_data=chunk_frame(upload_id, 3, b"def"))
+        frame = json.loads(await socket.receive_from(2))
+        self.assertEqual(
+            (frame["message_type"], frame["error"]), ("upload_error", "Access denied")
+        )
+        await socket.disconnect()
+
+
+class ChunkedUploadTests(SimpleTestCase):
+    def setUp(self):
+        upload_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(upload_dir.cleanup)
+        self.settings_override = override_settings(CHUNKED_UPLOAD_DIR=upload_dir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def test_begin_append_finish(self):
+        upload_id, offset = uploads.begin_upload(1, 7, {"fileName": "photo.jpg", "size": 6})
+        self.assertEqual(offset, 0)
+        self.assertEqual(uploads.append_chunk(1, upload_id, 0, b"abc"), 3)
+
+        with self.assertRaises(uploads.UploadError) as error:
+            uploads.finish_upload(1, upload_id)
+        self.assertEqual(error.exception.offset, 3)
+
+        # a resent chunk is refused with the offset to continue from
+        with self.assertRaises(uploads.UploadError) as error:
+            uploads.append_chunk(1, upload_id, 0, b"abc")
+        self.assertEqual(error.exception.offset, 3)
+
+        # resuming (after a reconnect) continues at the saved offset
+        self.assertEqual(uploads.begin_upload(1, 7, {"upload_id": upload_id}), (upload_id, 3))
+        self.assertEqual(uploads.append_chunk(1, upload_id, 3, b"def"), 6)
+
+        upload = uploads.finish_upload(1, upload_id)
+        self.assertEqual((upload["room_id"], upload["file_extension"]), (7, ".jpg"))
+        with open(upload["part_path"], "rb") as part_file:
+            self.assertEqual(part_file.read(), b"abcdef")
+
+    def test_other_users_and_rooms(self):
+        upload_id, _ = uploads.begin_upload(1, 7, {"size": 6})
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(2, upload_id, 0, b"abc")
+        with self.assertRaises(uploads.UploadError):
+            uploads.begin_upload(1, 8, {"upload_id": upload_id})
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(1, upload_id, 0, b"abc", room_allowed=lambda room_id: False)
+
+    def test_cleanup_stale_uploads(self):
+        stale_id, _ = uploads.begin_upload(1, 7, {})
+        fresh_id, _ = uploads.begin_upload(1, 7, {})
+        old = time.time() - settings.CHUNKED_UPLOAD_EXPIRY - 60
+        os.utime(uploads.part_path(stale_id), (old, old))
+
+        uploads.cleanup_stale_uploads()
+        with self.assertRaises(uploads.UploadError):
+            uploads.append_chunk(1, stale_id, 0, b"abc")
+        self.assertFalse(os.path.exists(uploads.part_path(stale_id)))
+        self.assertEqual(uploads.append_chunk(1, fresh_id, 0, b"abc"), 3)
+
+    def test_parse_chunk_frame(self):
+        self.assertEqual(
+            uploads.parse_chunk_frame(chunk_frame("a" * 32, 5, b"data")),
+            ({"upload_id": "a" * 32, "offset": 5}, b"data"),
+        )
+        for header in (b"[1]", b"7", b'"text"', b'{"upload_id": "x"}', b'{"offset": 0}', b"{"):
+            with self.assertRaises(uploads.UploadError):
+                uploads.parse_chunk_frame(len(header).to_bytes(4, "big") + header + b"data")
+        with self.assertRaises(uploads.UploadError):
+            uploads.parse_chunk_frame(b"\x00")
+
+
+class ChunkedUploadConsumerTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        self.settings_override = override_settings(
+            MEDIA_ROOT=media_dir.name,
+            CHUNKED_UPLOAD_DIR=os.path.join(media_dir.name, "tmp_uploads"),
+        )
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    async def request(self, socket, frame=None, bytes_data=None):
+        if bytes_data is not None:
+            await socket.send_to(bytes_data=bytes_data)
+        else:
+            await socket.send_json_to(frame)
+        return json.loads(await socket.receive_from(2))
+
+    async def test_resume_after_disconnect(self):
+        path = f"/ws/chat/{self.room.id}/"
+        socket = await self.connect(self.user, path)
+        await self.receive_all(socket)
+        frame = await self.request(
+            socket,
+            {"message_type": "upload_begin", "fileName": "notes.txt", "size": 6, "iv": "iv"},
+        )
+        upload_id = frame["upload_id"]
+        frame = await self.request(socket, bytes_data=chunk_frame(upload_id, 0, b"abc"))
+        self.assertEqual(frame["offset"], 3)
+        await socket.disconnect()
+
+        socket = await self.connect(self.user, path)
+        await self.receive_all(socket)
+        frame = await self.request(
+            socket, {"message_type": "upload_begin", "upload_id": upload_id}
+        )
+        self.assertEqual(
+            frame, {"message_type": "upload_ready", "upload_id": upload_id, "offset": 3}
+        )
+
+        # a header without its offset is a protocol error, the upload is untouched
+        header = json.dumps({"upload_id": upload_id}).encode()
+        frame = await self.request(
+            socket, bytes_data=len(header).to_bytes(4, "big") + header + b"def"
+        )
+        self.assertEqual(
+            (frame["message_type"], frame["error"]), ("upload_error", "Invalid chunk frame")
+        )
+
+        await self.request(socket, bytes_data=chunk_frame(upload_id, 3, b"def"))
+        frame = await self.request(socket, {"message_type": "upload_end", "upload_id": upload_id})
+        self.assertEqual(frame["message_type"], "upload_complete")
+        await socket.disconnect()
+
+        message = await database_sync_to_async(Message.objects.get)(chat_room=self.room)
+        self.assertTrue(message.isFile)
+        self.assertEqual(message.fileData.read(), b"abcdef")
+        message.fileData.close()
+        self.assertEqual(os.listdir(settings.CHUNKED_UPLOAD_DIR), [])
+
+
+class InMemoryPresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.presence = InMemoryPresence(ttl=30)
+        self.now = 1000.0
+        clock = mock.patch("api.presence.time.monotonic", side_effect=lambda: self.now)
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    async def test_join_and_leave(self):
+        await self.presence.join(1, 10, "tab-1")
+        await self.presence.join(1, 10, "tab-2")
+        await self.presence.join(1, 20, "phone")
+        self.assertEqual(await self.presence.room_members(1), [10, 20])
+
+        # closing one of 2 tabs keeps the user online
+        await self.presence.leave(1, 10, "tab-1")
+        self.assertEqual(await self.presence.room_members(1), [10, 20])
+        self.assertTrue(await self.presence.is_online(10))
+
+        await self.presence.leave(1, 10, "tab-2")
+        self.assertEqual(await self.presence.room_members(1), [20])
+        self.assertFalse(await self.presence.is_online(10))
+
+    async def test_connections_expire_without_heartbeat(self):
+        await self.presence.join(1, 10, "alive")
+        await self.presence.join(1, 20, "dead")  # worker died, never left
+
+        self.now += 20
+        await self.presence.heartbeat(1, 10, "alive")
+        self.now += 20
+        self.assertEqual(await self.presence.room_members(1), [10])
+        self.assertTrue(await self.presence.is_online(10))
+        self.assertFalse(await self.presence.is_online(20))
+
+
+    async def test_leaving_one_room_keeps_a_multiplexed_connection_online(self):
+        await self.presence.join(1, 10, "socket")
+        await self.presence.join(2, 10, "socket")
+
+        await self.presence.leave(1, 10, "socket")
+        self.assertEqual(await self.presence.room_members(1), [])
+        self.assertEqual(await self.presence.room_members(2), [10])
+        self.assertTrue(await self.presence.is_online(10))
+
+        await self.presence.leave(2, 10, "socket")
+        self.assertFalse(await self.presence.is_online(10))
+
+
+class RedisPresenceTests(SimpleTestCase):
+    def setUp(self):
+        self.presence = RedisPresence(ttl=30, host="redis://localhost:6379/0")
+        self.server = fakeredis.FakeServer()
+        # a client per event loop, like the real one
+        client = mock.patch.object(
+            RedisPresence,
+            "_get_client",
+            side_effect=lambda: fakeredis.FakeAsyncRedis(server=self.server),
+        )
+        client.start()
+        self.addCleanup(client.stop)
+
+    async def test_join_and_leave(self):
+        await self.presence.join(1, 10, "tab-1")
+        await self.presence.join(1, 10, "tab-2")
+        await self.presence.join(1, 20, "phone")
+        self.assertEqual(await self.presence.room_members(1), [10, 20])
+
+        await self.presence.leave(1, 10, "tab-1")
+        self.assertTrue(await self.presence.is_online(10))
+        await self.presence.leave(1, 10, "tab-2")
+        self.assertEqual(await self.presence.room_members(1), [20])
+        self.assertFalse(await self.presence.is_online(10))
+
+    async def test_leaving_one_room_keeps_a_multiplexed_connection_online(self):
+        await self.presence.join(1, 10, "socket")
+        await self.presence.join(2, 10, "socket")
+
+        await self.presence.leave(1, 10, "socket")
+        self.assertEqual(await self.presence.room_members(1), [])
+        self.assertEqual(await self.presence.room_members(2), [10])
+        self.assertTrue(await self.presence.is_online(10))
+
+        await self.presence.leave(2, 10, "socket")
+        self.assertFalse(await self.presence.is_online(10))
+
+
+class ContentAddressedStorageTests(TestCase):
+    def setUp(self):
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=media_dir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+        user1 = AppUser.objects.create(username="blob1")
+        user2 = AppUser.objects.create(username="blob2")
+        self.room = ChatRoom.objects.create(user1=user1, user2=user2)
+
+    def add_file(self, content, file_name="file.bin"):
+        message = Message(chat_room=self.room, sender=self.room.user1, isFile=True)
+        message.fileData.save(file_name, ContentFile(content), save=False)
+        message.save()
+        return message
+
+    def test_identical_content_is_one_blob(self):
+        first = self.add_file(b"encrypted bytes")
+        second = self.add_file(b"encrypted bytes")
+        other = self.add_file(b"other bytes")
+
+        self.assertEqual(first.fileData.name, second.fileData.name)
+        self.assertNotEqual(first.fileData.name, other.fileData.name)
+        digest = hashlib.sha256(b"encrypted bytes").hexdigest()
+        self.assertEqual(
+            first.fileData.name, f"uploads/{digest[:2]}/{digest[2:4]}/{digest}.bin"
+        )
+        with default_storage.open(first.fileData.name) as fh:
+            self.assertEqual(fh.read(), b"encrypted bytes")
+
+    def test_blob_is_deleted_with_its_last_message(self):
+        first = self.add_file(b"shared")
+        second = self.add_file(b"shared")
+        name = first.fileData.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(default_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(name))
+
+    def test_upload_racing_the_last_delete_keeps_the_blob(self):
+        first = self.add_file(b"shared")
+        name = first.fileData.name
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            first.delete()
+        # the same content is uploaded, its message is not saved yet when the delete commits
+        second = Message(chat_room=self.room, sender=self.room.user1, isFile=True)
+        second.fileData.save("file.bin", ContentFile(b"shared"), save=False)
+        for callback in callbacks:
+            callback()
+        second.save()
+
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(Blob.objects.get(name=name).refs, 1)
+
+    def test_upload_after_the_last_delete_writes_the_blob_again(self):
+        first = self.add_file(b"shared")
+        name = first.fileData.name
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(Blob.objects.filter(name=name).exists())
+
+        second = self.add_file(b"shared")
+        self.assertEqual(second.fileData.name, name)
+        with default_storage.open(name) as fh:
+            self.assertEqual(fh.read(), b"shared")
+
+
+@override_settings(MEDIA_SENDFILE="")
+class MediaResponseTests(TestCase):
+    # a TestCase, the storage counts the messages of every blob in the db
+    def setUp(self):
+        media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(media_dir.cleanup)
+        self.settings_override = override_settings(MEDIA_ROOT=media_dir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        self.name = default_storage.save("uploads/file.bin", ContentFile(b"0123456789"))
+
+    def get(self, **headers):
+        response = media_response(RequestFactory().get("/", **headers), self.name)
+        self.addCleanup(response.close)
+        return response
+
+    def body(self, response):
+        return b"".join(response.streaming_content)
+
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b"0123456789")
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        # the blob name is the hash of the content
+        self.assertEqual(
+            response["ETag"], f'"{hashlib.sha256(b"0123456789").hexdigest()}"'
+        )
+
+    def test_ranges(self):
+        for header, content_range, body in (
+            ("bytes=2-5", "bytes 2-5/10", b"2345"),
+            ("bytes=7-", "bytes 7-9/10", b"789"),
+            ("bytes=-3", "bytes 7-9/10", b"789"),
+            ("bytes=8-100", "bytes 8-9/10", b"89"),
+        ):
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(response["Content-Range"], content_range)
+            self.assertEqual(response["Content-Length"], str(len(body)))
+            self.assertEqual(self.body(response), body)
+
+    def test_unsatisfiable_range(self):
+        for header in ("bytes=10-", "bytes=5-2", "bytes=-0"):
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416, header)
+            self.assertEqual(response["Content-Range"], "bytes */10")
+
+    def test_if_range(self):
+        etag = self.get()["ETag"]
+        response = self.get(HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+        # the client has another version, it gets the whole file
+        response = self.get(HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"old"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), b"0123456789")
+
+    def test_if_none_match(self):
+        etag = self.get()["ETag"]
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH='"old"').status_code, 200)
+
+    def test_missing_file(self):
+        self.name = "uploads/missing.bin"
+        self.assertEqual(self.get().status_code, 404)
+
+
+class TypingStateTests(SimpleTestCase):
+    def make_state(self, min_interval=0.1, timeout=1):
+        self.forwarded = []
+
+        async def forward(is_typing):
+            self.forwarded.append(is_typing)
+
+        return TypingState(forward, min_interval=min_interval, timeout=timeout)
+
+    async def test_only_state_changes_are_forwarded(self):
+        state = self.make_state()
+        for _ in range(5):
+            await state.typing()
+        self.assertEqual(self.forwarded, [True])
+        await state.close()
+
+    async def test_changes_within_the_window_are_collapsed(self):
+        state = self.make_state(min_interval=0.1)
+        await state.typing()
+        # stop and start again within min_interval, the room never sees the flicker
+        await state.stopped()
+        await state.typing()
+        await asyncio.sleep(0.15)
+        self.assertEqual(self.forwarded, [True])
+
+        # a stop is sent once the window is over
+        await state.stopped()
+        self.assertEqual(self.forwarded, [True, False])
+        await state.typing()
+        self.assertEqual(self.forwarded, [True, False])
+        await asyncio.sleep(0.15)
+        self.assertEqual(self.forwarded, [True, False, True])
+        await state.close()
+
+    async def test_typing_expires(self):
+        state = self.make_state(min_interval=0, timeout=0.2)
+        await state.typing()
+        await asyncio.sleep(0.1)
+        await state.typing()  # still typing, the timeout starts again
+        await asyncio.sleep(0.15)
+        self.assertEqual(self.forwarded, [True])
+        await asyncio.sleep(0.2)
+        self.assertEqual(self.forwarded, [True, False])
+
+    async def test_close_stops_typing(self):
+        state = self.make_state()
+        await state.typing()
+        await state.close()
+        self.assertEqual(self.forwarded, [True, False])
+        await state.close()
+        self.assertEqual(self.forwarded, [True, False])
+
+
+class LastSeenWriterTests(TestCase):
+    def setUp(self):
+        self.user1 = AppUser.objects.create(username="seen1")
+        self.user2 = AppUser.objects.create(username="seen2")
+        self.room = ChatRoom.objects.create(user1=self.user1, user2=self.user2)
+        with mock.patch("api.persistence.atexit.register"):
+            self.writer = LastSeenWriter(flush_interval=60, batch_size=1000)
+
+    def test_touches_are_coalesced(self):
+        for _ in range(10):
+            self.writer.touch(self.room.id, self.user1.id)
+        self.writer.touch(self.room.id, self.user2.id)
+        latest = self.writer.get(self.room.id, self.user1.id)
+        self.assertIsNotNone(latest)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.writer.flush_sync(), 11)
+        # one UPDATE per side of the room, not one per touch
+        updates = [query for query in queries if query["sql"].startswith("UPDATE")]
+        self.assertEqual(len(updates), 2)
+
+        self.room.refresh_from_db()
+        self.assertEqual(self.room.user1_last_online, latest)
+        self.assertIsNotNone(self.room.user2_last_online)
+        # written, the db has the current value
+        self.assertIsNone(self.writer.get(self.room.id, self.user1.id))
+
+    def test_newer_touch_during_flush_is_kept(self):
+        self.writer.touch(self.room.id, self.user1.id)
+        original = self.writer.write_batch
+
+        def touch_while_writing(items):
+            self.writer.touch(self.room.id, self.user1.id)
+            original(items)
+
+        with mock.patch.object(self.writer, "write_batch", touch_while_writing):
+            self.writer.flush_sync()
+        # the newer time is not in the db yet, reads still come from the writer
+        self.assertIsNotNone(self.writer.get(self.room.id, self.user1.id))
+        self.assertEqual(self.writer.pending_count(), 1)
+
+
+@override_settings(CHAT_REQUIRE_FRIENDSHIP=True)
+class RoomAccessCacheTests(TestCase):
+    def setUp(self):
+        # ids are reused after the rollback of other tests
+        friends_cache.clear()
+        room_cache.clear()
+        self.user1 = AppUser.objects.create(username="authz1")
+        self.user2 = AppUser.objects.create(username="authz2")
+        self.outsider = AppUser.objects.create(username="authz3")
+        self.room = ChatRoom.objects.create(user1=self.user1, user2=self.user2)
+        self.friendship = Friendship.objects.create(
+            from_user=self.user1, to_user=self.user2, status="pending"
+        )
+
+    def test_cached_until_the_friendship_changes(self):
+        self.assertFalse(can_use_room(self.room.id, self.user1.id))
+        self.assertFalse(can_use_room(self.room.id, self.outsider.id))
+        # answered from memory now
+        with self.assertNumQueries(0):
+            self.assertFalse(cached_room_access(self.room.id, self.user1.id))
+
+        self.friendship.status = "accepted"
+        self.friendship.save()
+        self.assertIsNone(cached_room_access(self.room.id, self.user1.id))
+        self.assertIsNone(cached_room_access(self.room.id, self.user2.id))
+        self.assertTrue(can_use_room(self.room.id, self.user1.id))
+        self.assertTrue(can_use_room(self.room.id, self.user2.id))
+        self.assertTrue(cached_room_access(self.room.id, self.user2.id))
+
+        # unfriended
+        self.friendship.delete()
+        self.assertIsNone(cached_room_access(self.room.id, self.user2.id))
+        self.assertFalse(can_use_room(self.room.id, self.user2.id))
+
+    def test_cached_until_the_room_changes(self):
+        Friendship.objects.create(from_user=self.user1, to_user=self.outsider, status="accepted")
+        self.assertFalse(can_use_room(self.room.id, self.outsider.id))
+        with self.assertNumQueries(0):
+            self.assertEqual(get_room_info(self.room.id)["user2_id"], self.user2.id)
+
+        # the room changes members, the cached members go with it
+        self.room.user2 = self.outsider
+        self.room.save()
+        self.assertIsNone(cached_room_access(self.room.id, self.outsider.id))
+        self.assertEqual(get_room_info(self.room.id)["user2_id"], self.outsider.id)
+        self.assertTrue(can_use_room(self.room.id, self.outsider.id))
+        self.assertFalse(can_use_room(self.room.id, self.user2.id))
+
+        room_id = self.room.id
+        self.room.delete()
+        self.assertIsNone(get_room_info(room_id))
+
+    def test_friend_ids(self):
+        self.assertEqual(get_friend_ids(self.user1.id), frozenset())
+        Friendship.objects.create(from_user=self.outsider, to_user=self.user1, status="accepted")
+        self.assertEqual(get_friend_ids(self.user1.id), {self.outsider.id})
+        self.assertEqual(get_friend_ids(self.outsider.id), {self.user1.id})
+
+
+class ProtocolTests(SimpleTestCase):
+    payload = {
+        "message_type": "new_message",
+        "encrypted_message": base64.b64encode(b"\x00ciphertext\xff").decode(),
+        "message_signature": base64.b64encode(b"signature").decode(),
+        # valid base64 text that is not what a base64 encoder would produce for its bytes
+        "iv": "aXZ=",
+        "senderUsername": "abcd",  # base64 alphabet, but not a binary field
+        "message_id": 5,
+    }
+
+    def test_json_round_trip(self):
+        frame = encode(self.payload, use_msgpack=False)
+        self.assertEqual(json.loads(frame["text_data"]), self.payload)
+
+    def test_msgpack_round_trip(self):
+        frame = encode(self.payload, use_msgpack=True)
+        raw = msgpack.unpackb(frame["bytes_data"], raw=False)
+        # the binary fields are always bytes, the rest untouched
+        self.assertEqual(raw["encrypted_message"], b"\x00ciphertext\xff")
+        self.assertEqual(raw["iv"], base64.b64decode("aXZ="))
+        self.assertEqual(raw["senderUsername"], "abcd")
+        self.assertEqual(raw["message_id"], 5)
+
+        decoded = decode_msgpack(frame["bytes_data"])
+        self.assertEqual(decoded["encrypted_message"], self.payload["encrypted_message"])
+        self.assertEqual(decoded["message_signature"], self.payload["message_signature"])
+        self.assertEqual(base64.b64decode(decoded["iv"]), base64.b64decode("aXZ="))
+        # what a json client would have sent for the same frame
+        self.assertEqual(json.loads(encode(decoded, use_msgpack=False)["text_data"]), decoded)
+
+    def test_other_encodings_are_sent_as_they_are(self):
+        payload = {
+            "message_signature": "c2ln\nbmF0dXJl",  # wrapped base64
+            "encrypted_message": "-_8=",  # url safe base64
+        }
+        self.assertEqual(json.loads(encode(payload, use_msgpack=False)["text_data"]), payload)
+        raw = msgpack.unpackb(encode(payload, use_msgpack=True)["bytes_data"], raw=False)
+        self.assertEqual(raw, payload)
+
+
+class JsonClientTests(ConsumerTestCase):
+    async def test_fields_in_other_encodings_are_relayed(self):
+        socket = await self.connect(self.user, f"/ws/chat/{self.room.id}/")
+        friend_socket = await self.connect(self.friend, f"/ws/chat/{self.room.id}/")
+        await self.receive_all(socket)
+
+        message = {
+            "message_type": "new_message",
+            "encrypted_message": "c2Vj\ncmV0",
+            "message_signature": "-_8=",
+            "iv": "00ff11ee22dd33cc",
+        }
+        await friend_socket.send_json_to(message)
+        frames = await self.receive_all(socket, "new_message")
+        self.assertEqual(frames, [message])
+        # the sender's socket is still open
+        await friend_socket.send_json_to(message)
+        self.assertEqual(await self.receive_all(socket, "new_message"), [message])
+        await friend_socket.disconnect()
+        await socket.disconnect()
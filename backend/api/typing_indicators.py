@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+# typing indicator state for one websocket connection
+# clients send user_typing / user_stopped_typing on every keystroke, this only lets the state
+# changes through to the room (typing -> stopped -> typing ..), at most one every min_interval
+# seconds, and stops a "typing" state by itself if the client goes quiet for timeout seconds
+
+
+class TypingState:
+    def __init__(self, forward, min_interval, timeout):
+        self.forward = forward  # async callable(is_typing) that sends the state to the room
+        self.min_interval = min_interval
+        self.timeout = timeout
+
+        self.forwarded_typing = False  # what the room was told last
+        self.client_typing = False  # what the client told us last
+        self.last_forward = 0
+        self.expires_at = 0
+
+        self._deferred_task = None
+        self._expire_task = None
+
+    async def typing(self):
+        self.client_typing = True
+        self.expires_at = time.monotonic() + self.timeout
+        if self._expire_task is None:
+            self._expire_task = asyncio.create_task(self._expire())
+        await self._sync()
+
+    async def stopped(self):
+        self.client_typing = False
+        await self._sync()
+
+    async def close(self):
+        for task in (self._deferred_task, self._expire_task):
+            if task is not None:
+                task.cancel()
+        self._deferred_task = self._expire_task = None
+
+        # dont leave the other user looking at a typing indicator
+        if self.forwarded_typing:
+            self.forwarded_typing = False
+            await self.forward(False)
+
+    async def _sync(self):
+        if self.client_typing == self.forwarded_typing:
+            return
+
+        wait = self.last_forward + self.min_interval - time.monotonic()
+        if wait > 0:
+            # too soon after the last change, send whatever the state is once the interval is over
+            if self._deferred_task is None:
+                self._deferred_task = asyncio.create_task(self._deferred_sync(wait))
+            return
+
+        self.forwarded_typing = self.client_typing
+        self.last_forward = time.monotonic()
+        await self.forward(self.forwarded_typing)
+
+    async def _deferred_sync(self, wait):
+        await asyncio.sleep(wait)
+        self._deferred_task = None
+        await self._sync()
+
+    async def _expire(self):
+        # a client that stopped sending typing events without a user_stopped_typing is not typing anymore
+        while self.client_typing:
+            remaining = self.expires_at - time.monotonic()
+            if remaining > 0:
+                await asyncio.sleep(remaining)
+                continue
+            self._expire_task = None
+            await self.stopped()
+            return
+        self._expire_task = None
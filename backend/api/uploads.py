@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files import File
+
+# chunked / resumable uploads over the chat websocket
+# upload_begin -> upload_chunk (any number, each appended to a .part file on disk) -> upload_end
+# the state of an upload lives next to its .part file as <upload id>.json, so a client that
+# reconnects (even to another worker sharing the same disk) can continue from the saved offset
+
+upload_id_pattern = re.compile(r"^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    def __init__(self, message, offset=None):
+        super().__init__(message)
+        self.offset = offset
+
+
+class PartFile(File):
+    # lets the storage move the finished .part file into place instead of copying it
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _upload_dir():
+    upload_dir = settings.CHUNKED_UPLOAD_DIR
+    os.makedirs(upload_dir, exist_ok=True)
+    return upload_dir
+
+
+def part_path(upload_id):
+    return os.path.join(_upload_dir(), f"{upload_id}.part")
+
+
+def _meta_path(upload_id):
+    return os.path.join(_upload_dir(), f"{upload_id}.json")
+
+
+def _load_meta(upload_id, user_id):
+    if not upload_id or not upload_id_pattern.match(str(upload_id)):
+        raise UploadError("Invalid upload id")
+    try:
+        with open(_meta_path(upload_id)) as fh:
+            meta = json.load(fh)
+    except FileNotFoundError:
+        raise UploadError("Unknown upload id")
+
+    if meta["user_id"] != user_id:
+        raise UploadError("Unknown upload id")
+    return meta
+
+
+def _current_offset(upload_id):
+    try:
+        return os.path.getsize(part_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+
+def cleanup_stale_uploads():
+    # removes uploads that did not get a chunk for CHUNKED_UPLOAD_EXPIRY seconds
+    expires_before = time.time() - settings.CHUNKED_UPLOAD_EXPIRY
+    for name in os.listdir(_upload_dir()):
+        upload_id, extension = os.path.splitext(name)
+        if extension != ".json":
+            continue
+        try:
+            last_write = os.path.getmtime(part_path(upload_id))
+        except FileNotFoundError:
+            last_write = 0
+        if last_write < expires_before:
+            discard_upload(upload_id)
+
+
+def begin_upload(user_id, room_id, data):
+    """
+    Starts a new upload, or resumes one when data has the upload_id of an unfinished upload
+    returns (upload id, offset the next chunk has to start at)
+    """
+    upload_id = data.get("upload_id")
+    if upload_id:
+        meta = _load_meta(upload_id, user_id)
+        if meta["room_id"] != room_id:
+            raise UploadError("Upload belongs to another chatroom")
+        return upload_id, _current_offset(upload_id)
+
+    cleanup_stale_uploads()
+
+    total_size = data.get("size")
+    if total_size is not None:
+        total_size = int(total_size)
+        if total_size < 0 or total_size > settings.MAX_UPLOAD_SIZE:
+            raise UploadError("File is too large")
+
+    # hides file name but keeps extension
+    _, file_extension = os.path.splitext(data.get("fileName") or "")
+
+    upload_id = uuid.uuid4().hex
+    meta = {
+        "user_id": user_id,
+        "room_id": room_id,
+        "file_extension": file_extension,
+        "size": total_size,
+        "signature": data.get("signature"),
+        "iv": data.get("iv"),
+    }
+    with open(_meta_path(upload_id), "w") as fh:
+        json.dump(meta, fh)
+    open(part_path(upload_id), "wb").close()
+
+    return upload_id, 0
+
+
+def append_chunk(user_id, upload_id, offset, chunk, room_allowed=None):
+    # appends chunk to the .part file, returns the new offset
+    # chunks only carry the upload id, room_allowed(room id) is asked before anything is written
+    meta = _load_meta(upload_id, user_id)
+    if room_allowed is not None and not room_allowed(meta["room_id"]):
+        raise UploadError("Access denied")
+
+    current_offset = _current_offset(upload_id)
+    if offset is not None and int(offset) != current_offset:
+        # client and server disagree (lost chunk, resend after reconnect..) tell it where to continue
+        raise UploadError("Unexpected offset", offset=current_offset)
+
+    if len(chunk) > settings.CHUNKED_UPLOAD_MAX_CHUNK:
+        raise UploadError("Chunk is too large", offset=current_offset)
+
+    max_size = meta["size"] if meta["size"] is not None else settings.MAX_UPLOAD_SIZE
+    if current_offset + len(chunk) > max_size:
+        raise UploadError("Upload is larger than announced", offset=current_offset)
+
+    with open(part_path(upload_id), "ab") as fh:
+        fh.write(chunk)
+
+    return current_offset + len(chunk)
+
+
+def finish_upload(user_id, upload_id):
+    # returns the upload metadata once every byte was received, the caller stores the .part file
+    meta = _load_meta(upload_id, user_id)
+
+    received = _current_offset(upload_id)
+    if meta["size"] is not None and received != meta["size"]:
+        raise UploadError("Upload is incomplete", offset=received)
+
+    meta["upload_id"] = upload_id
+    meta["part_path"] = part_path(upload_id)
+    return meta
+
+
+def parse_chunk_frame(frame):
+    """
+    Binary upload_chunk frame: 4 byte big endian header length, json header
+    ({"upload_id": .., "offset": ..}), then the raw chunk bytes
+    """
+    if len(frame) < 4:
+        raise UploadError("Invalid chunk frame")
+    header_length = int.from_bytes(frame[:4], "big")
+    try:
+        header = json.loads(frame[4 : 4 + header_length])
+    except ValueError:
+        raise UploadError("Invalid chunk frame")
+    if not isinstance(header, dict) or "upload_id" not in header or "offset" not in header:
+        raise UploadError("Invalid chunk frame")
+    return header, frame[4 + header_length :]
+
+
+def discard_upload(upload_id):
+    for path in (part_path(upload_id), _meta_path(upload_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
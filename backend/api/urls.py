@@ -2,14 +2,34 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.urls import path, re_path
 
-from . import views
+from . import async_views, views
 
 urlpatterns = [
+    # authenticated file downloads, first so none of the patterns below match the file path
+    path("media/<path:file_path>", views.download_file, name="download_file"),
+    # async versions of the read heavy endpoints (api/async_views.py)
+    path("async/get_chatrooms/", async_views.get_chatrooms, name="async_get_chatrooms"),
+    path("async/get_friends/", async_views.get_friends, name="async_get_friends"),
+    path(
+        "async/get_pending_friends/",
+        async_views.get_pending_friends,
+        name="async_get_pending_friends",
+    ),
+    path(
+        "async/get_messages_from_db/",
+        async_views.get_messages_from_db,
+        name="async_get_messages_from_db",
+    ),
+    path("async/get_public/", async_views.get_public, name="async_get_public"),
+    path("async/get_user_SK/", async_views.get_user_SK, name="async_get_user_SK"),
+    path("sync/", views.sync, name="sync"),
+    path("bootstrap/", views.bootstrap, name="bootstrap"),
     re_path("test/", views.test, name="test"),
     re_path("register/", views.register, name="register"),
     re_path("login/", views.login, name="login"),
     re_path("set_public/", views.set_public, name="set_public"),
     re_path("get_public/", views.get_public, name="get_public"),
+    re_path("get_public_keys/", views.get_public_keys, name="get_public_keys"),
     re_path("handleChat/", views.handleChat, name="handleChat"),
     re_path(
         "get_pending_friends/", views.get_pending_friends, name="get_pending_friends"
@@ -35,6 +55,8 @@ urlpatterns = [
         name="handle_chatroom",
     ),
     re_path("get_chatrooms", views.get_chatrooms, name="get_chatrooms"),
+    re_path("get_inbox", views.get_inbox, name="get_inbox"),
+    re_path("mark_chatroom_read", views.mark_chatroom_read, name="mark_chatroom_read"),
     re_path(
         "get_messages_from_db", views.get_messages_from_db, name="get_messages_from_db"
     ),
@@ -46,6 +68,7 @@ urlpatterns = [
         name="get_users_last_online",
     ),
     re_path("upload_file", views.upload_file, name="upload_file"),
+    re_path("cache_stats", views.cache_stats, name="cache_stats"),
 ]
 
 if settings.DEBUG:
@@ -1,13 +1,27 @@
 import json
 
-from api.models import AppUser, ChatRoom, Friendship, Message
+from api.authentication import CachedTokenAuthentication
+from api.bootstrap import session_bootstrap
+from api.cache import all_cache_stats
+from api.dbwriter import run_write
+from api.inbox import mark_read, record_messages
+from api.last_seen import get_last_seen_writer
+from api.media import media_response
+from api.models import AppUser, ChatRoom, Friendship, InboxEntry, Message
+from api.pagination import legacy_page_size, paginate_messages, set_cursor_headers
+from api.public_keys import (keys_etag, lookup_public_keys,
+                             set_cached_public_key)
 from api.serializers import (ChatRoomSerializer, FriendshipSerializer,
-                             MessageSerializer, UserSerializer)
+                             InboxEntrySerializer, MessageSerializer,
+                             UserSerializer)
+from api.sync import sync_changes
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
+from django.conf import settings
 from django.contrib.auth import authenticate
-from django.db.models import Q
+from django.db.models import F, Q
 from django.shortcuts import HttpResponse, get_object_or_404, render
+from django.utils.http import parse_etags
 from django.views.decorators.http import require_POST
 from rest_framework import generics, status  # returns status codes 200, 404
 from rest_framework.authentication import TokenAuthentication
@@ -15,7 +29,7 @@ from rest_framework.authtoken.models import \
     Token  # creates a token for the user
 from rest_framework.decorators import (api_view, authentication_classes,
                                        permission_classes)
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
@@ -32,7 +46,7 @@ def test(request):
 
 
 @api_view(["POST"])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([AllowAny])
 def register(request):
     serializer = UserSerializer(data=request.data)
@@ -50,7 +64,7 @@ def register(request):
 
 
 @api_view(["POST"])
-@authentication_classes([TokenAuthentication])
+@authentication_classes([CachedTokenAuthentication])
 @permission_classes([AllowAny])
 def login(request):
     try:
@@ -92,6 +106,8 @@ def set_public(request):
 
     user.public_key = public_pem
     user.save()
+    # write through, the next batch lookup of our key does not need the db
+    set_cached_public_key(user.username, public_pem)
 
     return Response("success", status=status.HTTP_200_OK)
 
@@ -110,27 +126,87 @@ def get_public(request):
         return Response({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(["GET", "POST"])
+def get_public_keys(request):
+    """
+    Public keys of many users in one request
+    GET ?usernames=a,b,c or POST {"usernames": [..]} for long lists
+
+    every key comes with its version, the response has an ETag over all of them:
+    send it back as If-None-Match to get 304 when none of the keys changed
+    """
+    if request.method == "GET":
+        usernames = [
+            username
+            for value in request.query_params.getlist("usernames")
+            for username in value.split(",")
+            if username
+        ]
+    else:
+        usernames = request.data.get("usernames")
+        if not isinstance(usernames, list):
+            return Response(
+                {"Error": "usernames must be a list"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+    usernames = list(dict.fromkeys(str(username) for username in usernames))
+    if len(usernames) > settings.PUBLIC_KEY_BATCH_MAX:
+        return Response(
+            {"Error": f"at most {settings.PUBLIC_KEY_BATCH_MAX} usernames per request"},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    keys = lookup_public_keys(usernames)
+    etag = keys_etag(keys)
+
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match and etag in parse_etags(if_none_match):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(
+            {
+                "keys": keys,
+                "missing": [username for username in usernames if username not in keys],
+            },
+            status=status.HTTP_200_OK,
+        )
+    response["ETag"] = etag
+    # keys can change at any time, the client has to revalidate
+    response["Cache-Control"] = "private, no-cache"
+    return response
+
+
 def chatroom_exists(user1, user2):
-    chatroom = ChatRoom.objects.filter(
-        Q(user1=user1, user2=user2) | Q(user1=user2, user2=user1)
-    ).first()
+    user1, user2 = ChatRoom.canonical_pair(user1, user2)
+    chatroom = ChatRoom.objects.filter(user1=user1, user2=user2).first()
     if chatroom:
         return chatroom.id
     else:
         return None
 
 
+# returns (room id, created) for the room of 2 users
+def get_or_create_chatroom(user1, user2):
+    # get_or_create falls back to a get if another request inserted the same pair first,
+    # the unique (user1, user2) constraint makes sure only one of them wins
+    user1, user2 = ChatRoom.canonical_pair(user1, user2)
+    chatroom, created = ChatRoom.objects.get_or_create(user1=user1, user2=user2)
+    return chatroom.id, created
+
+
 @api_view(["POST"])
 def handleChat(request):
     loggedInUser = get_object_or_404(AppUser, id=request.user.id)
     user2 = get_object_or_404(AppUser, id=request.data["user_to_message"])
 
-    chatroom_id = chatroom_exists(loggedInUser, user2)
-    if chatroom_id:
+    if loggedInUser == user2:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
+    chatroom_id, created = get_or_create_chatroom(loggedInUser, user2)
+    if not created:
         return Response({"chatroom_id": chatroom_id}, status=status.HTTP_200_OK)
     else:
-        chatroom = ChatRoom.objects.create(user1=loggedInUser, user2=user2)
-        return Response({"chatroom_id": chatroom.id}, status=status.HTTP_201_CREATED)
+        return Response({"chatroom_id": chatroom_id}, status=status.HTTP_201_CREATED)
 
 
 @api_view(["POST"])
@@ -139,16 +215,101 @@ def get_messages_from_db(request):
     chatroom = get_object_or_404(ChatRoom, id=request.data.get("chatroom_id"))
     all_messages = Message.objects.filter(chat_room=chatroom)
 
-    serializer = MessageSerializer(instance=all_messages, many=True)
-    return Response(serializer.data, status=status.HTTP_200_OK)
+    before_id = request.data.get("before_id")
+    after_id = request.data.get("after_id")
+    page_size = request.data.get("page_size")
+
+    # old clients dont send any cursor, they still get a plain list but only of the newest page
+    if before_id is None and after_id is None and page_size is None:
+        messages, next_cursor, has_more = paginate_messages(
+            all_messages, page_size=legacy_page_size()
+        )
+        serializer = MessageSerializer(instance=messages, many=True)
+        return set_cursor_headers(
+            Response(serializer.data, status=status.HTTP_200_OK), next_cursor, has_more
+        )
+
+    try:
+        messages, next_cursor, has_more = paginate_messages(
+            all_messages, before_id=before_id, after_id=after_id, page_size=page_size
+        )
+    except (TypeError, ValueError) as e:
+        return Response({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = MessageSerializer(instance=messages, many=True)
+    return Response(
+        {
+            "messages": serializer.data,
+            "next_cursor": next_cursor,
+            "has_more": has_more,
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
+@api_view(["GET"])
+def bootstrap(request):
+    # friends, requests, rooms, keys and last seen times in one response, see api/bootstrap.py
+    data = session_bootstrap(request.user)
+    return Response(
+        {
+            "friends": FriendshipSerializer(instance=data["friends"], many=True).data,
+            "pending_friends": FriendshipSerializer(
+                instance=data["pending_friends"], many=True
+            ).data,
+            "chatrooms": ChatRoomSerializer(data["chatrooms"], many=True).data,
+            "inbox": InboxEntrySerializer(
+                data["inbox"], many=True, context={"user_id": request.user.id}
+            ).data,
+            "public_keys": data["public_keys"],
+            "session_keys": data["session_keys"],
+            "last_online": data["last_online"],
+            # since_message_id for sync / last_message_id for the websocket resume
+            "last_message_id": data["last_message_id"],
+            "server_time": data["server_time"],
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
+@api_view(["POST"])
+def sync(request):
+    # everything new since the client's watermark, see api/sync.py
+    try:
+        messages, chatrooms, friendships, next_message_id, has_more, server_time = (
+            sync_changes(
+                request.user,
+                since_message_id=request.data.get("since_message_id"),
+                since=request.data.get("since"),
+                limit=request.data.get("limit"),
+            )
+        )
+    except (TypeError, ValueError) as e:
+        return Response({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(
+        {
+            "messages": MessageSerializer(instance=messages, many=True).data,
+            "chatrooms": ChatRoomSerializer(chatrooms, many=True).data,
+            "friendships": FriendshipSerializer(instance=friendships, many=True).data,
+            "next_message_id": next_message_id,
+            "has_more": has_more,
+            # pass back as "since" on the next sync
+            "server_time": server_time,
+        },
+        status=status.HTTP_200_OK,
+    )
 
 
 @api_view(["GET"])
 def get_pending_friends(request):
     loggedInUser = get_object_or_404(AppUser, id=request.user.id)
-    pending_friends = Friendship.objects.filter(to_user=loggedInUser, status="pending")
+    pending_friends = Friendship.objects.filter(
+        to_user=loggedInUser, status="pending"
+    ).select_related(
+        "from_user", "to_user"
+    )  # joins the users so the serializer doesnt query them per row
     serializer = FriendshipSerializer(instance=pending_friends, many=True)
-    print(pending_friends, loggedInUser.username)
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 
@@ -217,7 +378,7 @@ def get_friends(request):
     accepted_friends = Friendship.objects.filter(
         Q(to_user=loggedInUser, status="accepted")
         | Q(from_user=loggedInUser, status="accepted")
-    )
+    ).select_related("from_user", "to_user")
     serializer = FriendshipSerializer(instance=accepted_friends, many=True)
     return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -246,18 +407,17 @@ def verify_token(request):
     return Response(status=status.HTTP_200_OK)
 
 
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def cache_stats(request):
+    # hit/miss counters of the in-process caches of the worker that answers
+    return Response(all_cache_stats(), status=status.HTTP_200_OK)
+
+
 # returns room of 2 users or creates one
 def find_or_create_chatroom(user1_input, user2_input):
-    chatroom = ChatRoom.objects.filter(
-        Q(user1=user1_input, user2=user2_input)
-        | Q(user2=user1_input, user1=user2_input)
-    ).first()
-
-    if chatroom:
-        return chatroom.id
-    else:
-        chatroom = ChatRoom.objects.create(user1=user1_input, user2=user2_input)
-        return chatroom.id
+    chatroom_id, _ = get_or_create_chatroom(user1_input, user2_input)
+    return chatroom_id
 
 
 @api_view(["POST"])
@@ -265,6 +425,9 @@ def handle_chatroom(request):
     loggedInUser = get_object_or_404(AppUser, id=request.user.id)
     user2 = get_object_or_404(AppUser, username=request.data.get("user_to_chat"))
 
+    if loggedInUser == user2:
+        return Response(status=status.HTTP_400_BAD_REQUEST)
+
     chatroom_id = find_or_create_chatroom(loggedInUser, user2)
 
     return Response({"chatroom_id": chatroom_id}, status=status.HTTP_200_OK)
@@ -274,11 +437,52 @@ def handle_chatroom(request):
 def get_chatrooms(request):
     loggedInUser = get_object_or_404(AppUser, id=request.user.id)
 
-    chatrooms = ChatRoom.objects.filter(Q(user1=loggedInUser) | Q(user2=loggedInUser))
+    chatrooms = ChatRoom.objects.filter(
+        Q(user1=loggedInUser) | Q(user2=loggedInUser)
+    ).select_related("user1", "user2")
     serializer = ChatRoomSerializer(chatrooms, many=True)
     return Response(serializer.data, status=status.HTTP_200_OK)
 
 
+@api_view(["GET"])
+def get_inbox(request):
+    # the user's rooms, most recent activity first, with unread counts (api/inbox.py)
+    inbox = (
+        InboxEntry.objects.filter(user=request.user)
+        .select_related("chat_room__user1", "chat_room__user2")
+        .order_by(F("last_message_time").desc(nulls_last=True), "-chat_room_id")
+    )
+    serializer = InboxEntrySerializer(
+        inbox, many=True, context={"user_id": request.user.id}
+    )
+    return Response(serializer.data, status=status.HTTP_200_OK)
+
+
+@api_view(["POST"])
+def mark_chatroom_read(request):
+    chatroom = get_object_or_404(ChatRoom, id=request.data.get("chatroom_id"))
+    if request.user.id not in (chatroom.user1_id, chatroom.user2_id):
+        return Response(
+            {"detail": "User not in chatroom"}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    try:
+        entry = mark_read(
+            request.user, chatroom, request.data.get("last_read_message_id")
+        )
+    except (TypeError, ValueError) as e:
+        return Response({"Error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(
+        {
+            "chatroom_id": chatroom.id,
+            "last_read_message_id": entry.last_read_message_id,
+            "unread_count": entry.unread_count,
+        },
+        status=status.HTTP_200_OK,
+    )
+
+
 @require_POST
 @api_view(["POST"])
 def set_SK(request):
@@ -339,16 +543,25 @@ def get_users_last_online(request):
     if not chatroom_object:
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
-    if chatroom_object.user1 == loggedInUser:
+    # times not flushed to the db yet are only in the last seen service (api/last_seen.py)
+    last_seen = get_last_seen_writer()
+
+    if chatroom_object.user1_id == loggedInUser.id:
         # we need to get user2
         return Response(
-            {"last_online": chatroom_object.user2_last_online},
+            {
+                "last_online": last_seen.get(chatroom_object.id, chatroom_object.user2_id)
+                or chatroom_object.user2_last_online
+            },
             status=status.HTTP_200_OK,
         )
-    elif chatroom_object.user2 == loggedInUser:
+    elif chatroom_object.user2_id == loggedInUser.id:
         # we need to get user1
         return Response(
-            {"last_online": chatroom_object.user1_last_online},
+            {
+                "last_online": last_seen.get(chatroom_object.id, chatroom_object.user1_id)
+                or chatroom_object.user1_last_online
+            },
             status=status.HTTP_200_OK,
         )
 
@@ -400,7 +613,12 @@ def upload_file(request):
         }
         seralizer = MessageSerializer(data=data)
         if seralizer.is_valid():
-            seralizer.save()
+
+            def store_message():
+                record_messages([seralizer.save()])
+
+            # one transaction, on the writer thread in the sqlite production mode (api/dbwriter.py)
+            run_write(store_message)
             return Response(status=status.HTTP_201_CREATED)
 
         print(seralizer.errors)
@@ -409,3 +627,17 @@ def upload_file(request):
     except Exception as e:
         print(e)
         return Response(status=status.HTTP_400_BAD_REQUEST)
+
+
+@api_view(["GET"])
+def download_file(request, file_path):
+    # only members of a chatroom the file was sent in can download it
+    # (blobs are shared, so any message pointing at the file gives access)
+    allowed = Message.objects.filter(
+        Q(chat_room__user1=request.user.id) | Q(chat_room__user2=request.user.id),
+        fileData=file_path,
+    ).exists()
+    if not allowed:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+
+    return media_response(request, file_path)